@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# coding:utf-8
+"""
+Measure the memory held by each session and the cost of the checks made on sessions.
+
+Usage: python3 contrib/benchmark/session_benchmark.py [--sessions 100000] [--checks 1000000]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src", "err-stackstorm")
+)
+
+from errst2lib.credentials_adapters import St2UserToken  # noqa: E402
+from errst2lib.session import Session  # noqa: E402
+
+
+def measure_memory(count):
+    """
+    Returns the number of bytes allocated for each session and its token.
+    """
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    sessions = [Session("user{}".format(i), "secret") for i in range(count)]
+    tokens = [St2UserToken("{:032x}".format(i)) for i in range(count)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    del sessions, tokens
+    return allocated / count
+
+
+def measure_check(statement, session, count):
+    """
+    Returns the number of nanoseconds taken by a statement.
+    """
+    return timeit.timeit(statement, globals={"session": session}, number=count) / count * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=100000, help="Sessions to create.")
+    parser.add_argument("--checks", type=int, default=1000000, help="Repetitions of each check.")
+    args = parser.parse_args()
+
+    print("Memory per session and token: {:.0f} bytes".format(measure_memory(args.sessions)))
+
+    session = Session("user", "secret")
+    for statement in [
+        "session.is_expired()",
+        "session.is_sealed()",
+        "session.id()",
+        "session.attributes()",
+        "repr(session)",
+    ]:
+        print("{:<32}{:>8.0f} ns".format(statement, measure_check(statement, session, args.checks)))
+    statement = "session.match_secret('secret')"
+    print(
+        "{:<32}{:>8.0f} ns".format(statement, measure_check(statement, session, args.checks // 10))
+    )
+
+
+if __name__ == "__main__":
+    main()
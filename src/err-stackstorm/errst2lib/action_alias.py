@@ -0,0 +1,154 @@
+# coding:utf-8
+import logging
+import re
+import threading
+import time
+
+LOG = logging.getLogger("errbot.plugin.st2.action_alias")
+
+
+class ActionAliasFormat(object):
+    """
+    A compiled action-alias format string.  The regular expression is built following the same
+    rules StackStorm's ActionAliasFormatParser uses to match commands against action-alias formats:
+
+      - The format is a regular expression, text outside of parameters isn't escaped.
+      - {{ param }} is a required parameter.
+      - {{ param=default }} is an optional parameter, the whitespace before it is optional too.
+      - The expression is anchored at the start and the end unless it already has an anchor.
+      - key=value pairs may be appended to the end of any command.
+    """
+
+    value = r"""(?:""|''|"(?:.+?)"|'(?:.+?)'|\{.+?\}|\S+)"""
+    ext_value = r"""(?:""|''|"(?:.+?)"|'(?:.+?)'|\{.+?\}|.+?)"""
+    param = r"""["']?(?:(?<=').+?(?=')|(?<=").+?(?=")|\{.+?\}|.+?)["']?"""
+    optional = re.compile(r"(\s*)\{\{\s*(\S+?)\s*=\s*" + ext_value + r"\s*\}\}", re.DOTALL)
+    required = re.compile(r"(\s*)\{\{\s*(\S+?)\s*\}\}", re.DOTALL)
+    ending = re.compile(r"(?:(?:^|\s+)\s*\S+?\s*=" + value + r"\s*)*$", re.DOTALL)
+
+    def __init__(self, display, representation):
+        self.display = display
+        self.representation = representation
+        self.regex = re.compile(self._compile(representation), re.DOTALL)
+
+    def _compile(self, fmt):
+        reg = ActionAliasFormat.optional.sub(
+            lambda m: "(?:{}{})?".format(m.group(1), ActionAliasFormat.param), fmt
+        )
+        reg = ActionAliasFormat.required.sub(
+            lambda m: "{}{}".format(m.group(1), ActionAliasFormat.param), reg
+        )
+        if not reg.startswith("^") and not reg.startswith(r"\A"):
+            reg = r"^\s*" + reg
+        if not re.search(r"(?<!\\)(?:\$|\\Z)$", reg):
+            reg = reg + r"\s*$"
+        return reg
+
+    def match(self, text):
+        """
+        Return True if the text matches the format as is or once any trailing key=value pairs are
+        removed.
+        """
+        if self.regex.search(text) is not None:
+            return True
+        ending = ActionAliasFormat.ending.search(text)
+        if ending and ending.group(0):
+            end = ending.start()
+            return self.regex.search(text[:end]) is not None
+        return False
+
+
+class ActionAliasIndex(object):
+    """
+    An in-process index of all StackStorm action-aliases used to match chat commands without
+    calling the StackStorm API.  The index is fetched with the bot's credentials, compiled once
+    and rebuilt when it is older than the ttl or has been invalidated by an action-alias stream
+    event.
+    """
+
+    def __init__(self, st2api, ttl=300):
+        self.st2api = st2api
+        self.ttl = ttl
+        self.formats = None
+        self.loaded_at = 0
+        self.lock = threading.Lock()
+
+    def invalidate(self, *args):
+        """
+        Mark the index as stale so it is reloaded on the next match.
+        """
+        LOG.debug("Action-alias index invalidated.")
+        self.loaded_at = 0
+
+    def is_stale(self):
+        return self.formats is None or time.monotonic() - self.loaded_at > self.ttl
+
+    def load(self):
+        """
+        Fetch the action-aliases from StackStorm and compile their formats.
+        Returns True when the index was loaded otherwise False.
+        """
+        aliases = self.st2api.actionalias_list()
+        if aliases is None:
+            return False
+
+        formats = []
+        for alias in aliases:
+            for fmt in alias.get("formats", []):
+                if isinstance(fmt, dict):
+                    display = fmt.get("display")
+                    representations = fmt.get("representation", [])
+                    if isinstance(representations, str):
+                        representations = [representations]
+                else:
+                    display = fmt
+                    representations = [fmt]
+                for representation in representations:
+                    try:
+                        formats.append((alias, ActionAliasFormat(display, representation)))
+                    except re.error as err:
+                        LOG.warning(
+                            "Unable to compile format '{}' for action-alias '{}'.  {}".format(
+                                representation, alias.get("ref"), err
+                            )
+                        )
+        self.formats = formats
+        self.loaded_at = time.monotonic()
+        LOG.info(
+            "Action-alias index loaded {} aliases with {} formats.".format(
+                len(aliases), len(formats)
+            )
+        )
+        return True
+
+    def match(self, text):
+        """
+        Match text against the indexed action-alias formats.
+        Returns a list of dicts in the same form as StackStorm's actionalias/match response or None
+        if the index is not available.
+        """
+        if self.is_stale():
+            with self.lock:
+                if self.is_stale():
+                    try:
+                        loaded = self.load()
+                    except Exception as err:
+                        LOG.warning("Failed to load the action-alias index.  {}".format(err))
+                        loaded = False
+                    if loaded is False and self.formats is not None:
+                        # Keep serving the previous index rather than retrying with every command.
+                        self.loaded_at = time.monotonic()
+
+        formats = self.formats
+        if formats is None:
+            return None
+
+        return [
+            {
+                "actionalias": alias,
+                "display": fmt.display,
+                "representation": fmt.representation,
+            }
+            for alias, fmt in formats
+            if fmt.match(text)
+        ]
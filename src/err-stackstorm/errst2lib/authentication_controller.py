@@ -3,7 +3,7 @@ import logging
 
 from errbot.backends.base import Identifier
 
-from errst2lib.errors import SessionInvalidError
+from errst2lib.errors import CircuitOpenError, SessionInvalidError
 from errst2lib.session import generate_password
 from errst2lib.session_manager import SessionManager
 
@@ -57,12 +57,7 @@ class AuthenticationController(object):
         """
         Fetch the session and unseal it to mark it as consumed.
         """
-        session = self.sessions.get_by_uuid(session_id)
-        if session is False:
-            LOG.debug("Invalid session id '{}'.".format(session_id))
-            raise SessionInvalidError
-        session.unseal()
-        return True
+        return self.sessions.consume(session_id)
 
     def list_sessions(self):
         """
@@ -70,6 +65,31 @@ class AuthenticationController(object):
         """
         return self.sessions.list_sessions()
 
+    def update_session(self, session):
+        """
+        Save changes made to a session.
+        """
+        self.sessions.update(session)
+
+    def teardown(self):
+        """
+        Wait for session and token changes to be saved.
+        """
+        self.sessions.teardown()
+
+    def expire_sessions(self):
+        """
+        Evict expired sessions and their StackStorm tokens.  The bot's session is kept, it's
+        renewed along with the bot's token.
+        """
+        return self.sessions.expire(keep=(self.to_userid(self.bot.internal_identity),))
+
+    def session_stats(self):
+        """
+        Returns a dict of live and expired session counts.
+        """
+        return self.sessions.stats()
+
     def session_url(self, session_id, url_path="/"):
         """
         Return a URL formatted with the UUID query string attached.
@@ -85,7 +105,7 @@ class AuthenticationController(object):
             LOG.debug("Session '{}' doesn't exist to be deleted".format(session_id))
             raise SessionInvalidError
         else:
-            self.sessions.delete(session.user_id)
+            self.sessions.delete(session.user_id, session_id)
 
     def get_session_userid(self, session_id):
         session = self.sessions.get_by_uuid(session_id)
@@ -169,7 +189,11 @@ class AuthenticationController(object):
         Return true if credentials were valid or False if they were not.
         """
         # get the configured authentication handler.
-        token = self.bot.cfg.auth_handler.authenticate(user, creds, bot_creds)
+        try:
+            token = self.bot.cfg.auth_handler.authenticate(user, creds, bot_creds)
+        except CircuitOpenError as err:
+            LOG.warning("Unable to validate StackStorm credentials for {}.  {}".format(user, err))
+            token = False
 
         # WARNING: Sensitive security information will be logged, uncomment only when necessary.
         # LOG.debug("Token for {} was {}".format(user, token))
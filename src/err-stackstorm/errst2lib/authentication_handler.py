@@ -1,17 +1,35 @@
 # coding:utf-8
 import abc
 import logging
+import time
+from datetime import datetime as dt
 from urllib.parse import urljoin, urlparse
 
 import requests
 
 from errst2lib.authentication_controller import BotPluginIdentity
+from errst2lib.cache import TTLCache
 from errst2lib.credentials_adapters import St2ApiKey, St2UserCredentials, St2UserToken
-from errst2lib.errors import SessionInvalidError
+from errst2lib.errors import SessionExistsError, SessionInvalidError
+from errst2lib.single_flight import SingleFlight
 
 LOG = logging.getLogger("errbot.plugin.st2.auth_handler")
 
 
+def parse_expiry(expiry):
+    """
+    Returns the POSIX timestamp of a StackStorm token expiry such as "2024-05-28T12:39:28.650231Z"
+    or None if it's missing or can't be parsed.
+    """
+    if not expiry:
+        return None
+    try:
+        return dt.fromisoformat(expiry.replace("Z", "+00:00")).timestamp()
+    except (AttributeError, ValueError):
+        LOG.warning("Unable to parse token expiry '{}'.".format(expiry))
+        return None
+
+
 class AbstractAuthHandlerFactory(metaclass=abc.ABCMeta):
     @abc.abstractmethod
     def instantiate(self, handler_type):
@@ -50,13 +68,19 @@ class BaseAuthHandler(AbstractAuthHandler):
         self.user_creds = user_creds
         self.bot_creds = bot_creds
 
+    def stats(self):
+        """
+        Returns a dict of the handler's counters or None when it has none.
+        """
+        return None
+
     def _http_request(
-        self, verb="GET", base="", path="/", headers={}, payload=None, auth=None, timeout=5
+        self, verb="GET", base="", path="/", headers={}, payload=None, auth=None, endpoint="auth"
     ):
         """
-        Generic HTTP call.
+        Generic HTTP call guarded by the endpoint's circuit breaker.
         """
-        get_kwargs = {"headers": headers, "timeout": timeout, "verify": self.cfg.verify_cert}
+        get_kwargs = {"headers": headers, "endpoint": endpoint}
 
         if auth:
             get_kwargs["auth"] = auth
@@ -70,7 +94,7 @@ class BaseAuthHandler(AbstractAuthHandler):
         url = urljoin(base, new_path)
         # WARNING: Sensitive security information will be logged, uncomment only when necessary.
         # LOG.debug("HTTP Request: {} {} {}".format(verb, url, get_kwargs))
-        return requests.request(verb, url, **get_kwargs)
+        return self.cfg.http.request(verb, url, **get_kwargs)
 
 
 class StandaloneAuthHandler(BaseAuthHandler):
@@ -104,7 +128,8 @@ class StandaloneAuthHandler(BaseAuthHandler):
             payload={"ttl": self.cfg.user_token_ttl},
         )
         if response.status_code in [requests.codes.created]:
-            return St2UserToken(response.json().get("token"))
+            body = response.json()
+            return St2UserToken(body.get("token"), parse_expiry(body.get("expiry")))
         else:
             LOG.info("API response to token = {} {}".format(response.status_code, response.reason))
         return False
@@ -185,19 +210,50 @@ class ServerSideAuthHandler(BaseAuthHandler):
 
     def __init__(self, cfg, opts=""):
         self.cfg = cfg
+        # User tokens are cached until they're about to expire.
+        self.tokens = TTLCache(cfg.user_token_ttl, maxsize=10000)
+        self.token_flight = SingleFlight()
+        self.token_fetches = 0
 
     def pre_execution_authentication(self, accessctl, chat_user):
         """
-        TODO: Docstring
+        Returns the chat user's token from the cache or fetches one from StackStorm.  Concurrent
+        commands from the same chat user share a single fetch.
         """
+        user_token = self.tokens.get(chat_user)
+        if user_token is None:
+            user_token = self.token_flight.do(
+                chat_user, self._fetch_user_token, accessctl, chat_user
+            )
+        return user_token
+
+    def _fetch_user_token(self, accessctl, chat_user):
         # TODO: FIXME: refactor to correct circular dependencies.
+        self.token_fetches += 1
         bot_token = accessctl.get_token_by_userid(accessctl.bot.internal_identity)
         user_token = self.authenticate(chat_user, bot_creds=bot_token)
         if user_token:
-            session = accessctl.create_session(chat_user, "")
+            try:
+                session = accessctl.create_session(chat_user, "")
+            except SessionExistsError:
+                session = accessctl.get_session(chat_user)
             accessctl.set_token_by_session(session.id(), user_token)
+            ttl = self.cfg.user_token_ttl
+            if user_token.expiry is not None:
+                ttl = user_token.expiry - time.time()
+            ttl -= self.cfg.token_expiry_margin
+            if ttl > 0:
+                self.tokens.set(chat_user, user_token, ttl)
         return user_token
 
+    def stats(self):
+        """
+        Returns a dict of the user token cache's counters.
+        """
+        stats = self.tokens.stats()
+        stats["fetches"] = self.token_fetches
+        return stats
+
     def fetch_user_token(self, accessctl, user):
         """
         Returns the session associated with the user.
@@ -246,10 +302,11 @@ class ServerSideAuthHandler(BaseAuthHandler):
             headers=bot_creds.requests(),
             payload={"user": chat_user},
         )
-        if response == requests.codes.ok:
-            token = response.json().get("token", False)
+        if response.status_code == requests.codes.ok:
+            body = response.json()
+            token = body.get("token", False)
             if token is not False:
-                token = St2UserToken(token)
+                token = St2UserToken(token, parse_expiry(body.get("expiry")))
         return token
 
     def authenticate(self, chat_user=None, st2_creds=None, bot_creds=None):
@@ -311,7 +368,8 @@ class ClientSideAuthHandler(BaseAuthHandler):
             payload={"ttl": self.cfg.user_token_ttl},
         )
         if response.status_code in [requests.codes.created]:
-            return St2UserToken(response.json().get("token"))
+            body = response.json()
+            return St2UserToken(body.get("token"), parse_expiry(body.get("expiry")))
         else:
             LOG.info("API response to token = {} {}".format(response.status_code, response.reason))
         return False
@@ -328,10 +386,11 @@ class ClientSideAuthHandler(BaseAuthHandler):
             headers=bot_creds.requests(),
             payload=creds.st2client(),
         )
-        if response == requests.codes.ok:
-            token = response.json().get("token", False)
+        if response.status_code == requests.codes.ok:
+            body = response.json()
+            token = body.get("token", False)
             if token is not False:
-                token = St2UserToken(token)
+                token = St2UserToken(token, parse_expiry(body.get("expiry")))
         return token
 
     def authenticate_key(self, creds, bot_creds):
@@ -346,6 +405,35 @@ class ClientSideAuthHandler(BaseAuthHandler):
 
         return api_key
 
+    def validate_token(self, token, bot_creds):
+        """
+        Check a chat user's cached token or API key is still accepted by StackStorm.
+        Returns True if it is, False if it was rejected or None when StackStorm couldn't say.
+        """
+        if isinstance(token, St2ApiKey):
+            response = self._http_request(
+                "GET", self.cfg.api_url, path="/", headers=token.requests(), endpoint="validate"
+            )
+            if response.status_code == requests.codes.ok:
+                return True
+        else:
+            if not bot_creds:
+                return None
+            response = self._http_request(
+                "POST",
+                self.cfg.auth_url,
+                path="/tokens/validate",
+                headers=bot_creds.requests(),
+                payload={"token": token.token},
+                endpoint="validate",
+            )
+            if response.status_code == requests.codes.ok:
+                return response.json().get("valid", False) is True
+        if response.status_code in [requests.codes.unauthorized, requests.codes.forbidden]:
+            return False
+        LOG.info("API response to validate = {} {}".format(response.status_code, response.reason))
+        return None
+
     def authenticate(self, chat_user=None, st2_creds=None, bot_creds=None):
         token = None
         if isinstance(st2_creds, St2UserCredentials):
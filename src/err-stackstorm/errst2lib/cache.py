@@ -0,0 +1,113 @@
+# coding:utf-8
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+
+LOG = logging.getLogger("errbot.plugin.st2.cache")
+
+
+class TTLCache(object):
+    """
+    Thread safe key/value cache where entries expire after a time to live.  When maxsize is
+    set, the least recently used entry is evicted to make space for a new one.
+    """
+
+    def __init__(self, ttl=300, maxsize=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        """
+        Return the value for key or default if the key is missing or has expired.
+        """
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            expiry, value = item
+            if expiry < time.monotonic():
+                del self.items[key]
+                self.misses += 1
+                return default
+            self.items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Store value for key.  The cache ttl is used when ttl isn't provided.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        with self.lock:
+            self.items[key] = (time.monotonic() + ttl, value)
+            self.items.move_to_end(key)
+            if self.maxsize is not None and len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def stats(self):
+        """
+        Returns a dict of the cache's counters.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.items),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+
+class RecentSet(object):
+    """
+    Thread safe set remembering the most recently added keys.  The oldest key is forgotten when
+    maxsize is reached.
+    """
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self.keys = set()
+        self.order = deque()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.keys
+
+    def add(self, key):
+        """
+        Add key to the set.  Returns False if the key was already present.
+        """
+        with self.lock:
+            if key in self.keys:
+                return False
+            if len(self.order) >= self.maxsize:
+                self.keys.discard(self.order.popleft())
+            self.keys.add(key)
+            self.order.append(key)
+            return True
@@ -7,6 +7,11 @@ from errbot.backends.base import (
     Room,
 )
 
+from errst2lib.cache import TTLCache
+from errst2lib.errors import DeliveryPermanentError, DeliveryTransientError
+from errst2lib.rate_limiter import RateLimiter
+from errst2lib.slack_directory import SlackDirectory
+
 LOG = logging.getLogger("errbot.plugin.st2.chat_adapters")
 
 
@@ -78,6 +83,10 @@ class AbstractChatAdapter(metaclass=abc.ABCMeta):
     def post_message(self, whisper, message, user, channel, extra):
         pass
 
+    @abc.abstractmethod
+    def post_reply(self, msg, message):
+        pass
+
     @abc.abstractmethod
     def format_help(self, help_strings):
         pass
@@ -92,8 +101,54 @@ class AbstractChatAdapter(metaclass=abc.ABCMeta):
 
 
 class GenericChatAdapter(AbstractChatAdapter):
+    # Outbound message limits for the chat backend, overridden by the rate_limit option.
+    rate_limit = {}
+
     def __init__(self, bot_plugin):
         self.bot_plugin = bot_plugin
+        options = dict(self.rate_limit)
+        options.update(bot_plugin.cfg.rate_limit)
+        self.rate_limiter = RateLimiter(**options)
+        self.identifiers = TTLCache(
+            bot_plugin.cfg.identifier_cache_ttl, bot_plugin.cfg.identifier_cache_size
+        )
+
+    def build_identifier(self, text):
+        """
+        Returns the chat backend identifier for a user or channel.  Resolved identifiers are
+        cached, failed resolutions are not.
+        """
+        identifier = self.identifiers.get(text)
+        if identifier is None:
+            identifier = self.bot_plugin.build_identifier(text)
+            self.identifiers.set(text, identifier)
+        return identifier
+
+    def forget_identifiers(self, *texts):
+        """
+        Remove cached identifiers, for example after the chat service rejected them.
+        """
+        for text in texts:
+            if text is not None:
+                self.identifiers.delete(text)
+
+    def activate(self):
+        """
+        Called when the plugin is activated and the chat backend is connected.
+        """
+        pass
+
+    def deactivate(self):
+        pass
+
+    def stats(self):
+        """
+        Returns a dict of the adapter's counters by section.
+        """
+        return {
+            "Chat rate limit": self.rate_limiter.stats(),
+            "Identifier cache": self.identifiers.stats(),
+        }
 
     def get_username(self, msg):
         """
@@ -126,20 +181,35 @@ class GenericChatAdapter(AbstractChatAdapter):
                 whisper, message, user, channel, extra
             )
         )
+        target_id = self.resolve_target(whisper, user, channel)
+        self.rate_limiter.wait(target_id)
+        try:
+            self.bot_plugin.send(target_id, message)
+        except Exception as err:
+            error = self.delivery_error(err)
+            if isinstance(error, DeliveryPermanentError):
+                self.forget_identifiers(user, channel)
+            raise error from err
+
+    def resolve_target(self, whisper, user, channel):
+        """
+        Returns the identifier to post a message to.  Whispers are sent to the user, other
+        messages to the channel or to the user when no channel is set.
+        """
         user_id = None
         channel_id = None
 
         if user is not None:
             try:
-                user_id = self.bot_plugin.build_identifier(user)
+                user_id = self.build_identifier(user)
                 LOG.debug("UserID: {}".format(user_id))
             except ValueError as err:
-                LOG.warning("Invalid user identifier '{}'.  {}".format(channel, err))
+                LOG.warning("Invalid user identifier '{}'.  {}".format(user, err))
 
         if channel is not None:
             try:
                 LOG.debug("Channel {}".format(channel))
-                channel_id = self.bot_plugin.build_identifier(channel)
+                channel_id = self.build_identifier(channel)
             except ValueError as err:
                 LOG.warning("Invalid channel identifier '{}'.  {}".format(channel, err))
 
@@ -154,15 +224,43 @@ class GenericChatAdapter(AbstractChatAdapter):
                 target_id = channel_id
 
         if target_id is None:
-            LOG.error("Unable to post message as there is no user or channel destination.")
-        else:
-            self.bot_plugin.send(target_id, message)
+            raise DeliveryPermanentError(
+                "Unable to post message as there is no user or channel destination."
+            )
+        return target_id
+
+    def delivery_error(self, err):
+        """
+        Returns a DeliveryPermanentError for chat service errors that won't succeed when
+        retried and a DeliveryTransientError for other errors.
+        """
+        if isinstance(err, (DeliveryPermanentError, DeliveryTransientError)):
+            return err
+        message = "{}: {}".format(type(err).__name__, err)
+        status_code = getattr(getattr(err, "response", None), "status_code", None)
+        if isinstance(err, (TypeError, ValueError)):
+            return DeliveryPermanentError(message)
+        if isinstance(status_code, int) and 400 <= status_code < 500 and status_code != 429:
+            return DeliveryPermanentError(message)
+        return DeliveryTransientError(message)
+
+    def post_reply(self, msg, message):
+        """
+        Reply to the chat message a command was received in.
+        """
+        self.bot_plugin._bot.send_simple_reply(msg, message)
 
     def normalise_user_id(self, user):
         return "Generic normalise {}".format(
             [user.aclattr, user.client, user.fullname, user.nick, user.person]
         )
 
+    def user_target(self, user_id):
+        """
+        Returns the user text post_message sends to for a normalised user id.
+        """
+        return user_id
+
     def present_sessions(self, sessions):
         res = "Session:\n"
         for session in sessions:
@@ -171,56 +269,19 @@ class GenericChatAdapter(AbstractChatAdapter):
 
 
 class DiscordChatAdapter(GenericChatAdapter):
+    # https://discord.com/developers/docs/topics/rate-limits
+    rate_limit = {"rate": 50, "burst": 50, "channel_rate": 1, "channel_burst": 5}
+
     def __init__(self, bot_plugin):
         super().__init__(bot_plugin)
 
-    def post_message(self, whisper, message, user, channel, extra):
-        """
-        Post messages to the chat backend.
-        """
-        LOG.debug(
-            "GenericChatAdapter posting message: whisper={},"
-            " message={}, user={}, channel={}, extra={}".format(
-                whisper, message, user, channel, extra
-            )
-        )
-        user_id = None
-        channel_id = None
-
-        if user is not None:
-            try:
-                user_id = self.bot_plugin.build_identifier(user)
-            except ValueError as err:
-                LOG.warning("Invalid user identifier '{}'.  {}".format(channel, err))
-
-        if channel is not None:
-            try:
-                channel_id = self.bot_plugin.build_identifier(channel)
-            except ValueError as err:
-                LOG.warning("Invalid channel identifier '{}'.  {}".format(channel, err))
-
-        # Only whisper to users, not channels.
-        if whisper and user_id is not None:
-            target_id = user_id
-        else:
-            if channel_id is None:
-                # Fall back to user if no channel is set.
-                target_id = user_id
-            else:
-                target_id = channel_id
-
-        if target_id is None:
-            LOG.error("Unable to post message as there is no user or channel destination.")
-        else:
-            self.bot_plugin.send(target_id, message)
-
     def normalise_user_id(self, user):
         return str(user.id)
 
 
 class XMPPChatAdapter(GenericChatAdapter):
     def __init__(self, bot_plugin):
-        self.bot_plugin = bot_plugin
+        super().__init__(bot_plugin)
 
     def normalise_user_id(self, user):
         return "{}@{}/{}".format(user.nick, user.domain, user.resource)
@@ -265,14 +326,66 @@ class MattermostChatAdapter(GenericChatAdapter):
 
 
 class SlackChatAdapter(GenericChatAdapter):
+    # https://api.slack.com/methods/chat.postMessage#rate_limiting
+    rate_limit = {"channel_rate": 1, "channel_burst": 5}
+    # https://api.slack.com/methods/chat.postMessage#errors
+    permanent_errors = set(
+        [
+            "account_inactive",
+            "cannot_dm_bot",
+            "channel_not_found",
+            "invalid_auth",
+            "invalid_blocks",
+            "is_archived",
+            "msg_too_long",
+            "no_text",
+            "not_authed",
+            "not_in_channel",
+            "restricted_action",
+            "user_not_found",
+        ]
+    )
+
     def __init__(self, bot_plugin):
         super().__init__(bot_plugin)
+        self.directory = None
+        if bot_plugin.cfg.slack_directory:
+            self.directory = SlackDirectory(
+                lambda: self.bot_plugin._bot.slack_web, bot_plugin.cfg.slack_directory_refresh
+            )
+
+    def activate(self):
+        if self.directory is not None:
+            self.directory.start()
+
+    def deactivate(self):
+        if self.directory is not None:
+            self.directory.stop()
+
+    def stats(self):
+        stats = super().stats()
+        if self.directory is not None:
+            stats["Slack directory"] = self.directory.stats()
+        return stats
+
+    def build_identifier(self, text):
+        """
+        User and channel names found in the Slack directory are passed to the backend as Slack
+        ids, which it resolves without calling Slack.
+        """
+        if self.directory is not None:
+            text = self.directory.translate(text)
+        return super().build_identifier(text)
 
     def get_username(self, msg):
         """
         Return the user name from an errbot message object.
         Slack identity tuple (username, userid, channelname, channelid)
         """
+        if self.directory is not None:
+            username = self.directory.username(getattr(msg.frm, "userid", None))
+            if username is not None:
+                return "@{}".format(username)
         (
             username,
             user_id,
@@ -307,34 +420,9 @@ class SlackChatAdapter(GenericChatAdapter):
             "Slack posting message: whisper={}, message={},"
             " user={}, channel={}, extra={}".format(whisper, message, user, channel, extra)
         )
-        user_id = None
-        channel_id = None
-
-        if user is not None:
-            try:
-                user_id = self.bot_plugin.build_identifier(user)
-            except ValueError as err:
-                LOG.warning("Invalid user identifier '{}'.  {}".format(channel, err))
-
-        if channel is not None:
-            try:
-                channel_id = self.bot_plugin.build_identifier(channel)
-            except ValueError as err:
-                LOG.warning("Invalid channel identifier '{}'.  {}".format(channel, err))
-
-        # Only whisper to users, not channels.
-        if whisper and user_id is not None:
-            target_id = user_id
-        else:
-            if channel_id is None:
-                # Fall back to user if no channel is set.
-                target_id = user_id
-            else:
-                target_id = channel_id
-
-        if target_id is None:
-            LOG.error("Unable to post message as there is no user or channel destination.")
-        else:
+        target_id = self.resolve_target(whisper, user, channel)
+        self.rate_limiter.wait(target_id)
+        try:
             if extra and "slack" in extra:
                 # https://api.slack.com/reference/messaging/attachments#legacy_fields
                 legacy_fields = set(
@@ -363,6 +451,23 @@ class SlackChatAdapter(GenericChatAdapter):
                     self._post_block_message(whisper, message, target_id, extra["slack"])
             else:
                 self.bot_plugin.send(target_id, message)
+        except Exception as err:
+            error = self.delivery_error(err)
+            if isinstance(error, DeliveryPermanentError):
+                self.forget_identifiers(user, channel)
+            raise error from err
+
+    def delivery_error(self, err):
+        """
+        Slack API errors are classified by their error code.
+        """
+        try:
+            error_code = err.response.get("error")
+        except AttributeError:
+            error_code = None
+        if error_code in self.permanent_errors:
+            return DeliveryPermanentError("Slack API error: {}".format(error_code))
+        return super().delivery_error(err)
 
     def _post_legacy_attachment(self, whisper, message, target_id, extra):
         LOG.debug("Legacy attachment - Send card using backend {}".format(self.bot_plugin.mode))
@@ -426,6 +531,9 @@ class SlackChatAdapter(GenericChatAdapter):
     def normalise_user_id(self, user):
         return str(user.userid)
 
+    def user_target(self, user_id):
+        return "@{}".format(user_id)
+
     def present_sessions(self, sessions):
         res = "**Sessions**:\n"
         for session in sessions:
@@ -433,9 +541,7 @@ class SlackChatAdapter(GenericChatAdapter):
             if session.attributes().get("UserID") == "errbot%service":
                 res += "- {}\n".format(str(session))
             else:
-                user = self.bot_plugin.build_identifier(
-                    "@{}".format(session.attributes().get("UserID"))
-                )
+                user = self.build_identifier("@{}".format(session.attributes().get("UserID")))
                 res += "- {} {}\n".format(user.person, str(session))
         return res
 
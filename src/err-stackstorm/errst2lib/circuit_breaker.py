@@ -0,0 +1,146 @@
+# coding:utf-8
+import logging
+import threading
+import time
+from collections import deque
+
+from errst2lib.errors import CircuitOpenError
+
+LOG = logging.getLogger("errbot.plugin.st2.circuit_breaker")
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker for a StackStorm end point.
+
+    closed:     requests are sent and failures are counted.
+    open:       requests fail fast until reset_timeout seconds have passed.
+    half-open:  a single trial request is sent, its outcome closes or re-opens the circuit.
+
+    The request timeout adapts to the observed latency.  It's set to a multiple of the latency
+    percentile, bounded by min_timeout and max_timeout.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(
+        self,
+        name,
+        failure_threshold=5,
+        reset_timeout=30,
+        min_timeout=2,
+        max_timeout=10,
+        percentile=95,
+        timeout_factor=3,
+        samples=100,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.percentile = percentile
+        self.timeout_factor = timeout_factor
+        self.latencies = deque(maxlen=samples)
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.trial_in_flight = False
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        """
+        Raise CircuitOpenError if a request isn't allowed to be sent.
+        """
+        with self.lock:
+            if self.state == CircuitBreaker.OPEN:
+                remaining = self.opened_at + self.reset_timeout - time.monotonic()
+                if remaining > 0:
+                    self.rejected += 1
+                    raise CircuitOpenError(self.name, remaining)
+                LOG.info("Circuit breaker '{}' is half-open.".format(self.name))
+                self.state = CircuitBreaker.HALF_OPEN
+            if self.state == CircuitBreaker.HALF_OPEN:
+                if self.trial_in_flight:
+                    self.rejected += 1
+                    raise CircuitOpenError(self.name, self.reset_timeout)
+                self.trial_in_flight = True
+
+    def record_success(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+            if self.state != CircuitBreaker.CLOSED:
+                LOG.info("Circuit breaker '{}' is closed.".format(self.name))
+            self.state = CircuitBreaker.CLOSED
+            self.failures = 0
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.state == CircuitBreaker.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != CircuitBreaker.OPEN:
+                    LOG.warning(
+                        "Circuit breaker '{}' is open for {} seconds after {} failures.".format(
+                            self.name, self.reset_timeout, self.failures
+                        )
+                    )
+                self.state = CircuitBreaker.OPEN
+                self.opened_at = time.monotonic()
+
+    def latency(self, percentile=None):
+        """
+        Returns the latency percentile in seconds or None when there are no samples.
+        """
+        if percentile is None:
+            percentile = self.percentile
+        # Copy the samples under the lock, requests record latencies while they are sorted.
+        with self.lock:
+            samples = list(self.latencies)
+        samples.sort()
+        if len(samples) == 0:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * percentile / 100))]
+
+    def timeout(self):
+        """
+        Returns the request timeout in seconds adapted to the observed latency.
+        """
+        # Too few samples to be representative, use the maximum.
+        if len(self.latencies) < 10:
+            return self.max_timeout
+        return min(self.max_timeout, max(self.min_timeout, self.latency() * self.timeout_factor))
+
+    def stats(self):
+        latency = self.latency()
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "latency_p{}".format(self.percentile): round(latency, 3) if latency else None,
+            "timeout": round(self.timeout(), 3),
+        }
+
+
+class CircuitBreakers(object):
+    """
+    A circuit breaker per named StackStorm end point, created on first use.
+    """
+
+    def __init__(self, options=None):
+        self.options = options or {}
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        with self.lock:
+            if name not in self.breakers:
+                self.breakers[name] = CircuitBreaker(name, **self.options)
+            return self.breakers[name]
+
+    def stats(self):
+        return {name: breaker.stats() for name, breaker in sorted(self.breakers.items())}
@@ -0,0 +1,149 @@
+# coding:utf-8
+import logging
+import threading
+import time
+from collections import deque
+
+from errst2lib.delivery import Announcement
+
+LOG = logging.getLogger("errbot.plugin.st2.coalescer")
+
+
+class Coalescer(object):
+    """
+    Merge bursts of plain text announcements for the same channel, user and whisper into a
+    single announcement.
+
+    The first announcement of a burst opens a window of window seconds.  Announcements for the
+    same destination arriving within the window are joined with new lines, until the merged
+    message would exceed max_length characters.  Announcements with extra data, such as Slack
+    attachments or blocks, are never merged.  They are emitted after any pending announcements
+    for their channel so channel order is kept.
+
+    Announcements ready to be emitted are queued in order while holding the condition and are
+    emitted after it's released, one thread at a time, so slow deliveries don't block put.
+    """
+
+    def __init__(self, emit, window=0.5, max_length=4000):
+        self.emit = emit
+        self.window = window
+        self.max_length = max_length
+        self.pending = {}
+        self.outbox = deque()
+        self.running = True
+        self.condition = threading.Condition()
+        self.emit_lock = threading.Lock()
+        self.received = 0
+        self.emitted = 0
+        self.thread = threading.Thread(target=self._flusher, name="st2_coalescer", daemon=True)
+        self.thread.start()
+
+    def put(self, announcement):
+        with self.condition:
+            self._put(announcement)
+            ready = bool(self.outbox)
+        if ready:
+            self._drain()
+
+    def _put(self, announcement):
+        self.received += 1
+        if announcement.extra or not isinstance(announcement.message, str):
+            self._flush_channel(announcement.channel)
+            self._ready(announcement)
+            return
+
+        key = (announcement.channel, announcement.whisper, announcement.user)
+        group = self.pending.get(key)
+        if group is not None:
+            length = sum(len(m) + 1 for m in group["messages"]) + len(announcement.message)
+            if length > self.max_length:
+                self._flush(key)
+                group = None
+        if group is None:
+            group = {
+                "first": announcement,
+                "messages": [],
+                "spool_ids": [],
+                "deadline": time.monotonic() + self.window,
+            }
+            self.pending[key] = group
+            self.condition.notify()
+        group["messages"].append(announcement.message)
+        group["spool_ids"].extend(announcement.spool_ids)
+
+    def _ready(self, announcement):
+        # Called holding the condition.
+        self.emitted += 1
+        self.outbox.append(announcement)
+
+    def _drain(self):
+        """
+        Emit the queued announcements in order.
+        """
+        with self.emit_lock:
+            while True:
+                with self.condition:
+                    if not self.outbox:
+                        return
+                    announcement = self.outbox.popleft()
+                try:
+                    self.emit(announcement)
+                except Exception as err:
+                    LOG.exception("Failed to emit {}.  {}".format(announcement, err))
+
+    def _flush(self, key):
+        group = self.pending.pop(key)
+        first = group["first"]
+        if len(group["messages"]) == 1:
+            self._ready(first)
+            return
+        LOG.debug("Coalesced {} announcements for {}.".format(len(group["messages"]), first))
+        announcement = Announcement(
+            first.whisper, "\n".join(group["messages"]), first.user, first.channel, first.extra
+        )
+        announcement.queued_at = first.queued_at
+        announcement.spool_ids = group["spool_ids"]
+        self._ready(announcement)
+
+    def _flush_channel(self, channel):
+        for key in [k for k in self.pending if k[0] == channel]:
+            self._flush(key)
+
+    def _flusher(self):
+        while True:
+            with self.condition:
+                if not self.running:
+                    return
+                now = time.monotonic()
+                for key in [k for k, g in self.pending.items() if g["deadline"] <= now]:
+                    self._flush(key)
+                if not self.outbox:
+                    if self.pending:
+                        timeout = min(g["deadline"] for g in self.pending.values()) - now
+                    else:
+                        timeout = None
+                    self.condition.wait(timeout)
+            self._drain()
+
+    def stats(self):
+        """
+        Returns a dict of the coalescer's counters.
+        """
+        with self.condition:
+            return {
+                "received": self.received,
+                "emitted": self.emitted,
+                "pending": len(self.pending),
+            }
+
+    def shutdown(self):
+        """
+        Emit the pending announcements and stop the flusher thread.
+        """
+        with self.condition:
+            self.running = False
+            for key in list(self.pending):
+                self._flush(key)
+            self.condition.notify()
+        self.thread.join()
+        self._drain()
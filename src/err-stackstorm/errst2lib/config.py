@@ -1,8 +1,10 @@
 # coding:utf-8
 import logging
+import os
 
 from errst2lib.authentication_handler import AuthHandlerFactory
 from errst2lib.credentials_adapters import CredentialsFactory
+from errst2lib.http_client import HttpClientFactory
 
 LOG = logging.getLogger(__name__)
 
@@ -42,13 +44,65 @@ class PluginConfiguration(BorgSingleton):
         self.timer_update = bot_conf.STACKSTORM.get("timer_update", 60)
         self.verify_cert = bot_conf.STACKSTORM.get("verify_cert", True)
         self.secrets_store = bot_conf.STACKSTORM.get("secrets_store", "cleartext")
+        self.secrets_store_options = bot_conf.STACKSTORM.get("secrets_store_options", {})
+        if self.secrets_store == "sqlite" and "path" not in self.secrets_store_options:
+            # Keep the database with Errbot's data rather than in the working directory.
+            self.secrets_store_options = dict(
+                self.secrets_store_options,
+                path=os.path.join(bot_conf.BOT_DATA_DIR, "st2_secrets.db"),
+            )
         self.route_key = bot_conf.STACKSTORM.get("route_key", "errbot")
         self.session_ttl = bot_conf.STACKSTORM.get("session_ttl", 3600)
+        self.session_sweep_interval = bot_conf.STACKSTORM.get("session_sweep_interval", 60)
         self.user_token_ttl = bot_conf.STACKSTORM.get("user_token_ttl", 86400)
+        self.token_expiry_margin = bot_conf.STACKSTORM.get("token_expiry_margin", 300)
+        self.bot_token_renewal = bot_conf.STACKSTORM.get("bot_token_renewal", 0.75)
+        self.token_revalidate_interval = bot_conf.STACKSTORM.get("token_revalidate_interval", 900)
+        self.token_revalidate = bot_conf.STACKSTORM.get("token_revalidate", {})
 
         self.client_cert = bot_conf.STACKSTORM.get("client_cert", None)
         self.client_key = bot_conf.STACKSTORM.get("client_key", None)
         self.ca_cert = bot_conf.STACKSTORM.get("ca_cert", None)
+        self.pool_size = bot_conf.STACKSTORM.get("pool_size", {})
+        self.http_engine = bot_conf.STACKSTORM.get("http_engine", "requests")
+        self.circuit_breaker = bot_conf.STACKSTORM.get("circuit_breaker", {})
+        self.alias_index = bot_conf.STACKSTORM.get("alias_index", True)
+        self.alias_index_ttl = bot_conf.STACKSTORM.get("alias_index_ttl", 300)
+        self.help_cache_ttl = bot_conf.STACKSTORM.get("help_cache_ttl", 300)
+        self.execution_workers = bot_conf.STACKSTORM.get("execution_workers", 4)
+        self.execution_queue_size = bot_conf.STACKSTORM.get("execution_queue_size", 100)
+        self.delivery_workers = bot_conf.STACKSTORM.get("delivery_workers", 4)
+        self.delivery_queue_size = bot_conf.STACKSTORM.get("delivery_queue_size", 1000)
+        self.delivery_overflow = bot_conf.STACKSTORM.get("delivery_overflow", "block")
+        self.coalesce_window = bot_conf.STACKSTORM.get("coalesce_window", 0)
+        self.coalesce_max_length = bot_conf.STACKSTORM.get("coalesce_max_length", 4000)
+        self.rate_limit = bot_conf.STACKSTORM.get("rate_limit", {})
+        self.spool_path = bot_conf.STACKSTORM.get("spool_path")
+        self.delivery_retry = bot_conf.STACKSTORM.get("delivery_retry", {})
+        self.webhook_async = bot_conf.STACKSTORM.get("webhook_async", False)
+        self.webhook_status = bot_conf.STACKSTORM.get("webhook_status", False)
+        if self.webhook_async and self.delivery_workers < 1:
+            # Webhook messages are only acknowledged before delivery when they are queued.
+            LOG.warning("webhook_async requires delivery workers, delivery_workers is set to 1.")
+            self.delivery_workers = 1
+        self.receipt_ttl = bot_conf.STACKSTORM.get("receipt_ttl", 3600)
+        self.webhook_batch_max = bot_conf.STACKSTORM.get("webhook_batch_max", 1000)
+        self.identifier_cache_size = bot_conf.STACKSTORM.get("identifier_cache_size", 1000)
+        self.identifier_cache_ttl = bot_conf.STACKSTORM.get("identifier_cache_ttl", 3600)
+        self.slack_directory = bot_conf.STACKSTORM.get("slack_directory", False)
+        self.slack_directory_refresh = bot_conf.STACKSTORM.get("slack_directory_refresh", 3600)
+
+        self.open_http()
+
+    def open_http(self):
+        """
+        Create the HTTP client shared by all StackStorm API and authentication calls, closing
+        the client it replaces.
+        """
+        previous = getattr(self, "http", None)
+        self.http = HttpClientFactory.instantiate(self.http_engine)(self)
+        if previous is not None:
+            previous.close()
 
     def _configure_rbac_auth(self, bot_conf):
         self.auth_handler = None
@@ -30,6 +30,9 @@ class CredentialsFactory(AbstractCredentialsFactory):
 
 
 class AbstractCredentials(metaclass=abc.ABCMeta):
+    # Credentials are slotted, one is held for each session.
+    __slots__ = ()
+
     @abc.abstractmethod
     def __init__(self, username=None, password=None):
         raise NotImplementedError
@@ -44,6 +47,8 @@ class AbstractCredentials(metaclass=abc.ABCMeta):
 
 
 class St2UserCredentials(AbstractCredentials):
+    __slots__ = ("username", "password")
+
     def __init__(self, username=None, password=None):
         self.username = username
         self.password = password
@@ -68,10 +73,14 @@ class St2UserCredentials(AbstractCredentials):
 
 
 class St2UserToken(AbstractCredentials):
-    def __init__(self, token=None):
+    __slots__ = ("token", "expiry")
+
+    def __init__(self, token=None, expiry=None):
         self.token = None
         if token:
             self.token = token
+        # POSIX timestamp of the token's expiry when StackStorm provided it.
+        self.expiry = expiry
 
     def __repr__(self):
         return self.token
@@ -84,6 +93,8 @@ class St2UserToken(AbstractCredentials):
 
 
 class St2ApiKey(AbstractCredentials):
+    __slots__ = ("apikey",)
+
     def __init__(self, apikey=None):
         self.apikey = None
         if apikey:
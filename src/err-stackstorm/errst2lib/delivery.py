@@ -0,0 +1,208 @@
+# coding:utf-8
+import logging
+import queue
+import threading
+import time
+
+LOG = logging.getLogger("errbot.plugin.st2.delivery")
+
+
+class Announcement(object):
+    """
+    A ChatOps notification read from the StackStorm stream waiting to be posted to chat.
+    """
+
+    def __init__(self, whisper, message, user, channel, extra):
+        self.whisper = whisper
+        self.message = message
+        self.user = user
+        self.channel = channel
+        self.extra = extra
+        self.queued_at = time.monotonic()
+        # Ids of the spool records the announcement was built from.
+        self.spool_ids = []
+        # Id of the delivery receipt returned to the webhook caller.
+        self.receipt = None
+
+    def __repr__(self):
+        return "<Announcement channel={} user={} whisper={}>".format(
+            self.channel, self.user, self.whisper
+        )
+
+    def to_dict(self):
+        return {
+            "whisper": self.whisper,
+            "message": self.message,
+            "user": self.user,
+            "channel": self.channel,
+            "extra": self.extra,
+        }
+
+    @staticmethod
+    def from_dict(data):
+        return Announcement(
+            data.get("whisper"),
+            data.get("message"),
+            data.get("user"),
+            data.get("channel"),
+            data.get("extra"),
+        )
+
+    def key(self):
+        """
+        Announcements with the same key are delivered in the order they were queued.
+        """
+        return self.channel or self.user
+
+
+class DeliveryQueue(object):
+    """
+    Deliver announcements to chat from a pool of worker threads so a slow chat API call doesn't
+    hold up reading the stream.
+
+    Each worker has its own bounded queue.  Announcements are assigned to a worker by hashing
+    their channel, which delivers channels in parallel while keeping the order of announcements
+    within a channel.  When a worker's queue is full the overflow policy applies:
+
+    block:          the producer waits for space in the queue.
+    drop_oldest:    the oldest queued announcement is dropped to make space.
+    drop_newest:    the announcement being queued is dropped.
+    """
+
+    BLOCK = "block"
+    DROP_OLDEST = "drop_oldest"
+    DROP_NEWEST = "drop_newest"
+    OVERFLOW_POLICIES = [BLOCK, DROP_OLDEST, DROP_NEWEST]
+
+    def __init__(self, name, deliver, workers=4, queue_size=1000, overflow="block", on_drop=None):
+        if overflow not in DeliveryQueue.OVERFLOW_POLICIES:
+            raise ValueError("Unknown delivery overflow policy '{}'.".format(overflow))
+        self.name = name
+        self.deliver = deliver
+        self.on_drop = on_drop
+        self.overflow = overflow
+        self.queue_size = queue_size
+        self.running = True
+        # Set when shutdown gave up waiting for the queued announcements to be delivered.
+        self.abandoned = threading.Event()
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.delivered = 0
+        self.failed = 0
+        self.dropped = 0
+        self.blocked = 0
+        self.max_latency = 0.0
+
+        self.queues = [queue.Queue(maxsize=max(1, queue_size // workers)) for _ in range(workers)]
+        self.threads = []
+        for i, q in enumerate(self.queues):
+            thread = threading.Thread(
+                target=self._worker, args=[q], name="{}_{}".format(name, i), daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, announcement):
+        """
+        Queue an announcement for delivery.  Returns False if it was dropped.
+        """
+        q = self.queues[hash(announcement.key()) % len(self.queues)]
+        try:
+            q.put_nowait(announcement)
+        except queue.Full:
+            if not self._overflow(q, announcement):
+                return False
+        with self.lock:
+            self.queued += 1
+        return True
+
+    def _overflow(self, q, announcement):
+        if self.overflow == DeliveryQueue.DROP_NEWEST:
+            self._drop(announcement)
+            return False
+
+        if self.overflow == DeliveryQueue.DROP_OLDEST:
+            while True:
+                try:
+                    self._drop(q.get_nowait())
+                except queue.Empty:
+                    pass
+                try:
+                    q.put_nowait(announcement)
+                    return True
+                except queue.Full:
+                    continue
+
+        with self.lock:
+            self.blocked += 1
+        LOG.debug("{} queue is full, waiting for space.".format(self.name))
+        while self.running:
+            try:
+                q.put(announcement, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        self._drop(announcement)
+        return False
+
+    def _drop(self, announcement):
+        with self.lock:
+            self.dropped += 1
+        LOG.warning("{} queue is full, {} dropped.".format(self.name, announcement))
+        if self.on_drop is not None:
+            self.on_drop(announcement)
+
+    def _worker(self, q):
+        while True:
+            announcement = q.get()
+            if announcement is None or self.abandoned.is_set():
+                break
+            try:
+                self.deliver(announcement)
+                with self.lock:
+                    self.delivered += 1
+                    self.max_latency = max(
+                        self.max_latency, time.monotonic() - announcement.queued_at
+                    )
+            except Exception as err:
+                LOG.exception("{} failed to deliver {}.  {}".format(self.name, announcement, err))
+                with self.lock:
+                    self.failed += 1
+
+    def stats(self):
+        """
+        Returns a dict of the delivery queue's counters.
+        """
+        with self.lock:
+            return {
+                "workers": len(self.queues),
+                "queue_size": self.queue_size,
+                "overflow": self.overflow,
+                "queue_depth": sum(q.qsize() for q in self.queues),
+                "queued": self.queued,
+                "delivered": self.delivered,
+                "failed": self.failed,
+                "dropped": self.dropped,
+                "blocked": self.blocked,
+                "max_latency": round(self.max_latency, 3),
+            }
+
+    def shutdown(self, wait=True, timeout=30):
+        """
+        Stop the workers once the announcements already queued have been delivered.  Workers
+        that haven't emptied their queue within timeout seconds stop after their current delivery
+        and the announcements left in the queue aren't delivered.
+        """
+        self.running = False
+        deadline = time.monotonic() + timeout
+        for q in self.queues:
+            try:
+                q.put(None, timeout=max(deadline - time.monotonic(), 0))
+            except queue.Full:
+                # The worker stops when it takes its next announcement.
+                self.abandoned.set()
+        if self.abandoned.is_set():
+            LOG.warning("{} didn't deliver its queue in time, abandoning it.".format(self.name))
+        if wait:
+            for thread in self.threads:
+                thread.join(max(deadline - time.monotonic(), 0))
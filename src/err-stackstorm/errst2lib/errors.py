@@ -28,3 +28,30 @@ class SessionExistsError(Error):
     def __init__(self, message="Session already exists."):
         super(SessionExistsError, self).__init__()
         self.message = message
+
+
+class CircuitOpenError(Error):
+    def __init__(self, endpoint, retry_in=0):
+        super(CircuitOpenError, self).__init__()
+        self.endpoint = endpoint
+        self.message = "StackStorm {} end point is unavailable, retry in {} seconds.".format(
+            endpoint, int(retry_in) + 1
+        )
+
+
+class DeliveryTransientError(Error):
+    def __init__(self, message="Chat delivery failed temporarily."):
+        super(DeliveryTransientError, self).__init__()
+        self.message = message
+
+
+class DeliveryPermanentError(Error):
+    def __init__(self, message="Chat delivery failed permanently."):
+        super(DeliveryPermanentError, self).__init__()
+        self.message = message
+
+
+class DirectoryStoppedError(Error):
+    def __init__(self, message="Slack directory was stopped."):
+        super(DirectoryStoppedError, self).__init__()
+        self.message = message
@@ -0,0 +1,88 @@
+# coding:utf-8
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+LOG = logging.getLogger("errbot.plugin.st2.executor")
+
+
+class BoundedExecutor(object):
+    """
+    Thread pool with a bounded number of waiting jobs.  Jobs submitted while the pool and its
+    queue are full are rejected immediately rather than blocking the caller.  Queue depth and the
+    time jobs spend waiting for a worker are recorded.
+    """
+
+    def __init__(self, name, workers=4, queue_size=100):
+        self.name = name
+        self.workers = workers
+        self.queue_size = queue_size
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.running = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queue fn to be called with args by a worker.  Returns False if the queue is full.
+        """
+        if self.slots.acquire(blocking=False) is False:
+            with self.lock:
+                self.rejected += 1
+            LOG.warning("{} queue is full, job rejected.".format(self.name))
+            return False
+        with self.lock:
+            self.submitted += 1
+            self.pending += 1
+        self.pool.submit(self._run, time.monotonic(), fn, args, kwargs)
+        return True
+
+    def _run(self, queued_at, fn, args, kwargs):
+        wait = time.monotonic() - queued_at
+        with self.lock:
+            self.pending -= 1
+            self.running += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+        try:
+            fn(*args, **kwargs)
+            with self.lock:
+                self.completed += 1
+        except Exception as err:
+            LOG.exception("{} job failed.  {}".format(self.name, err))
+            with self.lock:
+                self.failed += 1
+        finally:
+            with self.lock:
+                self.running -= 1
+            self.slots.release()
+
+    def stats(self):
+        """
+        Returns a dict of the executor's counters.
+        """
+        with self.lock:
+            started = self.completed + self.failed + self.running
+            return {
+                "workers": self.workers,
+                "queue_size": self.queue_size,
+                "queue_depth": self.pending,
+                "running": self.running,
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "completed": self.completed,
+                "failed": self.failed,
+                "avg_wait": round(self.total_wait / started, 3) if started else 0.0,
+                "max_wait": round(self.max_wait, 3),
+            }
+
+    def shutdown(self, wait=True):
+        self.pool.shutdown(wait=wait)
@@ -0,0 +1,345 @@
+# coding:utf-8
+import abc
+import asyncio
+import concurrent.futures
+import json
+import logging
+import queue
+import ssl
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+import sseclient
+import urllib3
+from requests.adapters import HTTPAdapter
+
+from errst2lib.circuit_breaker import CircuitBreakers
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+LOG = logging.getLogger("errbot.plugin.st2.http_client")
+
+
+class AbstractHttpClientFactory(metaclass=abc.ABCMeta):
+    @abc.abstractmethod
+    def instantiate(engine):
+        raise NotImplementedError
+
+
+class HttpClientFactory(AbstractHttpClientFactory):
+    @staticmethod
+    def instantiate(engine="requests"):
+        if engine == "asyncio" and aiohttp is None:
+            LOG.warning("The asyncio HTTP engine requires aiohttp, defaulting to requests.")
+            engine = "requests"
+        LOG.debug("Create HTTP client for '{}' engine".format(engine))
+        return {"requests": HttpClient, "asyncio": AsyncHttpClient}.get(engine, HttpClient)
+
+
+class AbstractHttpClient(metaclass=abc.ABCMeta):
+    default_pool_size = 10
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.breakers = CircuitBreakers(cfg.circuit_breaker)
+        self.closed = False
+
+    @abc.abstractmethod
+    def send(self, verb, url, **kwargs):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def events(self, url, headers, params=None, last_id=None):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def close(self):
+        raise NotImplementedError
+
+    def request(self, verb, url, endpoint=None, **kwargs):
+        """
+        Send an HTTP request.  When an endpoint name is given, the request is guarded by the
+        endpoint's circuit breaker and its timeout adapts to the endpoint's observed latency.
+        CircuitOpenError is raised without sending the request while the circuit is open.
+        """
+        if endpoint is None:
+            return self.send(verb, url, **kwargs)
+
+        breaker = self.breakers.get(endpoint)
+        breaker.before_call()
+        kwargs["timeout"] = breaker.timeout()
+        start = time.monotonic()
+        try:
+            response = self.send(verb, url, **kwargs)
+        except Exception:
+            breaker.record_failure()
+            raise
+        if response.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success(time.monotonic() - start)
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def pool_sizes(self):
+        """
+        Returns a dict of connection pool sizes by url prefix.  End points served from the same
+        host share a pool sized for the largest of them.
+        """
+        pools = {}
+        for end_point in ["api_url", "auth_url", "stream_url"]:
+            o = urlparse(getattr(self.cfg, end_point))
+            prefix = "{}://{}/".format(o.scheme, o.netloc)
+            pool_size = self.cfg.pool_size.get(end_point, AbstractHttpClient.default_pool_size)
+            pools[prefix] = max(pool_size, pools.get(prefix, 0))
+        return pools
+
+
+class HttpClient(AbstractHttpClient):
+    """
+    Connection pooled HTTP client shared by the StackStorm API and authentication handlers.
+
+    A single requests session is used to keep TCP/TLS connections alive between calls.  Each
+    StackStorm end point (api_url, auth_url and stream_url) is mounted with its own connection
+    pool so the pool sizes can be tuned independently.  TLS verification and client certificates
+    are applied to the session once rather than with each request.
+    """
+
+    def __init__(self, cfg):
+        super().__init__(cfg)
+        self.session = requests.Session()
+
+        # The CA certificate is only used when verification hasn't been disabled.
+        if self.cfg.verify_cert and self.cfg.ca_cert:
+            self.session.verify = self.cfg.ca_cert
+        else:
+            self.session.verify = self.cfg.verify_cert
+        if self.cfg.verify_cert is False:
+            urllib3.disable_warnings()
+
+        if self.cfg.client_cert and self.cfg.client_key:
+            self.session.cert = (self.cfg.client_cert, self.cfg.client_key)
+        elif self.cfg.client_cert:
+            self.session.cert = self.cfg.client_cert
+
+        for prefix, pool_size in self.pool_sizes().items():
+            LOG.debug("Connection pool for {} has {} connections.".format(prefix, pool_size))
+            self.session.mount(prefix, HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+    def send(self, verb, url, **kwargs):
+        """
+        Send an HTTP request using the pooled session.  Takes the same arguments as
+        requests.request.
+        """
+        return self.session.request(verb, url, **kwargs)
+
+    def events(self, url, headers, params=None, last_id=None):
+        """
+        Returns an iterator of server sent events read from url.  When last_id is given, it's
+        sent as the Last-Event-ID header for the server to resume the stream after that event.
+        """
+        return sseclient.SSEClient(
+            url, last_id=last_id, session=self.session, headers=headers, params=params
+        )
+
+    def close(self):
+        self.session.close()
+        self.closed = True
+
+
+class AsyncResponse(object):
+    """
+    The subset of requests.Response used by err-stackstorm, built from an aiohttp response.
+    """
+
+    def __init__(self, url, status_code, reason, headers, text):
+        self.url = url
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.text = text
+
+    def __repr__(self):
+        return "<AsyncResponse [{}]>".format(self.status_code)
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        if 400 <= self.status_code < 600:
+            raise requests.exceptions.HTTPError(
+                "{} Error: {} for url: {}".format(self.status_code, self.reason, self.url),
+                response=self,
+            )
+
+
+class AsyncHttpClient(AbstractHttpClient):
+    """
+    HTTP client running all requests and the event stream as coroutines on a dedicated asyncio
+    event loop thread.  The send method is a thin synchronous wrapper that submits the
+    coroutine to the loop and waits for its result, so it can be used in place of HttpClient.
+    """
+
+    # Number of stream events read ahead of the listener before the stream is paused.
+    event_queue_size = 1000
+
+    def __init__(self, cfg):
+        super().__init__(cfg)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name="st2_event_loop", daemon=True
+        )
+        self.thread.start()
+        self.session = self.submit(self._create_session()).result()
+
+    def _ssl_context(self):
+        """
+        Build the TLS context from the verify_cert, ca_cert, client_cert and client_key options.
+        """
+        if self.cfg.verify_cert is False and not self.cfg.client_cert:
+            return False
+        context = ssl.create_default_context(cafile=self.cfg.ca_cert or None)
+        if self.cfg.verify_cert is False:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        if self.cfg.client_cert:
+            context.load_cert_chain(self.cfg.client_cert, self.cfg.client_key or None)
+        return context
+
+    async def _create_session(self):
+        pools = self.pool_sizes()
+        connector = aiohttp.TCPConnector(
+            limit=sum(pools.values()),
+            limit_per_host=max(pools.values()),
+            ssl=self._ssl_context(),
+        )
+        return aiohttp.ClientSession(connector=connector)
+
+    def submit(self, coroutine):
+        """
+        Schedule a coroutine on the event loop and return a concurrent.futures.Future.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    async def _request(
+        self, verb, url, headers=None, params=None, data=None, json=None, auth=None, timeout=None
+    ):
+        kwargs = {"headers": headers, "data": data, "json": json}
+        if params:
+            kwargs["params"] = {k: str(v) for k, v in params.items()}
+        if auth:
+            kwargs["auth"] = aiohttp.BasicAuth(*auth)
+        if timeout:
+            kwargs["timeout"] = aiohttp.ClientTimeout(total=timeout)
+        try:
+            async with self.session.request(verb, url, **kwargs) as response:
+                return AsyncResponse(
+                    str(response.url),
+                    response.status,
+                    response.reason,
+                    dict(response.headers),
+                    await response.text(),
+                )
+        except asyncio.TimeoutError:
+            raise requests.exceptions.Timeout("Request to {} timed out.".format(url))
+        except aiohttp.ClientError as err:
+            raise requests.exceptions.ConnectionError(str(err))
+
+    def send(self, verb, url, timeout=None, **kwargs):
+        """
+        Send an HTTP request on the event loop and wait for the response.  Takes the same
+        arguments as requests.request for the options used by err-stackstorm.
+        """
+        future = self.submit(self._request(verb, url, timeout=timeout, **kwargs))
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise requests.exceptions.Timeout("Request to {} timed out.".format(url))
+
+    async def _events(self, url, headers, params, last_id, events):
+        """
+        Read server sent events from url and put them on the events queue.
+        """
+        headers = dict(headers)
+        headers.update({"Cache-Control": "no-cache", "Accept": "text/event-stream"})
+        if last_id:
+            headers["Last-Event-ID"] = last_id
+        timeout = aiohttp.ClientTimeout(total=None)
+        async with self.session.get(
+            url, headers=headers, params=params, timeout=timeout
+        ) as response:
+            response.raise_for_status()
+            fields = {}
+            async for raw_line in response.content:
+                line = raw_line.decode("utf-8").rstrip("\r\n")
+                if line == "":
+                    if "data" in fields:
+                        await self._put_event(events, sseclient.Event(**fields))
+                    fields = {}
+                    continue
+                if line.startswith(":"):
+                    continue
+                name, _, value = line.partition(":")
+                if value.startswith(" "):
+                    value = value[1:]
+                if name == "data" and "data" in fields:
+                    fields["data"] = "{}\n{}".format(fields["data"], value)
+                elif name in ["data", "event", "id", "retry"]:
+                    fields[name] = value
+
+    @staticmethod
+    async def _put_event(events, event):
+        """
+        Wait for room on the events queue without blocking the event loop.
+        """
+        while True:
+            try:
+                events.put_nowait(event)
+                return
+            except queue.Full:
+                await asyncio.sleep(0.05)
+
+    def events(self, url, headers, params=None, last_id=None):
+        """
+        Returns an iterator of server sent events read from url by the event loop.  Errors
+        raised by the stream are raised by the iterator.  When last_id is given, it's sent as
+        the Last-Event-ID header for the server to resume the stream after that event.
+        """
+        events = queue.Queue(AsyncHttpClient.event_queue_size)
+        future = self.submit(self._events(url, headers, params, last_id, events))
+        try:
+            while True:
+                try:
+                    event = events.get(timeout=1)
+                except queue.Empty:
+                    # Events are queued before the stream ends, the queue is empty once it has.
+                    if future.done() and events.empty():
+                        break
+                    continue
+                yield event
+            future.result()
+        finally:
+            future.cancel()
+
+    def close(self):
+        """
+        Close the session and stop the event loop thread.
+        """
+        if self.closed:
+            return
+        self.submit(self.session.close()).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.closed = True
@@ -0,0 +1,93 @@
+# coding:utf-8
+import logging
+import threading
+import time
+
+LOG = logging.getLogger("errbot.plugin.st2.rate_limiter")
+
+
+class TokenBucket(object):
+    """
+    Token bucket allowing rate messages per second on average with bursts of up to burst
+    messages.  A message arriving when the bucket is empty reserves the next token so messages
+    are sent in the order they arrived.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Take a token and return the number of seconds to wait before it can be used.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+
+class RateLimiter(object):
+    """
+    Outbound message rate limiter with a bucket for the chat backend and a bucket per channel.
+    A rate of None disables the corresponding limit.
+    """
+
+    def __init__(self, rate=None, burst=1, channel_rate=None, channel_burst=1):
+        self.backend = TokenBucket(rate, burst) if rate else None
+        self.channel_rate = channel_rate
+        self.channel_burst = channel_burst
+        self.channels = {}
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.delayed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _channel(self, channel):
+        with self.lock:
+            if channel not in self.channels:
+                self.channels[channel] = TokenBucket(self.channel_rate, self.channel_burst)
+            return self.channels[channel]
+
+    def wait(self, channel):
+        """
+        Block until a message can be sent to channel.  Returns the number of seconds waited.
+        """
+        wait = 0.0
+        if self.channel_rate:
+            wait = self._channel(str(channel)).reserve()
+        if self.backend is not None:
+            wait = max(wait, self.backend.reserve())
+
+        with self.lock:
+            self.messages += 1
+            if wait > 0:
+                self.delayed += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+        if wait > 0:
+            LOG.debug(
+                "Rate limit reached, message to {} waits {:.2f} seconds.".format(channel, wait)
+            )
+            time.sleep(wait)
+        return wait
+
+    def stats(self):
+        """
+        Returns a dict of the rate limiter's counters.
+        """
+        with self.lock:
+            return {
+                "messages": self.messages,
+                "delayed": self.delayed,
+                "avg_wait": round(self.total_wait / self.delayed, 3) if self.delayed else 0.0,
+                "max_wait": round(self.max_wait, 3),
+            }
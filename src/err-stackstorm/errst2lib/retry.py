@@ -0,0 +1,118 @@
+# coding:utf-8
+import logging
+import threading
+import time
+from collections import deque
+from random import SystemRandom
+
+from errst2lib.errors import DeliveryPermanentError
+
+LOG = logging.getLogger("errbot.plugin.st2.retry")
+
+
+class DeliveryRetry(object):
+    """
+    Retry failed chat deliveries with an exponential backoff and jitter.
+
+    Permanent errors, such as an unknown channel, aren't retried.  Other errors are retried up
+    to max_attempts times.  Announcements that can't be delivered are kept in a bounded
+    dead-letter list for administrators to inspect.  Retries happen on the delivering thread so
+    the order of announcements within a channel is kept.
+    """
+
+    DELIVERED = "delivered"
+    DEAD_LETTERED = "dead_lettered"
+    FAILED = "failed"
+
+    def __init__(self, deliver, max_attempts=5, backoff=1, backoff_max=30, dead_letters=100):
+        self.deliver = deliver
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.dead_letters = deque(maxlen=dead_letters)
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.retried = 0
+        self.dead_lettered = 0
+
+    def __call__(self, announcement, max_attempts=None, dead_letter=True):
+        """
+        Deliver the announcement.  Returns DELIVERED or DEAD_LETTERED, or None if delivery was
+        abandoned because retries were stopped.  max_attempts overrides the configured attempts.
+        When dead_letter is False, failed announcements are returned as FAILED for the caller to
+        resend instead of being dead-lettered.
+        """
+        if max_attempts is None:
+            max_attempts = self.max_attempts
+        attempt = 1
+        while True:
+            try:
+                self.deliver(announcement)
+                return DeliveryRetry.DELIVERED
+            except DeliveryPermanentError as err:
+                return self._failed(announcement, attempt, err, dead_letter)
+            except Exception as err:
+                if attempt >= max_attempts:
+                    return self._failed(announcement, attempt, err, dead_letter)
+                backoff = min(self.backoff * 2 ** (attempt - 1), self.backoff_max)
+                backoff = SystemRandom().uniform(backoff / 2, backoff)
+                LOG.warning(
+                    "Delivery attempt {} of {} failed, retrying in {:.1f} seconds.  {}".format(
+                        attempt, max_attempts, backoff, err
+                    )
+                )
+                with self.lock:
+                    self.retried += 1
+                if self.stopped.wait(backoff):
+                    return None
+                attempt += 1
+
+    def _failed(self, announcement, attempts, err, dead_letter):
+        if not dead_letter:
+            LOG.warning(
+                "Failed to deliver {} after {} attempts.  {}".format(announcement, attempts, err)
+            )
+            return DeliveryRetry.FAILED
+        self._dead_letter(announcement, attempts, err)
+        return DeliveryRetry.DEAD_LETTERED
+
+    def _dead_letter(self, announcement, attempts, err):
+        LOG.error("Failed to deliver {} after {} attempts.  {}".format(announcement, attempts, err))
+        with self.lock:
+            self.dead_lettered += 1
+            self.dead_letters.append(
+                {
+                    "failed_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+                    "announcement": announcement,
+                    "attempts": attempts,
+                    "error": "{}: {}".format(type(err).__name__, err),
+                }
+            )
+
+    def list_dead_letters(self):
+        with self.lock:
+            return list(self.dead_letters)
+
+    def clear_dead_letters(self):
+        with self.lock:
+            self.dead_letters.clear()
+
+    def stats(self):
+        """
+        Returns a dict of the retry counters.
+        """
+        with self.lock:
+            return {
+                "retried": self.retried,
+                "dead_lettered": self.dead_lettered,
+                "dead_letters": len(self.dead_letters),
+            }
+
+    def start(self):
+        self.stopped.clear()
+
+    def stop(self):
+        """
+        Abandon any retry waiting for its backoff to pass.
+        """
+        self.stopped.set()
@@ -1,9 +1,12 @@
 # coding:utf-8
 import hashlib
+import hmac
 import logging
 import string
+import time
 import uuid
 from datetime import datetime as dt
+from functools import lru_cache
 from random import SystemRandom
 
 from errst2lib.errors import SessionConsumedError, SessionExpiredError
@@ -18,36 +21,103 @@ def generate_password(length=8):
     return "".join([rnd.choice(string.hexdigits) for _ in range(length)])
 
 
+@lru_cache(maxsize=4096)
+def render_timestamp(timestamp):
+    """
+    Returns the timestamp formatted as a local date and time.  Sessions created or modified in
+    the same second share the rendered text.
+    """
+    return str(dt.fromtimestamp(timestamp))
+
+
 class Session(object):
+    """
+    Sessions are slotted to keep hundreds of thousands of them cheap to hold.  Expiry is checked
+    against the monotonic clock so it isn't affected by changes to the system clock.  The wall
+    clock create and modified dates are only kept to be displayed and saved.
+    """
+
+    __slots__ = (
+        "bot_secret",
+        "user_id",
+        "_is_sealed",
+        "session_id",
+        "create_date",
+        "modified_date",
+        "ttl_in_seconds",
+        "_expires_at",
+        "_hashed_secret",
+    )
+
     def __init__(self, user_id, user_secret, session_ttl=3600):
         self.bot_secret = None
         self.user_id = user_id
         self._is_sealed = True
-        self.session_id = uuid.uuid4()
-        self.create_date = int(dt.now().timestamp())
+        self.session_id = str(uuid.uuid4())
+        self.create_date = int(time.time())
         self.modified_date = self.create_date
         self.ttl_in_seconds = session_ttl
+        self._expires_at = time.monotonic() + session_ttl
         self._hashed_secret = self.hash_secret(user_secret)
         del user_secret
 
     def is_expired(self):
         """
-        Returns False if both create and modified timestamps have exceeded the ttl.
+        Returns False if the ttl hasn't elapsed since the session was created or modified,
+        otherwise raises SessionExpiredError.
         """
-        now = int(dt.now().timestamp())
-        modified_expiry = self.modified_date + self.ttl_in_seconds
-        if modified_expiry < now:
+        if self._expires_at < time.monotonic():
             raise SessionExpiredError
         return False
 
+    def expiry(self):
+        """
+        Returns the time.monotonic() time after which the session is expired.
+        """
+        return self._expires_at
+
+    def to_dict(self):
+        """
+        Returns the session as a dict of JSON serialisable values.
+        """
+        return {
+            "user_id": self.user_id,
+            "session_id": str(self.session_id),
+            "sealed": self._is_sealed,
+            "bot_secret": self.bot_secret,
+            "hashed_secret": self._hashed_secret.hex(),
+            "create_date": self.create_date,
+            "modified_date": self.modified_date,
+            "ttl": self.ttl_in_seconds,
+        }
+
+    @staticmethod
+    def from_dict(attributes):
+        """
+        Returns a session restored from a dict produced by to_dict.
+        """
+        session = Session.__new__(Session)
+        session.user_id = attributes["user_id"]
+        session.session_id = str(uuid.UUID(attributes["session_id"]))
+        session._is_sealed = attributes["sealed"]
+        session.bot_secret = attributes["bot_secret"]
+        session._hashed_secret = bytes.fromhex(attributes["hashed_secret"])
+        session.create_date = attributes["create_date"]
+        session.modified_date = attributes["modified_date"]
+        session.ttl_in_seconds = attributes["ttl"]
+        # The monotonic clock doesn't survive a restart, carry over the time left on the session.
+        remaining = session.modified_date + session.ttl_in_seconds - time.time()
+        session._expires_at = time.monotonic() + remaining
+        return session
+
     def attributes(self):
         return {
             "UserID": self.user_id,
             "IsSealed": self._is_sealed,
             "SessionID": self.session_id,
-            "CreationDate": str(dt.fromtimestamp(self.create_date)),
-            "ModifiedDate": str(dt.fromtimestamp(self.modified_date)),
-            "ExpiryDate": str(dt.fromtimestamp(self.modified_date + self.ttl_in_seconds)),
+            "CreationDate": render_timestamp(self.create_date),
+            "ModifiedDate": render_timestamp(self.modified_date),
+            "ExpiryDate": render_timestamp(self.modified_date + self.ttl_in_seconds),
         }
 
     def __repr__(self):
@@ -55,11 +125,11 @@ class Session(object):
             [
                 "UserID: {},".format(str(self.user_id)),
                 "Is Sealed: {},".format(str(self._is_sealed)),
-                "SessionID: {},".format(str(self.session_id)),
-                "Creation Date: {},".format(str(dt.fromtimestamp(self.create_date))),
-                "Modified Date: {},".format(str(dt.fromtimestamp(self.modified_date))),
+                "SessionID: {},".format(self.session_id),
+                "Creation Date: {},".format(render_timestamp(self.create_date)),
+                "Modified Date: {},".format(render_timestamp(self.modified_date)),
                 "Expiry Date: {}".format(
-                    str(dt.fromtimestamp(self.modified_date + self.ttl_in_seconds))
+                    render_timestamp(self.modified_date + self.ttl_in_seconds)
                 ),
             ]
         )
@@ -89,7 +159,7 @@ class Session(object):
         """
         Return the UUID for the session.
         """
-        return str(self.session_id)
+        return self.session_id
 
     def ttl(self, ttl=None):
         """
@@ -105,7 +175,8 @@ class Session(object):
 
         if isinstance(ttl, int):
             self.ttl_in_seconds = ttl
-            self.modified_date = int(dt.now().timestamp())
+            self.modified_date = int(time.time())
+            self._expires_at = time.monotonic() + ttl
         else:
             LOG.warning("session ttl must be an integer type, got '{}'".format(ttl))
 
@@ -121,7 +192,7 @@ class Session(object):
         h.update(bytes(user_secret, "utf-8"))
         del user_secret
         h.update(bytes(self.bot_secret, "utf-8"))
-        return h.hexdigest()
+        return h.digest()
 
     def match_secret(self, user_secret):
         """
@@ -130,4 +201,4 @@ class Session(object):
         Return True if the user_secret hash has matches the session hash or False if it does not.
         """
         self.is_expired()
-        return self._hashed_secret == self.hash_secret(user_secret)
+        return hmac.compare_digest(self._hashed_secret, self.hash_secret(user_secret))
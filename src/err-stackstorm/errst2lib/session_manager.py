@@ -11,9 +11,10 @@ LOG = logging.getLogger("errbot.plugin.st2.session_mgr")
 class SessionManager(object):
     def __init__(self, cfg):
         self.cfg = cfg
-        self.store = SessionStore()
         self.secure_store = StoreAdapterFactory.instantiate(cfg.secrets_store)()
-        self.secure_store.setup()
+        self.secure_store.setup(**cfg.secrets_store_options)
+        # Sessions are kept with the secrets they refer to when the secrets store is persistent.
+        self.store = SessionStore(self.secure_store if self.secure_store.persistent else None)
 
     def get_by_userid(self, user_id):
         """
@@ -45,18 +46,28 @@ class SessionManager(object):
         if self.exists(user_id):
             raise SessionExistsError
         session = Session(user_id, user_secret, session_ttl)
-        # Store the session.
-        self.store.put(session)
+        # Store the session unless another thread stored one for the user in the meantime.
+        if not self.store.put_if_absent(session):
+            raise SessionExistsError
         return session
 
-    def delete(self, user_id):
+    def consume(self, session_id):
         """
-        Remove a session from the manager
+        Mark a session as consumed.  Raises SessionConsumedError if it was already consumed.
         """
-        session = self.get_by_userid(user_id)
-        if session:
-            self.secure_store.delete(session.id())
-        self.store.delete(user_id)
+        if self.store.consume(session_id) is False:
+            raise SessionInvalidError
+        return True
+
+    def delete(self, user_id, session_id=None):
+        """
+        Remove a session from the manager.  When session_id is given, the user's session is only
+        removed if it has that id.
+        """
+        session = self.store.delete(user_id, session_id)
+        if session is False:
+            raise SessionInvalidError
+        self.secure_store.delete(session.id())
 
     def list_sessions(self):
         """
@@ -64,8 +75,35 @@ class SessionManager(object):
         """
         return self.store.list()
 
+    def expire(self, now=None, keep=()):
+        """
+        Evict expired sessions along with their secrets, except the sessions of the user ids in
+        keep.  Returns the number of sessions evicted.
+        """
+        expired = self.store.expire(now, keep)
+        for session in expired:
+            self.secure_store.delete(session.id())
+        if expired:
+            LOG.info("Evicted {} expired sessions.".format(len(expired)))
+        return len(expired)
+
+    def stats(self):
+        """
+        Returns a dict of the session store's counters.
+        """
+        return self.store.stats()
+
     def update(self, session):
-        raise NotImplementedError
+        """
+        Save changes made to a session.
+        """
+        self.store.update(session)
+
+    def teardown(self):
+        """
+        Wait for the secrets store to save pending changes.
+        """
+        self.secure_store.teardown()
 
     def exists(self, user_id):
         return self.store.get_by_userid(user_id) is not False
@@ -0,0 +1,49 @@
+# coding:utf-8
+import logging
+import threading
+
+LOG = logging.getLogger("errbot.plugin.st2.single_flight")
+
+
+class Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Coalesce concurrent calls for the same key into a single in-flight call.  The first caller
+    runs the function while callers arriving before it completes wait and share its result or
+    exception.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = Call()
+                self.calls[key] = call
+
+        if leader:
+            try:
+                call.result = fn(*args, **kwargs)
+            except Exception as err:
+                call.error = err
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.done.set()
+        else:
+            LOG.debug("Waiting on in-flight call for '{}'.".format(key))
+            call.done.wait()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
@@ -0,0 +1,163 @@
+# coding:utf-8
+import logging
+import threading
+import time
+
+from errst2lib.errors import DirectoryStoppedError
+
+LOG = logging.getLogger("errbot.plugin.st2.slack_directory")
+
+
+class SlackDirectory(object):
+    """
+    In memory directory of a Slack workspace's users and channels.
+
+    The directory is bulk loaded with the paginated users.list and conversations.list methods
+    and reloaded in the background every refresh seconds.  The previous directory keeps
+    serving lookups while a reload is in progress.  User and channel names are translated to
+    Slack ids so the Slack backend can build identifiers without looking them up one at a time.
+    """
+
+    def __init__(self, web_client, refresh=3600, page_size=200):
+        # Called to get the Slack WebClient, which is only available once the backend connected.
+        self.web_client = web_client
+        self.refresh = refresh
+        self.page_size = page_size
+        self.user_ids = {}
+        self.user_names = {}
+        self.channel_ids = {}
+        self.loaded_at = None
+        self.loads = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def _paginate(self, method, key, **kwargs):
+        cursor = None
+        while True:
+            try:
+                response = method(cursor=cursor, limit=self.page_size, **kwargs)
+            except Exception as err:
+                # Wait out Slack's rate limit before fetching the page again.
+                response = getattr(err, "response", None)
+                if getattr(response, "status_code", None) != 429:
+                    raise
+                retry_after = int(response.headers.get("Retry-After", 30))
+                LOG.debug("Slack directory rate limited for {} seconds.".format(retry_after))
+                if self.stopped.wait(retry_after):
+                    # Abort the load rather than replace the directory with partial lists.
+                    raise DirectoryStoppedError
+                continue
+            for item in response[key]:
+                yield item
+            cursor = response.get("response_metadata", {}).get("next_cursor")
+            if not cursor:
+                break
+
+    def load(self):
+        """
+        Load the workspace's users and channels and replace the directory with them.
+        """
+        start = time.monotonic()
+        client = self.web_client()
+        user_ids = {}
+        user_names = {}
+        for member in self._paginate(client.users_list, "members"):
+            if member.get("deleted"):
+                continue
+            user_ids[member["name"]] = member["id"]
+            user_names[member["id"]] = member["name"]
+
+        channel_ids = {}
+        for channel in self._paginate(
+            client.conversations_list,
+            "channels",
+            types="public_channel,private_channel",
+            exclude_archived=True,
+        ):
+            channel_ids[channel["name"]] = channel["id"]
+
+        with self.lock:
+            self.user_ids = user_ids
+            self.user_names = user_names
+            self.channel_ids = channel_ids
+            self.loaded_at = time.monotonic()
+            self.loads += 1
+        LOG.info(
+            "Slack directory loaded {} users and {} channels in {:.1f} seconds.".format(
+                len(user_ids), len(channel_ids), time.monotonic() - start
+            )
+        )
+
+    def _refresher(self):
+        while not self.stopped.is_set():
+            try:
+                self.load()
+            except DirectoryStoppedError:
+                LOG.debug("Slack directory stopped while loading.")
+                break
+            except Exception as err:
+                LOG.error("Failed to load the Slack directory.  {}".format(err))
+            self.stopped.wait(self.refresh)
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(
+            target=self._refresher, name="st2_slack_directory", daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def translate(self, text):
+        """
+        Returns text with a @user or #channel name replaced by its Slack id.  Text that isn't a
+        name in the directory is returned unchanged.
+        """
+        if len(text) < 2 or text[0] not in "@#" or "/" in text:
+            return text
+        name = text[1:]
+        with self.lock:
+            if text[0] == "@":
+                if name in self.user_names:
+                    slack_id = name
+                else:
+                    slack_id = self.user_ids.get(name)
+                prefix = "<@"
+            else:
+                slack_id = self.channel_ids.get(name)
+                prefix = "<#"
+            if slack_id is None:
+                self.misses += 1
+                return text
+            self.hits += 1
+        return "{}{}>".format(prefix, slack_id)
+
+    def username(self, user_id):
+        """
+        Returns the user name for a Slack user id or None if it isn't in the directory.
+        """
+        with self.lock:
+            return self.user_names.get(user_id)
+
+    def stats(self):
+        """
+        Returns a dict of the directory's counters.
+        """
+        with self.lock:
+            return {
+                "users": len(self.user_names),
+                "channels": len(self.channel_ids),
+                "loads": self.loads,
+                "age": (
+                    round(time.monotonic() - self.loaded_at) if self.loaded_at is not None else None
+                ),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,107 @@
+# coding:utf-8
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from errst2lib.delivery import Announcement
+
+LOG = logging.getLogger("errbot.plugin.st2.spool")
+
+
+class Spool(object):
+    """
+    Durable record of announcements waiting to be delivered to chat.
+
+    Announcements are written to an SQLite database before delivery and removed once they
+    have been posted, so anything left in the spool after a restart can be replayed.  The
+    database uses write-ahead logging with synchronous=NORMAL: each write is appended to the
+    log without an fsync and the log is synced in batches when it's checkpointed into the
+    database.  A power loss may lose the most recent writes, a crash of the bot won't.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS announcements ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, created REAL NOT NULL, payload TEXT NOT NULL)"
+        )
+        self.appended = 0
+        self.completed = 0
+        LOG.info("Announcement spool {} opened.".format(path))
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM announcements").fetchone()[0]
+
+    def append(self, announcement):
+        """
+        Record the announcement and add the record's id to the announcement's spool ids.
+        """
+        payload = json.dumps(announcement.to_dict())
+        try:
+            with self.lock:
+                cursor = self.conn.execute(
+                    "INSERT INTO announcements (created, payload) VALUES (?, ?)",
+                    (time.time(), payload),
+                )
+                self.appended += 1
+        except sqlite3.Error as err:
+            LOG.error("Failed to spool {}, delivering without it.  {}".format(announcement, err))
+            return
+        announcement.spool_ids.append(cursor.lastrowid)
+
+    def done(self, announcement):
+        """
+        Remove the records of a delivered announcement.
+        """
+        if not announcement.spool_ids:
+            return
+        try:
+            with self.lock:
+                self.conn.executemany(
+                    "DELETE FROM announcements WHERE id = ?",
+                    [(i,) for i in announcement.spool_ids],
+                )
+                self.completed += len(announcement.spool_ids)
+        except sqlite3.Error as err:
+            LOG.error("Failed to remove {} from the spool.  {}".format(announcement, err))
+
+    def pending(self):
+        """
+        Returns the announcements still waiting to be delivered, oldest first.
+        """
+        with self.lock:
+            rows = self.conn.execute("SELECT id, payload FROM announcements ORDER BY id").fetchall()
+        announcements = []
+        for spool_id, payload in rows:
+            try:
+                announcement = Announcement.from_dict(json.loads(payload))
+            except ValueError as err:
+                LOG.error("Discarding unreadable spool record {}.  {}".format(spool_id, err))
+                with self.lock:
+                    self.conn.execute("DELETE FROM announcements WHERE id = ?", (spool_id,))
+                continue
+            announcement.spool_ids.append(spool_id)
+            announcements.append(announcement)
+        return announcements
+
+    def stats(self):
+        """
+        Returns a dict of the spool's counters.
+        """
+        return {
+            "path": self.path,
+            "pending": len(self),
+            "appended": self.appended,
+            "completed": self.completed,
+        }
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
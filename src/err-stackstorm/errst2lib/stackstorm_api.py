@@ -1,16 +1,27 @@
 # coding:utf-8
 import json
 import logging
+import threading
 import time
 import traceback
+from random import SystemRandom
 
 import requests
-import sseclient
-import urllib3
 from requests.exceptions import HTTPError
 
+from errst2lib.action_alias import ActionAliasIndex
+from errst2lib.cache import RecentSet
+from errst2lib.errors import CircuitOpenError, SessionInvalidError
+from errst2lib.single_flight import SingleFlight
+
 LOG = logging.getLogger("errbot.plugin.st2.st2_api")
 
+ACTION_ALIAS_EVENTS = [
+    "st2.action_alias__create",
+    "st2.action_alias__update",
+    "st2.action_alias__delete",
+]
+
 
 class Result(object):
     def __init__(self, return_code=None, message=None):
@@ -28,20 +39,227 @@ class Result(object):
 
 class StackStormAPI(object):
     stream_backoff = 10
+    stream_backoff_max = 300
     authenticate_backoff = 10
-    http_timeout = 10
+    # Refresh requests arriving this many seconds after a refresh completed reuse its token.
+    refresh_min_interval = 5
+    # Number of recent stream event ids remembered to drop events replayed after a reconnect.
+    stream_recent_ids = 1000
 
     def __init__(self, cfg, accessctl):
         self.cfg = cfg
         self.accessctl = accessctl
 
-        if self.cfg.verify_cert is False:
-            urllib3.disable_warnings()
+        self.refresh_flight = SingleFlight()
+        self.refreshed_at = None
+        self.refresh_requests = 0
+        self.refreshes = 0
+        # The bot's token is renewed by a timer before it expires.  The timer is started and
+        # cancelled holding the renewal lock.
+        self.renewal_lock = threading.Lock()
+        self.renewal_timer = None
+        self.renewal_active = True
+        self.bot_token_expiry = None
+        self.bot_renewal_at = None
+        self.renewals = 0
+        self.renewal_failures = 0
+
+        # Stream events other than announcements are passed to handlers registered by event name.
+        self.stream_handlers = {}
+        self.stream_received = 0
+        self.stream_dispatched = 0
+        self.stream_last_id = None
+        self.stream_recent_ids = RecentSet(StackStormAPI.stream_recent_ids)
+        self.stream_duplicates = 0
+        self.stream_reconnects = 0
+        self.stream_failures = 0
+        self.stream_disconnected_at = None
+        self.stream_last_gap = None
+        self.stream_max_gap = 0.0
+
+        self.action_aliases = None
+        if self.cfg.alias_index:
+            self.action_aliases = ActionAliasIndex(self, self.cfg.alias_index_ttl)
+            self.add_stream_handler(ACTION_ALIAS_EVENTS, self.action_aliases.invalidate)
+
+    @property
+    def http(self):
+        # The configuration's client is replaced when the plugin is activated again.
+        return self.cfg.http
+
+    def add_stream_handler(self, events, handler):
+        """
+        Register a handler to be called with (event, data) for each of the named stream events.
+        The stream listener only subscribes to announcements and events with a handler.
+        """
+        for event in events:
+            self.stream_handlers.setdefault(event, []).append(handler)
+
+    def stream_events(self):
+        """
+        Returns the list of stream events the listener subscribes to.
+        """
+        return ["st2.announcement__{}".format(self.cfg.route_key)] + sorted(self.stream_handlers)
+
+    def stream_stats(self):
+        return {
+            "received": self.stream_received,
+            "dispatched": self.stream_dispatched,
+            "duplicates": self.stream_duplicates,
+            "reconnects": self.stream_reconnects,
+            "last_event_id": self.stream_last_id,
+            "last_gap": round(self.stream_last_gap, 3) if self.stream_last_gap else None,
+            "max_gap": round(self.stream_max_gap, 3),
+        }
+
+    def _stream_disconnected(self):
+        """
+        Record the time the stream disconnected, unless it hasn't resumed since the last time.
+        """
+        if self.stream_disconnected_at is None:
+            self.stream_disconnected_at = time.monotonic()
+            self.stream_reconnects += 1
+
+    def _stream_resumed(self):
+        """
+        Record the time between the stream disconnecting and the first event after reconnecting.
+        Events emitted by StackStorm during the gap are lost unless the stream was resumed from
+        the last event id.
+        """
+        gap = time.monotonic() - self.stream_disconnected_at
+        self.stream_disconnected_at = None
+        self.stream_last_gap = gap
+        self.stream_max_gap = max(self.stream_max_gap, gap)
+        LOG.warning(
+            "Stream resumed after {:.1f} seconds from event id {}.".format(gap, self.stream_last_id)
+        )
+
+    def _stream_seen(self, event):
+        """
+        Track the id of a received stream event.  Returns True if the event was already received.
+        """
+        if not event.id:
+            return False
+        if self.stream_recent_ids.add(event.id) is False:
+            self.stream_duplicates += 1
+            LOG.debug("Duplicate stream event {} dropped.".format(event.id))
+            return True
+        self.stream_last_id = event.id
+        return False
 
     def refresh_bot_credentials(self):
+        """
+        Re-authenticate the bot's credentials.  Concurrent refresh requests from the poller, the
+        stream listener and commands share a single authentication with StackStorm.
+        """
+        self.refresh_requests += 1
+        self.refresh_flight.do("bot", self._refresh_bot_credentials)
+
+    def _refresh_bot_credentials(self):
+        if (
+            self.refreshed_at is not None
+            and time.monotonic() - self.refreshed_at < StackStormAPI.refresh_min_interval
+        ):
+            LOG.debug("Bot credentials were refreshed less than a moment ago.")
+            return
         LOG.warning("Bot credentials re-authentication required.")
-        session_id = self.accessctl.get_session(self.accessctl.bot.internal_identity)
-        self.accessctl.bot.reauthenticate_bot_credentials(session_id)
+        self.refreshes += 1
+        try:
+            bot_session = self.accessctl.get_session(self.accessctl.bot.internal_identity)
+            authenticated = self.accessctl.bot.reauthenticate_bot_credentials(bot_session)
+        except SessionInvalidError:
+            authenticated = self.accessctl.bot.authenticate_bot_credentials()
+        # Failed refreshes don't hold back the next attempt.
+        if authenticated:
+            self.refreshed_at = time.monotonic()
+
+    def schedule_bot_renewal(self, token):
+        """
+        Schedule the bot's token to be renewed once the bot_token_renewal fraction of its lifetime
+        has passed.  Tokens without an expiry, such as API keys, are left to the credentials
+        poller.
+        """
+        with self.renewal_lock:
+            self._cancel_bot_renewal()
+            self.bot_token_expiry = getattr(token, "expiry", None)
+            self.bot_renewal_at = None
+            if self.bot_token_expiry is None or not self.cfg.bot_token_renewal:
+                return
+            lifetime = self.bot_token_expiry - time.time()
+            delay = max(lifetime * self.cfg.bot_token_renewal, StackStormAPI.refresh_min_interval)
+            self._start_bot_renewal(delay)
+
+    def _start_bot_renewal(self, delay):
+        # Called holding the renewal lock.  The timer isn't started while renewal is cancelled.
+        self.bot_renewal_at = time.time() + delay
+        if not self.renewal_active:
+            return
+        self.renewal_timer = threading.Timer(delay, self._renew_bot_credentials)
+        self.renewal_timer.name = "st2_bot_renewal"
+        self.renewal_timer.daemon = True
+        self.renewal_timer.start()
+        LOG.info("Bot token will be renewed in {:.0f} seconds.".format(delay))
+
+    def _cancel_bot_renewal(self):
+        # Called holding the renewal lock.
+        if self.renewal_timer is not None:
+            self.renewal_timer.cancel()
+            self.renewal_timer = None
+
+    def resume_bot_renewal(self):
+        """
+        Restart a renewal cancelled by cancel_bot_renewal.
+        """
+        with self.renewal_lock:
+            self.renewal_active = True
+            if self.bot_renewal_at is not None and self.renewal_timer is None:
+                self._start_bot_renewal(max(self.bot_renewal_at - time.time(), 0))
+
+    def cancel_bot_renewal(self):
+        """
+        Stop renewing the bot's token until resume_bot_renewal is called.
+        """
+        with self.renewal_lock:
+            self.renewal_active = False
+            self._cancel_bot_renewal()
+
+    def _renew_bot_credentials(self):
+        """
+        Authenticate the bot while its current token is still valid.  The new token replaces the
+        current one once it's been issued so requests in progress aren't left without a token.
+        """
+        with self.renewal_lock:
+            timer = self.renewal_timer
+        self.renewals += 1
+        LOG.info("Renewing the bot token before it expires.")
+        try:
+            self.refresh_bot_credentials()
+        except Exception as err:
+            LOG.error("Bot token renewal failed.  {}".format(err))
+        with self.renewal_lock:
+            # A successful renewal schedules the next one and a cancelled renewal stops.
+            if self.renewal_timer is not timer:
+                return
+            # Try again while the token is valid.
+            self.renewal_failures += 1
+            remaining = self.bot_token_expiry - time.time()
+            if remaining > 0:
+                self._start_bot_renewal(min(StackStormAPI.authenticate_backoff, remaining / 2))
+            else:
+                self.renewal_timer = None
+                LOG.error("Bot token expired before it could be renewed.")
+
+    def refresh_stats(self):
+        expires_in = None
+        if self.bot_token_expiry is not None:
+            expires_in = round(self.bot_token_expiry - time.time())
+        return {
+            "refresh_requests": self.refresh_requests,
+            "refreshes": self.refreshes,
+            "renewals": self.renewals,
+            "renewal_failures": self.renewal_failures,
+            "token_expires_in": expires_in,
+        }
 
     def action_get(self, action_id):
         raise NotImplementedError
@@ -56,12 +274,11 @@ class StackStormAPI(object):
         url = f"{self.cfg.api_url}/inquiries/"
         params = {}
         headers = st2_creds.requests()
-        return requests.get(
+        return self.http.get(
             url,
             headers=headers,
             params=params,
-            timeout=StackStormAPI.http_timeout,
-            verify=self.cfg.verify_cert,
+            endpoint="inquiries",
         )
 
     def enquiry_get(self, enquiry_id, st2_creds=None):
@@ -107,12 +324,11 @@ class StackStormAPI(object):
         url = f"{self.cfg.api_url}/inquiries/{enquiry_id}"
         params = {}
         headers = st2_creds.requests()
-        response = requests.get(
+        response = self.http.get(
             url,
             headers=headers,
             params=params,
-            timeout=StackStormAPI.http_timeout,
-            verify=self.cfg.verify_cert,
+            endpoint="inquiries",
         )
 
         if response.status_code == requests.codes.ok:
@@ -145,12 +361,11 @@ class StackStormAPI(object):
             params["offset"] = offset
 
         headers = st2_creds.requests()
-        response = requests.get(
+        response = self.http.get(
             url,
             headers=headers,
             params=params,
-            timeout=StackStormAPI.http_timeout,
-            verify=self.cfg.verify_cert,
+            endpoint="help",
         )
         if response.status_code == requests.codes.ok:
             return response.json().get("helpstrings", [])
@@ -159,7 +374,44 @@ class StackStormAPI(object):
         else:
             response.raise_for_status()
 
+    def actionalias_list(self, st2_creds=None):
+        """
+        Fetch all action-aliases from StackStorm, page by page.  The bot's credentials are used
+        when none are supplied.  Returns a list of action-aliases or None on error.
+        """
+        if st2_creds is None:
+            st2_creds = self.accessctl.get_token_by_userid(self.accessctl.bot.internal_identity)
+
+        url = "/".join([self.cfg.api_url, "actionalias"])
+        headers = st2_creds.requests()
+        limit = 100
+        aliases = []
+        while True:
+            response = self.http.get(
+                url,
+                headers=headers,
+                params={"limit": limit, "offset": len(aliases)},
+                endpoint="match",
+            )
+            if response.status_code != requests.codes.ok:
+                LOG.warning(
+                    "Failed to list action-aliases {} {}".format(
+                        response.status_code, response.reason
+                    )
+                )
+                return None
+            page = response.json()
+            aliases.extend(page)
+            if len(page) < limit:
+                return aliases
+
     def match(self, text, st2token):
+        if self.action_aliases is not None:
+            matches = self.action_aliases.match(text)
+            # Commands the index can't match are left to StackStorm's API to decide.
+            if matches:
+                return self._local_match_result(text, matches)
+
         headers = st2token.requests()
         url = "/".join([self.cfg.api_url, "actionalias/match"])
 
@@ -168,12 +420,11 @@ class StackStormAPI(object):
 
         result = Result()
         try:
-            response = requests.post(
+            response = self.http.post(
                 url,
                 headers=headers,
                 data=payload,
-                timeout=StackStormAPI.http_timeout,
-                verify=self.cfg.verify_cert,
+                endpoint="match",
             )
             if response.status_code == 200:
                 result.OK(response.json())
@@ -187,6 +438,9 @@ class StackStormAPI(object):
                 LOG.error(result.message)
             else:
                 response.raise_for_status()
+        except CircuitOpenError as e:
+            result.error(4, str(e))
+            LOG.error(result.message)
         except HTTPError as e:
             result.error(2, "HTTPError {}".format(str(e)))
             LOG.error(result.message)
@@ -195,6 +449,23 @@ class StackStormAPI(object):
             LOG.error(result.message)
         return result
 
+    def _local_match_result(self, text, matches):
+        """
+        Build the match result from the action-alias index in the same form as the API match.
+        """
+        result = Result()
+        if len(matches) == 1:
+            result.OK(matches[0])
+        else:
+            result.error(
+                1,
+                "st2 command '{}' matched more than one action-alias: {}.".format(
+                    text, ", ".join([m["actionalias"].get("ref", "") for m in matches])
+                ),
+            )
+            LOG.error(result.message)
+        return result
+
     def execute_actionalias(self, msg, chat_user, st2token):
         """
         @msg: errbot message.
@@ -217,12 +488,11 @@ class StackStormAPI(object):
 
         msg = ""
         try:
-            response = requests.post(
+            response = self.http.post(
                 url,
                 headers=headers,
                 json=payload,
-                timeout=StackStormAPI.http_timeout,
-                verify=self.cfg.verify_cert,
+                endpoint="execute",
             )
 
             if response.status_code in [201, 400]:
@@ -252,13 +522,27 @@ class StackStormAPI(object):
                     )
                     raise ValueError("Bot token is not valid for Stream API.")
 
-            stream_kwargs = {"headers": token.requests(), "verify": self.cfg.verify_cert}
-
             stream_url = "".join([self.cfg.stream_url, "/stream"])
 
-            stream = sseclient.SSEClient(stream_url, **stream_kwargs)
+            # Ask StackStorm to only send the events err-stackstorm handles.
+            params = {"events": ",".join(self.stream_events())}
+
+            # Resume from the last event received before a reconnect.
+            stream = self.http.events(
+                stream_url,
+                headers=token.requests(),
+                params=params,
+                last_id=self.stream_last_id,
+            )
             for event in stream:
+                self.stream_failures = 0
+                self.stream_received += 1
+                if self.stream_disconnected_at is not None:
+                    self._stream_resumed()
+                if self._stream_seen(event):
+                    continue
                 if event.event == "st2.announcement__{}".format(self.cfg.route_key):
+                    self.stream_dispatched += 1
                     LOG.debug(
                         "*** Errbot announcement event detected! ***\n{}\n{}\n".format(
                             event.dump(), stream
@@ -276,20 +560,49 @@ class StackStormAPI(object):
                             p.get("channel"),
                             p.get("extra"),
                         )
+                elif event.event in self.stream_handlers:
+                    LOG.debug("Stream event {} dispatched.".format(event.event))
+                    self.stream_dispatched += 1
+                    for handler in self.stream_handlers[event.event]:
+                        try:
+                            handler(event.event, event.data)
+                        except Exception as err:
+                            LOG.error(
+                                "Stream event {} handler failed.  {}".format(event.event, err)
+                            )
                 # Test for shutdown after event to avoid losing messages.
                 if self.accessctl.bot.run_listener is False:
                     break
 
-        StackStormAPI.stream_backoff = 10
         while self.accessctl.bot.run_listener:
             try:
                 self.refresh_bot_credentials()
                 listener(callback, bot_identity)
             except Exception as err:
+                self._stream_disconnected()
+                # Back off exponentially with jitter while the stream keeps failing.
+                self.stream_failures += 1
+                backoff = min(
+                    StackStormAPI.stream_backoff * 2 ** (self.stream_failures - 1),
+                    StackStormAPI.stream_backoff_max,
+                )
+                backoff = SystemRandom().uniform(backoff / 2, backoff)
                 LOG.critical(
                     "St2 stream listener - An error occurred: {} {}.  "
-                    "Backing off {} seconds.".format(type(err), err, StackStormAPI.stream_backoff)
+                    "Backing off {:.1f} seconds.".format(type(err), err, backoff)
                 )
                 traceback.print_exc()
-                time.sleep(StackStormAPI.stream_backoff)
+                self._stream_backoff(backoff)
+            else:
+                # StackStorm closed the stream, reconnect and resume from the last event id.
+                if self.accessctl.bot.run_listener:
+                    self._stream_disconnected()
         LOG.info("*** Exit stream listener ***")
+
+    def _stream_backoff(self, seconds):
+        """
+        Sleep for the number of seconds or until the stream listener is stopped.
+        """
+        deadline = time.monotonic() + seconds
+        while self.accessctl.bot.run_listener and time.monotonic() < deadline:
+            time.sleep(min(1, seconds))
@@ -1,6 +1,16 @@
 # coding:utf-8
 import abc
+import heapq
+import json
 import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from errst2lib.credentials_adapters import St2ApiKey, St2UserToken
+from errst2lib.session import Session
 
 LOG = logging.getLogger(__name__)
 
@@ -15,7 +25,22 @@ class StoreAdapterFactory(AbstractStoreAdapterFactory):
     @staticmethod
     def instantiate(store_type):
         LOG.debug("Create secret store for '{}'".format(store_type))
-        return {"cleartext": ClearTextStoreAdapter}.get(store_type, ClearTextStoreAdapter)
+        return {"cleartext": ClearTextStoreAdapter, "sqlite": SQLiteStoreAdapter}.get(
+            store_type, ClearTextStoreAdapter
+        )
+
+
+class StripedLock(object):
+    """
+    A fixed number of locks shared by keys hashing to the same stripe.  Operations on the same
+    key are serialised while operations on different keys rarely wait for each other.
+    """
+
+    def __init__(self, stripes=64):
+        self.locks = [threading.Lock() for _ in range(stripes)]
+
+    def __call__(self, key):
+        return self.locks[hash(key) % len(self.locks)]
 
 
 class AbstractStoreAdapter(metaclass=abc.ABCMeta):
@@ -42,8 +67,11 @@ class ClearTextStoreAdapter(AbstractStoreAdapter):
     either.  If more secure methods are required to operate, open an issue requesting a new feature.
     """
 
+    persistent = False
+
     def __init__(self):
         self.associations = {}
+        self.locks = StripedLock()
 
     def __str__(self):
         return str(self.associations)
@@ -52,33 +80,293 @@ class ClearTextStoreAdapter(AbstractStoreAdapter):
         pass
 
     def set(self, name, secret, namespace=""):
-        self.associations[name] = secret
+        with self.locks(name):
+            self.associations[name] = secret
         return True
 
     def get(self, name, namespace=""):
-        return self.associations.get(name)
+        with self.locks(name):
+            return self.associations.get(name)
 
     def delete(self, name, namespace=""):
-        if name in self.associations:
-            del self.associations[name]
+        with self.locks(name):
+            self.associations.pop(name, None)
 
     def teardown(self):
         pass
 
 
-class SessionStore(object):
+class SQLiteStoreAdapter(AbstractStoreAdapter):
+    """
+    The SQLite store adapter persists secrets and sessions to a database so they survive restarts
+    of the bot.  Reads are served from memory and fall through to the database the first time a
+    name is read.  Writes update memory immediately and are written to the database in batches by
+    a background thread.  The database isn't encrypted, it's created readable by the bot's user
+    only.
+    """
+
+    persistent = True
+
     def __init__(self):
+        self.path = None
+        self.conn = None
+        self.cache = {}
+        # Number of writes queued for each name, deletions are remembered until none are left.
+        self.pending = {}
+        # Incremented when deletions are dropped from memory.
+        self.forgotten = 0
+        self.lock = threading.Lock()
+        self.db_lock = threading.Lock()
+        self.writes = queue.Queue()
+        self.writer = None
+        self.hits = 0
+        self.misses = 0
+        self.written = 0
+
+    def __str__(self):
+        return "SQLite store {}".format(self.path)
+
+    def setup(self, path):
+        self.path = path
+        # The database holds secrets, create it before SQLite does so it's only readable by the
+        # bot's user.  SQLite creates the journal files with the database's permissions.
+        os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+        os.chmod(path, 0o600)
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS secrets (namespace TEXT NOT NULL, name TEXT NOT NULL, "
+            "value TEXT NOT NULL, PRIMARY KEY (namespace, name))"
+        )
+        self.writer = threading.Thread(target=self._writer, name="st2_store_writer", daemon=True)
+        self.writer.start()
+        LOG.info("SQLite store {} opened.".format(path))
+
+    @staticmethod
+    def encode(secret):
+        if isinstance(secret, St2UserToken):
+            return json.dumps({"token": secret.token, "expiry": secret.expiry})
+        if isinstance(secret, St2ApiKey):
+            return json.dumps({"apikey": secret.apikey})
+        return json.dumps({"value": secret})
+
+    @staticmethod
+    def decode(value):
+        value = json.loads(value)
+        if "token" in value:
+            return St2UserToken(value["token"], value.get("expiry"))
+        if "apikey" in value:
+            return St2ApiKey(value["apikey"])
+        return value["value"]
+
+    def _writer(self):
+        while True:
+            writes = [self.writes.get()]
+            while True:
+                try:
+                    writes.append(self.writes.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with self.db_lock:
+                    self.conn.execute("BEGIN")
+                    for namespace, name, value in writes:
+                        if value is None:
+                            self.conn.execute(
+                                "DELETE FROM secrets WHERE namespace = ? AND name = ?",
+                                (namespace, name),
+                            )
+                        else:
+                            self.conn.execute(
+                                "INSERT OR REPLACE INTO secrets (namespace, name, value) "
+                                "VALUES (?, ?, ?)",
+                                (namespace, name, value),
+                            )
+                    self.conn.execute("COMMIT")
+                self.written += len(writes)
+                self._forget(writes, committed=True)
+            except sqlite3.Error as err:
+                LOG.error("Failed to write {} changes to {}.  {}".format(len(writes), self, err))
+                with self.db_lock:
+                    if self.conn.in_transaction:
+                        self.conn.execute("ROLLBACK")
+                # Deletions that weren't written keep hiding the database records.
+                self._forget(writes, committed=False)
+            for _ in writes:
+                self.writes.task_done()
+
+    def _forget(self, writes, committed):
         """
-        Sessions are stored by userid with a lookup index for uuid's to user_ids.
+        Drop the deletions that have been committed to the database from memory, unless the name
+        has been written again since.
+        """
+        with self.lock:
+            for namespace, name, value in writes:
+                key = (namespace, name)
+                self.pending[key] -= 1
+                if self.pending[key] == 0:
+                    del self.pending[key]
+                    if committed and key in self.cache and self.cache[key] is None:
+                        del self.cache[key]
+                        self.forgotten += 1
+
+    def _queue(self, namespace, name, value):
+        # Called holding the lock so writes are queued in the order they're made in memory.
+        key = (namespace, name)
+        self.pending[key] = self.pending.get(key, 0) + 1
+        self.writes.put((namespace, name, value))
+
+    def set(self, name, secret, namespace=""):
+        try:
+            value = self.encode(secret)
+        except TypeError as err:
+            LOG.warning("Unable to persist {} secret, keeping it in memory.  {}".format(name, err))
+            value = None
+        with self.lock:
+            self.cache[(namespace, name)] = secret
+            if value is not None:
+                self._queue(namespace, name, value)
+        return True
+
+    def get(self, name, namespace=""):
+        key = (namespace, name)
+        with self.lock:
+            if key in self.cache:
+                self.hits += 1
+                return self.cache[key]
+            self.misses += 1
+            forgotten = self.forgotten
+        with self.db_lock:
+            row = self.conn.execute(
+                "SELECT value FROM secrets WHERE namespace = ? AND name = ?", (namespace, name)
+            ).fetchone()
+        secret = self.decode(row[0]) if row else None
+        with self.lock:
+            if secret is None or self.forgotten != forgotten:
+                # Missing names aren't cached.  When a deletion was dropped while the database was
+                # read, the row may be stale.
+                return self.cache.get(key, secret)
+            # Keep a value set or deleted while the database was read.
+            return self.cache.setdefault(key, secret)
+
+    def delete(self, name, namespace=""):
+        with self.lock:
+            # Remember the deletion so reads don't fall through to the record until it's removed.
+            self.cache[(namespace, name)] = None
+            self._queue(namespace, name, None)
+
+    def items(self, namespace=""):
+        """
+        Returns a list of (name, secret) stored in the namespace.
+        """
+        self.writes.join()
+        with self.db_lock:
+            rows = self.conn.execute(
+                "SELECT name, value FROM secrets WHERE namespace = ?", (namespace,)
+            ).fetchall()
+        return [(name, self.decode(value)) for name, value in rows]
+
+    def stats(self):
+        """
+        Returns a dict of the store's counters.
+        """
+        with self.lock:
+            return {
+                "path": self.path,
+                "cached": len(self.cache),
+                "hits": self.hits,
+                "misses": self.misses,
+                "pending": self.writes.unfinished_tasks,
+                "written": self.written,
+            }
+
+    def teardown(self):
+        """
+        Wait for pending writes to reach the database.
+        """
+        self.writes.join()
+
+
+class SessionStore(object):
+    def __init__(self, adapter=None):
+        """
+        Sessions are stored by userid with a lookup index for uuid's to user_ids.  Changes to a
+        user's session and its uuid mapping are made while holding the user's lock stripe.  The
+        uuid mapping can be read without a lock and is confirmed against the user's session.
+
+        A min-heap of (expiry, session id) orders sessions by expiry so expired sessions can be
+        found without scanning the store.  When a persistent store adapter is given, sessions are
+        saved with it and the unexpired sessions it holds are restored.
         """
         self.memory = {}
         self.id_to_user_map = {}
+        self.locks = StripedLock()
+        self.expiry_index = []
+        self.indexed = {}
+        self.index_lock = threading.Lock()
+        self.evicted = 0
+        self.adapter = adapter
+        if adapter is not None:
+            self._restore()
+
+    def _restore(self):
+        now = time.monotonic()
+        restored = 0
+        for user_id, attributes in self.adapter.items("sessions"):
+            try:
+                session = Session.from_dict(attributes)
+            except (KeyError, TypeError, ValueError) as err:
+                LOG.error("Discarding unreadable session for {}.  {}".format(user_id, err))
+                self.adapter.delete(user_id, "sessions")
+                # Discard the session's secret too when its id can still be read.
+                if isinstance(attributes, dict) and attributes.get("session_id"):
+                    self.adapter.delete(str(attributes["session_id"]))
+                continue
+            if session.expiry() < now:
+                self.adapter.delete(user_id, "sessions")
+                self.adapter.delete(session.id())
+                continue
+            self.memory[session.user_id] = session
+            self.id_to_user_map[session.id()] = session.user_id
+            self._index(session)
+            restored += 1
+        LOG.info("Restored {} sessions from {}.".format(restored, self.adapter))
+
+    def _index(self, session):
+        with self.index_lock:
+            self.indexed[session.id()] = session.expiry()
+            heapq.heappush(self.expiry_index, (session.expiry(), session.id()))
+
+    def _save(self, session):
+        if self.adapter is not None:
+            self.adapter.set(session.user_id, session.to_dict(), "sessions")
+
+    def _remove(self, session):
+        """
+        Remove the session and its uuid mapping.  The caller must hold the user's lock stripe.
+        """
+        del self.memory[session.user_id]
+        self.id_to_user_map.pop(session.id(), None)
+        if self.adapter is not None:
+            self.adapter.delete(session.user_id, "sessions")
+
+    def _lookup(self, session_id):
+        """
+        Returns the user id and session for a session id.  The caller must hold the user's lock
+        stripe to act on the session.
+        """
+        user_id = self.id_to_user_map.get(session_id)
+        session = self.memory.get(user_id)
+        if session is None or session.id() != session_id:
+            return user_id, None
+        return user_id, session
 
     def list(self):
         """
         Return a list of string representation of session.
         """
-        return [self.memory[k] for k in self.memory.keys()]
+        return list(self.memory.values())
 
     def get_by_userid(self, user_id):
         """
@@ -90,33 +378,144 @@ class SessionStore(object):
         """
         Put a new session in the store using the user_id as the key
         and create a reverse mapping between the user_id and the session_id.
+        A session already stored for the user is replaced.
         """
-        self.memory[session.user_id] = session
-        self.id_to_user_map[session.id()] = session.user_id
+        with self.locks(session.user_id):
+            previous = self.memory.get(session.user_id)
+            if previous is not None:
+                self.id_to_user_map.pop(previous.id(), None)
+            self.memory[session.user_id] = session
+            self.id_to_user_map[session.id()] = session.user_id
+            self._save(session)
+        self._index(session)
 
-    def delete(self, user_id):
+    def put_if_absent(self, session):
+        """
+        Put a new session in the store unless one is already stored for the user.  Returns True if
+        the session was stored.
+        """
+        with self.locks(session.user_id):
+            if session.user_id in self.memory:
+                return False
+            self.memory[session.user_id] = session
+            self.id_to_user_map[session.id()] = session.user_id
+            self._save(session)
+        self._index(session)
+        return True
+
+    def update(self, session):
+        """
+        Save a modified session and re-index its expiry.  Sessions that have been removed from the
+        store aren't saved again.
+        """
+        with self.locks(session.user_id):
+            if self.memory.get(session.user_id) is not session:
+                return False
+            self._save(session)
+        self._index(session)
+        return True
+
+    def consume(self, session_id):
+        """
+        Unseal a session.  Returns the session or False if it isn't in the store.  Raises
+        SessionConsumedError if the session was already consumed.
+        """
+        user_id, session = self._lookup(session_id)
+        if session is None:
+            return False
+        with self.locks(user_id):
+            user_id, session = self._lookup(session_id)
+            if session is None:
+                return False
+            session.unseal()
+            self._save(session)
+        return session
+
+    def delete(self, user_id, session_id=None):
         """
         Delete a session by user_id.  Delete the reverse mapping
-        if it exists.
+        if it exists.  When session_id is given, the session is only deleted if it has that id.
+        Returns the deleted session or False.
         """
-        session = self.memory.get(user_id, False)
+        with self.locks(user_id):
+            session = self.memory.get(user_id, False)
+            if session and session_id is not None and session.id() != session_id:
+                session = False
+            if session:
+                self._remove(session)
         if session:
-            if session.id() in self.id_to_user_map:
-                del self.id_to_user_map[session.id()]
-            del self.memory[user_id]
+            with self.index_lock:
+                self.indexed.pop(session.id(), None)
+            self._compact()
         else:
             LOG.warning("Failed to delete user_id {} session - Not found.".format(user_id))
+        return session
+
+    def _compact(self):
+        """
+        Entries of deleted and updated sessions are left in the expiry index until they reach the
+        top of the heap.  Rebuild the index when they outnumber the indexed sessions.
+        """
+        with self.index_lock:
+            if len(self.expiry_index) > 2 * len(self.indexed) + 64:
+                self.expiry_index = [(e, i) for i, e in self.indexed.items()]
+                heapq.heapify(self.expiry_index)
+
+    def expire(self, now=None, keep=()):
+        """
+        Remove the sessions that have expired and return them.  Stale index entries are
+        discarded and sessions whose ttl was extended are pushed back with the new expiry, so
+        each session costs O(log n).  A session whose ttl was shortened without being updated is
+        evicted once its original expiry is reached.
+        param: now[float] time.monotonic() time to expire sessions at, defaults to the current time.
+        param: keep[iterable] user ids whose sessions are never evicted.
+        """
+        if now is None:
+            now = time.monotonic()
+        due = []
+        with self.index_lock:
+            while self.expiry_index and self.expiry_index[0][0] < now:
+                expiry, session_id = heapq.heappop(self.expiry_index)
+                if self.indexed.get(session_id) == expiry:
+                    del self.indexed[session_id]
+                    due.append(session_id)
+
+        expired = []
+        for session_id in due:
+            user_id, session = self._lookup(session_id)
+            if session is None:
+                continue
+            with self.locks(user_id):
+                user_id, session = self._lookup(session_id)
+                if session is None:
+                    continue
+                if session.expiry() < now and user_id not in keep:
+                    self._remove(session)
+                    expired.append(session)
+                    continue
+            self._index(session)
+        with self.index_lock:
+            self.evicted += len(expired)
+        return expired
 
-    def put_by_id(self, session_id, session):
+    def stats(self):
         """
-        Put a session in the store using the session id.
+        Returns a dict of the number of live and expired sessions.
         """
-        if session.user_id in self.memory:
-            self.id_to_user_map[session_id] = session.user_id
+        now = time.monotonic()
+        sessions = list(self.memory.values())
+        expired = sum(1 for s in sessions if s.expiry() < now)
+        with self.index_lock:
+            return {
+                "live": len(sessions) - expired,
+                "expired": expired,
+                "evicted": self.evicted,
+                "index": len(self.expiry_index),
+            }
 
     def get_by_uuid(self, session_id):
-        user_id = self.id_to_user_map.get(session_id, False)
-        session = self.memory.get(user_id, False)
-        if session is False:
-            LOG.debug("Error: Session id '{}' points to a missing session.".format(""))
+        user_id, session = self._lookup(session_id)
+        if session is None:
+            LOG.debug("Error: Session id '{}' points to a missing session.".format(session_id))
+            return False
         return session
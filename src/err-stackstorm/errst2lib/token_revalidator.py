@@ -0,0 +1,151 @@
+# coding:utf-8
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from errst2lib.errors import SessionExpiredError, SessionInvalidError
+from errst2lib.rate_limiter import TokenBucket
+
+LOG = logging.getLogger("errbot.plugin.st2.token_revalidator")
+
+# Results of validating a chat user's token.
+VALID = "valid"
+INVALID = "invalid"
+UNKNOWN = "unknown"
+
+
+class TokenRevalidator(object):
+    """
+    Check the StackStorm tokens cached for chat users are still valid, away from the chat
+    command path.
+
+    Each run validates the tokens of the consumed sessions in batches of batch_size.  A batch is
+    validated by a pool of workers and validations are sent to StackStorm at no more than rate
+    per second.  Sessions whose token is rejected are deleted and the chat user is notified.
+    Chat users whose token expires within warning seconds are notified once beforehand.
+    Tokens that couldn't be checked, because StackStorm was unavailable, are kept.
+    """
+
+    def __init__(
+        self, accessctl, validate, notify, batch_size=50, workers=4, rate=10, warning=3600
+    ):
+        self.accessctl = accessctl
+        # Called with (token, bot_token), returns True, False or None when it couldn't check.
+        self.validate = validate
+        # Called with (user_id, expires_in), expires_in is None when the token was rejected.
+        self.notify = notify
+        self.batch_size = batch_size
+        self.workers = workers
+        self.bucket = TokenBucket(rate, workers)
+        self.warning = warning
+        self.warned = set()
+        self.lock = threading.Lock()
+        self.runs = 0
+        self.checked = 0
+        self.evicted = 0
+        self.warnings = 0
+        self.errors = 0
+        self.last_duration = None
+
+    def _sessions(self):
+        """
+        Returns the consumed sessions of chat users, those with a token to check.
+        """
+        bot_user_id = self.accessctl.to_userid(self.accessctl.bot.internal_identity)
+        sessions = []
+        for session in self.accessctl.list_sessions():
+            if session.user_id == bot_user_id:
+                continue
+            try:
+                if session.is_sealed():
+                    continue
+            except SessionExpiredError:
+                continue
+            sessions.append(session)
+        return sessions
+
+    def _check(self, session, bot_token):
+        token = self.accessctl.get_token_by_session(session.id())
+        if not token:
+            return UNKNOWN
+        wait = self.bucket.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        try:
+            valid = self.validate(token, bot_token)
+        except Exception as err:
+            LOG.warning("Unable to validate the token of {}.  {}".format(session.user_id, err))
+            valid = None
+        with self.lock:
+            self.checked += 1
+            if valid is None:
+                self.errors += 1
+        if valid is None:
+            return UNKNOWN
+        if not valid:
+            return INVALID
+
+        expiry = getattr(token, "expiry", None)
+        if expiry is not None and session.id() not in self.warned:
+            expires_in = expiry - time.time()
+            if expires_in < self.warning:
+                with self.lock:
+                    self.warned.add(session.id())
+                    self.warnings += 1
+                self.notify(session.user_id, max(expires_in, 0))
+        return VALID
+
+    def _evict(self, session):
+        LOG.info("Evicting the rejected StackStorm token of {}.".format(session.user_id))
+        try:
+            self.accessctl.delete_session(session.id())
+        except SessionInvalidError:
+            # The session was deleted while it was being checked.
+            return
+        with self.lock:
+            self.evicted += 1
+        self.notify(session.user_id, None)
+
+    def run(self):
+        """
+        Validate the tokens of all chat users.
+        """
+        start = time.monotonic()
+        sessions = self._sessions()
+        bot_token = self.accessctl.get_token_by_userid(self.accessctl.bot.internal_identity)
+        with ThreadPoolExecutor(self.workers, thread_name_prefix="st2_revalidate") as executor:
+            for start_index in range(0, len(sessions), self.batch_size):
+                end_index = start_index + self.batch_size
+                batch = sessions[start_index:end_index]
+                results = executor.map(lambda s: self._check(s, bot_token), batch)
+                for session, result in zip(batch, results):
+                    if result == INVALID:
+                        self._evict(session)
+
+        with self.lock:
+            # Forget warnings for sessions that no longer exist.
+            self.warned &= set(s.id() for s in sessions)
+            self.runs += 1
+            self.last_duration = time.monotonic() - start
+        LOG.debug(
+            "Revalidated {} chat user tokens in {:.1f} seconds.".format(
+                len(sessions), self.last_duration
+            )
+        )
+
+    def stats(self):
+        """
+        Returns a dict of the revalidator's counters.
+        """
+        with self.lock:
+            return {
+                "runs": self.runs,
+                "checked": self.checked,
+                "evicted": self.evicted,
+                "warnings": self.warnings,
+                "errors": self.errors,
+                "last_duration": (
+                    round(self.last_duration, 3) if self.last_duration is not None else None
+                ),
+            }
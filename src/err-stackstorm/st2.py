@@ -3,7 +3,10 @@ import json
 import logging
 import shlex
 import threading
+import time
 import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from types import SimpleNamespace
 
 import requests
@@ -11,17 +14,25 @@ from errbot import BotPlugin, Command, arg_botcmd, botcmd, re_botcmd, webhook
 
 from errst2lib.authentication_controller import AuthenticationController, BotPluginIdentity
 from errst2lib.authentication_handler import AuthHandlerFactory, ClientSideAuthHandler
+from errst2lib.cache import TTLCache
 from errst2lib.chat_adapters import ChatAdapterFactory
+from errst2lib.coalescer import Coalescer
 from errst2lib.config import PluginConfiguration
 from errst2lib.credentials_adapters import St2ApiKey, St2UserCredentials, St2UserToken
+from errst2lib.delivery import Announcement, DeliveryQueue
 from errst2lib.enquiry import Enquiry, EnquiryManager
 from errst2lib.errors import (
+    CircuitOpenError,
     SessionConsumedError,
     SessionExistsError,
     SessionExpiredError,
     SessionInvalidError,
 )
-from errst2lib.stackstorm_api import StackStormAPI
+from errst2lib.executor import BoundedExecutor
+from errst2lib.retry import DeliveryRetry
+from errst2lib.spool import Spool
+from errst2lib.stackstorm_api import ACTION_ALIAS_EVENTS, StackStormAPI
+from errst2lib.token_revalidator import TokenRevalidator
 from errst2lib.version import ERR_STACKSTORM_VERSION
 
 LOG = logging.getLogger("errbot.plugin.st2")
@@ -55,6 +66,12 @@ class St2(BotPlugin):
 
         self.st2api = StackStormAPI(self.cfg, self.accessctl)
 
+        # Action-alias help is cached until it expires or an action-alias is changed.
+        self.help_cache = TTLCache(self.cfg.help_cache_ttl, maxsize=256)
+        self.st2api.add_stream_handler(
+            ACTION_ALIAS_EVENTS, lambda event, data: self.help_cache.clear()
+        )
+
         self.responses = EnquiryManager()
 
         # Wrap err-stackstorm credentials to distinguish it from chat backend credentials.
@@ -63,10 +80,27 @@ class St2(BotPlugin):
 
         self.run_listener = True
         self.st2events_listener = None
+        self.executor = None
+        self.delivery = None
+        self.coalescer = None
+        self.spool = None
+        self.retry = DeliveryRetry(self.post_to_chat, **self.cfg.delivery_retry)
+        # Delivery status of webhook messages accepted for asynchronous delivery.
+        self.receipts = TTLCache(self.cfg.receipt_ttl, maxsize=10000)
+        # Chat users' tokens are only cached by the bot with client side authentication.
+        self.revalidator = None
+        if isinstance(self.cfg.auth_handler, ClientSideAuthHandler):
+            self.revalidator = TokenRevalidator(
+                self.accessctl,
+                self.cfg.auth_handler.validate_token,
+                self.notify_token_user,
+                **self.cfg.token_revalidate,
+            )
 
     def authenticate_bot_credentials(self):
         """
         Create a session and associate valid StackStorm credentials with it for the bot to use.
+        Returns True when StackStorm issued the bot a token.
         """
 
         # Create a session for internal use by err-stackstorm
@@ -76,22 +110,48 @@ class St2(BotPlugin):
             )
             self.accessctl.consume_session(bot_session.id())
         except SessionExistsError:
-            LOG.warning("Internal logic error, bot session already exists.")
+            LOG.debug("Bot session already exists, renewing its token.")
             bot_session = self.accessctl.get_session(self.internal_identity)
+            # Extend the session's lifetime along with the new token.
+            try:
+                bot_session.ttl(self.cfg.session_ttl)
+                self.accessctl.update_session(bot_session)
+            except SessionExpiredError:
+                self.accessctl.delete_session(bot_session.id())
+                return self.authenticate_bot_credentials()
         LOG.debug("Bot session {}".format(bot_session))
 
         # Bot authentication is a corner case, it always requires the standalone model.
         standalone_auth = AuthHandlerFactory.instantiate("standalone")(self.cfg)
-        bot_token = standalone_auth.authenticate(st2_creds=self.cfg.bot_creds)
+        try:
+            bot_token = standalone_auth.authenticate(st2_creds=self.cfg.bot_creds)
+        except CircuitOpenError as err:
+            LOG.warning("{}".format(err))
+            bot_token = False
         if bot_token:
             LOG.debug("StackStorm authentication succeeded.")
+            # The new token replaces the previous one, which kept serving requests until now.
             self.accessctl.set_token_by_session(bot_session.id(), bot_token)
-        else:
-            LOG.critical("Failed to authenticate bot credentials with StackStorm API.")
+            expiry = getattr(bot_token, "expiry", None)
+            if expiry is not None:
+                # Keep the bot session for as long as the token is valid.
+                bot_session.ttl(max(self.cfg.session_ttl, int(expiry - time.time())))
+                self.accessctl.update_session(bot_session)
+            self.st2api.schedule_bot_renewal(bot_token)
+            return True
+        LOG.critical("Failed to authenticate bot credentials with StackStorm API.")
+        return False
 
     def reauthenticate_bot_credentials(self, bot_session):
-        self.accessctl.delete_session(bot_session.id())
-        self.authenticate_bot_credentials()
+        """
+        Renew the bot's StackStorm token.  The session is kept unless it has expired so threads
+        reading the bot's token are never left without one.
+        """
+        try:
+            bot_session.is_expired()
+        except SessionExpiredError:
+            self.accessctl.delete_session(bot_session.id())
+        return self.authenticate_bot_credentials()
 
     def validate_bot_credentials(self):
         """
@@ -100,12 +160,41 @@ class St2(BotPlugin):
         try:
             bot_session = self.accessctl.get_session(self.internal_identity)
             bot_session.is_expired()
-        except SessionExpiredError as err:
-            LOG.debug("{}".format(err))
-            self.reauthenticate_bot_credentials(bot_session)
-        except SessionInvalidError as err:
+        except (SessionExpiredError, SessionInvalidError) as err:
             LOG.debug("{}".format(err))
-            self.authenticate_bot_credentials()
+            self.st2api.refresh_bot_credentials()
+
+    def expire_sessions(self):
+        """
+        Evict expired sessions and their StackStorm tokens from the session store.
+        """
+        self.accessctl.expire_sessions()
+
+    def revalidate_tokens(self):
+        """
+        Check the StackStorm tokens of chat users are still valid.
+        """
+        self.revalidator.run()
+
+    def notify_token_user(self, user_id, expires_in):
+        """
+        Tell a chat user their StackStorm token was rejected or is about to expire.
+        """
+        if expires_in is None:
+            message = (
+                "Your StackStorm token is no longer valid.  Please authenticate using "
+                "{}session_start to continue running commands.".format(self.cfg.plugin_prefix)
+            )
+        else:
+            message = (
+                "Your StackStorm token expires in {} minutes.  Please authenticate using "
+                "{}session_start before it does.".format(
+                    int(expires_in // 60), self.cfg.plugin_prefix
+                )
+            )
+        self.queue_announcement(
+            Announcement(True, message, self.chatbackend.user_target(user_id), None, None)
+        )
 
     def st2listener(self, start=False, stop=False):
         """
@@ -125,26 +214,198 @@ class St2(BotPlugin):
         """
         super().activate()
         LOG.info("Activate St2 plugin")
+        # The HTTP client is closed when the plugin is deactivated.
+        if self.cfg.http.closed:
+            self.cfg.open_http()
 
         self.dynamic_commands()
 
         self.start_poller(self.cfg.timer_update, self.validate_bot_credentials)
+        self.st2api.resume_bot_renewal()
+        if self.cfg.session_sweep_interval > 0:
+            self.start_poller(self.cfg.session_sweep_interval, self.expire_sessions)
+        if self.revalidator is not None and self.cfg.token_revalidate_interval > 0:
+            self.start_poller(self.cfg.token_revalidate_interval, self.revalidate_tokens)
+
+        if self.cfg.execution_workers > 0:
+            self.executor = BoundedExecutor(
+                "st2_execution", self.cfg.execution_workers, self.cfg.execution_queue_size
+            )
+
+        self.chatbackend.activate()
+        self.retry.start()
+        if self.cfg.spool_path:
+            self.spool = Spool(self.cfg.spool_path)
+
+        if self.cfg.delivery_workers > 0:
+            self.delivery = DeliveryQueue(
+                "st2_delivery",
+                self.deliver_announcement,
+                self.cfg.delivery_workers,
+                self.cfg.delivery_queue_size,
+                self.cfg.delivery_overflow,
+                on_drop=self.drop_announcement,
+            )
+
+        if self.cfg.coalesce_window > 0:
+            self.coalescer = Coalescer(
+                self.queue_announcement, self.cfg.coalesce_window, self.cfg.coalesce_max_length
+            )
+
+        if self.spool is not None:
+            pending = self.spool.pending()
+            if pending:
+                LOG.info("Replaying {} spooled announcements.".format(len(pending)))
+            for announcement in pending:
+                self.queue_announcement(announcement)
+
         self.st2events_listener = threading.Thread(
             target=self.st2api.st2stream_listener,
             name="st2stream_listener",
-            args=[self.chatbackend.post_message, self.internal_identity],
+            args=[self.post_announcement, self.internal_identity],
         )
         self.st2listener(start=True)
 
     def deactivate(self):
         super().deactivate()
         self.stop_poller(self.validate_bot_credentials)
+        self.st2api.cancel_bot_renewal()
+        if self.cfg.session_sweep_interval > 0:
+            self.stop_poller(self.expire_sessions)
+        if self.revalidator is not None and self.cfg.token_revalidate_interval > 0:
+            self.stop_poller(self.revalidate_tokens)
         self.destroy_dynamic_plugin("St2")
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
         self.st2listener(stop=True)
         LOG.info("st2stream listener wait for thread to exit.")
         self.st2events_listener.join()
         LOG.info("st2stream listener exited.")
         del self.st2events_listener
+        if self.coalescer is not None:
+            self.coalescer.shutdown()
+            self.coalescer = None
+        # Announcements waiting to be retried stay in the spool to be replayed.
+        self.retry.stop()
+        if self.delivery is not None:
+            self.delivery.shutdown()
+            self.delivery = None
+        # The chat backend is torn down once the queued announcements have been posted.
+        self.chatbackend.deactivate()
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+        self.accessctl.teardown()
+        self.cfg.http.close()
+
+    def post_announcement(self, whisper, message, user, channel, extra):
+        """
+        Queue an announcement read from the stream for delivery to the chat backend.  Bursts of
+        announcements are merged when coalescing is enabled.
+        """
+        announcement = Announcement(whisper, message, user, channel, extra)
+        if self.spool is not None:
+            self.spool.append(announcement)
+        if self.coalescer is None:
+            self.queue_announcement(announcement)
+        else:
+            self.coalescer.put(announcement)
+
+    def queue_announcement(self, announcement):
+        if self.delivery is None:
+            self.deliver_announcement(announcement)
+        else:
+            self.delivery.put(announcement)
+
+    def deliver_announcement(self, announcement, max_attempts=None, dead_letter=True):
+        """
+        Post an announcement to the chat backend, retrying transient failures.
+        """
+        status = self.retry(announcement, max_attempts, dead_letter)
+        if status is not None:
+            self.spool_done(announcement)
+            self.update_receipt(announcement, status)
+        return status
+
+    def drop_announcement(self, announcement):
+        self.spool_done(announcement)
+        self.update_receipt(announcement, "dropped")
+
+    def update_receipt(self, announcement, status):
+        if announcement.receipt is not None:
+            self.receipts.set(announcement.receipt, status)
+
+    def post_to_chat(self, announcement):
+        self.chatbackend.post_message(
+            announcement.whisper,
+            announcement.message,
+            announcement.user,
+            announcement.channel,
+            announcement.extra,
+        )
+
+    def spool_done(self, announcement):
+        """
+        Remove a delivered or dropped announcement from the spool.
+        """
+        if self.spool is not None:
+            self.spool.done(announcement)
+
+    def stats(self, msg, args):
+        """
+        Report err-stackstorm runtime statistics.
+        """
+        stats = {}
+        if self.executor is not None:
+            stats["Action-alias execution"] = self.executor.stats()
+        if self.coalescer is not None:
+            stats["Announcement coalescing"] = self.coalescer.stats()
+        if self.delivery is not None:
+            stats["Announcement delivery"] = self.delivery.stats()
+        if self.spool is not None:
+            stats["Announcement spool"] = self.spool.stats()
+        stats["Delivery retry"] = self.retry.stats()
+        stats.update(self.chatbackend.stats())
+        stats["Sessions"] = self.accessctl.session_stats()
+        auth_stats = self.cfg.auth_handler.stats()
+        if auth_stats is not None:
+            stats["User tokens"] = auth_stats
+        if self.revalidator is not None:
+            stats["Token revalidation"] = self.revalidator.stats()
+        stats["Bot credentials"] = self.st2api.refresh_stats()
+        stats["Stream events"] = self.st2api.stream_stats()
+        for endpoint, breaker_stats in self.cfg.http.breakers.stats().items():
+            stats["Circuit breaker {}".format(endpoint)] = breaker_stats
+
+        res = "err-stackstorm statistics:\n"
+        for section, counters in stats.items():
+            res += "{}\n".format(section)
+            for name, value in counters.items():
+                res += "\t{}: {}\n".format(name, value)
+        return res
+
+    def dead_letters(self, msg, args):
+        """
+        List the announcements that couldn't be delivered to the chat backend.
+        """
+        if args == "clear":
+            self.retry.clear_dead_letters()
+            return "Dead letters cleared."
+        dead_letters = self.retry.list_dead_letters()
+        if len(dead_letters) == 0:
+            return "No dead letters."
+        res = "Dead letters:\n"
+        for dead_letter in dead_letters:
+            announcement = dead_letter["announcement"]
+            res += " - {} {} after {} attempts.  {}\n\t{}\n".format(
+                dead_letter["failed_at"],
+                announcement.channel or announcement.user,
+                dead_letter["attempts"],
+                dead_letter["error"],
+                announcement.message,
+            )
+        return res
 
     def session_list(self, msg, args):
         """
@@ -183,7 +444,11 @@ class St2(BotPlugin):
             LOG.warning(rejection)
             return rejection
 
-        res = self.st2api.enquiry_list(st2token).json()
+        try:
+            res = self.st2api.enquiry_list(st2token).json()
+        except CircuitOpenError as err:
+            yield str(err)
+            return
         yield f"Enquries awaiting response: {len(res)}"
         for enquiry in res:
             yield enquiry["id"]
@@ -210,7 +475,10 @@ class St2(BotPlugin):
             LOG.warning(rejection)
             return rejection
 
-        res = self.st2api.enquiry_get(args, st2token)
+        try:
+            res = self.st2api.enquiry_get(args, st2token)
+        except CircuitOpenError as err:
+            return str(err)
         if res:
             p = res["schema"]["properties"]
             return "Enquiry ID: {} (★ indicates required responses)\n{}".format(
@@ -316,6 +584,30 @@ class St2(BotPlugin):
         """
         Run an arbitrary stackstorm command.
         Available commands can be listed using !st2help
+
+        When the execution pool is enabled, the command is run by a pool worker and the result is
+        posted to the chat backend once available.
+        """
+        if self.executor is None:
+            return self.run_actionalias(msg, match)
+
+        if self.executor.submit(self.run_actionalias_job, msg, match) is False:
+            return (
+                "StackStorm commands are busy, please try again in a moment.  "
+                "Your command '{}' was not run.".format(match.group())
+            )
+
+    def run_actionalias_job(self, msg, match):
+        """
+        Run the action-alias in an execution pool worker and reply with the result.
+        """
+        result = self.run_actionalias(msg, match)
+        if result:
+            self.chatbackend.post_reply(msg, result)
+
+    def run_actionalias(self, msg, match):
+        """
+        Match and execute an action-alias.  Returns the message to reply with.
         """
 
         def remove_bot_prefix(msg):
@@ -387,6 +679,12 @@ class St2(BotPlugin):
         """
         Provide help for StackStorm action aliases.
         """
+        cache_key = (pack, filter, limit, offset, self._bot.mode)
+        cached = self.help_cache.get(cache_key)
+        if cached is not None:
+            help_result, help_text = cached
+            return help_text
+
         # If the bot session is invalid, attempt to renew it.
         try:
             bot_session = self.accessctl.get_session(self.internal_identity)
@@ -395,11 +693,49 @@ class St2(BotPlugin):
             bot_session = self.accessctl.get_session(self.internal_identity)
 
         st2_creds = self.accessctl.get_token_by_session(bot_session.id())
-        help_result = self.st2api.actionalias_help(pack, filter, limit, offset, st2_creds)
+        try:
+            help_result = self.st2api.actionalias_help(pack, filter, limit, offset, st2_creds)
+        except CircuitOpenError as err:
+            return str(err)
         if isinstance(help_result, list) and len(help_result) == 0:
-            return "No help found for the search."
+            help_text = "No help found for the search."
         else:
-            return self.chatbackend.format_help(help_result)
+            help_text = self.chatbackend.format_help(help_result)
+
+        # Only cache successful responses from the API.
+        if isinstance(help_result, list):
+            self.help_cache.set(cache_key, (help_result, help_text))
+        return help_text
+
+    def webhook_announcement(self, payload):
+        """
+        Returns the announcement for a webhook message.  ValueError is raised when the message
+        is invalid.
+        """
+        if not isinstance(payload, dict):
+            raise ValueError("The message must be an object.")
+        extra = payload.get("extra") or {}
+        if not isinstance(extra, dict):
+            raise ValueError("The message extra must be an object.")
+        message = payload.get("message")
+        if not isinstance(message, str) and not extra:
+            raise ValueError("The message text is missing.")
+        if payload.get("channel") is None and payload.get("user") is None:
+            raise ValueError("The message has no channel or user.")
+        return Announcement(
+            payload.get("whisper"), message, payload.get("user"), payload.get("channel"), extra
+        )
+
+    def accept_announcement(self, announcement):
+        """
+        Queue a webhook announcement for delivery and return its receipt id.
+        """
+        announcement.receipt = uuid.uuid4().hex
+        self.receipts.set(announcement.receipt, "queued")
+        if self.spool is not None:
+            self.spool.append(announcement)
+        self.queue_announcement(announcement)
+        return announcement.receipt
 
     @webhook("/chatops/message")
     def chatops_message(self, request):
@@ -409,16 +745,106 @@ class St2(BotPlugin):
         """
         # WARNING: Sensitive security information will be logged, uncomment only when necessary.
         # LOG.debug("Webhook request: {}".format(request))
+        try:
+            announcement = self.webhook_announcement(request)
+        except ValueError as err:
+            return {"status": "rejected", "error": str(err)}, 400
+
+        if self.cfg.webhook_async:
+            # Acknowledge the message and deliver it in the background.
+            return {"status": "accepted", "receipt": self.accept_announcement(announcement)}, 202
+
+        if self.spool is not None:
+            self.spool.append(announcement)
+        # The caller is waiting, so the message is only posted once and left for the caller to
+        # resend when it fails.
+        status = self.deliver_announcement(announcement, max_attempts=1, dead_letter=False)
+        if not self.cfg.webhook_status:
+            if status == DeliveryRetry.DELIVERED:
+                return "Delivered to chat backend."
+            return "Failed to deliver to chat backend.", 500
+        if status == DeliveryRetry.DELIVERED:
+            return {"status": status}
+        if status == DeliveryRetry.FAILED:
+            return {"status": status}, 502
+        return {"status": "abandoned"}, 503
+
+    def deliver_batch(self, announcements):
+        """
+        Deliver announcements in order within each channel and in parallel across channels.
+        Like /chatops/message, each announcement is posted once and failures are left for the
+        caller to resend.  Returns the delivery status of each announcement.
+        """
+        channels = {}
+        for index, announcement in enumerate(announcements):
+            channels.setdefault(announcement.key(), []).append((index, announcement))
+
+        statuses = [None] * len(announcements)
 
-        channel = request.get("channel")
-        message = request.get("message")
+        def deliver_channel(channel_announcements):
+            for index, announcement in channel_announcements:
+                statuses[index] = self.deliver_announcement(
+                    announcement, max_attempts=1, dead_letter=False
+                )
 
-        user = request.get("user")
-        whisper = request.get("whisper")
-        extra = request.get("extra", {})
+        workers = max(1, min(len(channels), self.cfg.delivery_workers))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="st2_batch") as pool:
+            list(pool.map(deliver_channel, channels.values()))
+        return statuses
 
-        self.chatbackend.post_message(whisper, message, user, channel, extra)
-        return "Delivered to chat backend."
+    @webhook("/chatops/messages")
+    def chatops_messages(self, request):
+        """
+        Webhook entry point for stackstorm to post a batch of messages into errbot.  The request
+        is a list of messages, or an object with the list in "messages", each with the same
+        fields as /chatops/message.  A status is returned for each message.
+        """
+        messages = request.get("messages") if isinstance(request, dict) else request
+        if not isinstance(messages, list):
+            return {"status": "rejected", "error": "The request must be a list of messages."}, 400
+        if len(messages) > self.cfg.webhook_batch_max:
+            return {
+                "status": "rejected",
+                "error": "The request has more than {} messages.".format(
+                    self.cfg.webhook_batch_max
+                ),
+            }, 400
+
+        results = []
+        announcements = []
+        for payload in messages:
+            try:
+                announcement = self.webhook_announcement(payload)
+            except ValueError as err:
+                results.append({"status": "rejected", "error": str(err)})
+                continue
+            results.append(None)
+            announcements.append((len(results) - 1, announcement))
+
+        if self.cfg.webhook_async:
+            for index, announcement in announcements:
+                receipt = self.accept_announcement(announcement)
+                results[index] = {"status": "accepted", "receipt": receipt}
+            return {"results": results}, 202
+
+        indexes = [index for index, announcement in announcements]
+        announcements = [announcement for index, announcement in announcements]
+        if self.spool is not None:
+            for announcement in announcements:
+                self.spool.append(announcement)
+        for index, status in zip(indexes, self.deliver_batch(announcements)):
+            results[index] = {"status": status or "abandoned"}
+        return {"results": results}
+
+    @webhook("/chatops/receipt/<receipt>")
+    def chatops_receipt(self, request, receipt):
+        """
+        Delivery status of a message accepted by the chatops webhooks.
+        """
+        status = self.receipts.get(receipt)
+        if status is None:
+            return {"receipt": receipt, "status": "unknown"}, 404
+        return {"receipt": receipt, "status": status}
 
     @webhook("/login/authenticate/<uuid>")
     def login_auth(self, request, uuid):
@@ -582,6 +1008,21 @@ class St2(BotPlugin):
                         self.cfg.bot_prefix, self.cfg.plugin_prefix
                     ),
                 ),
+                Command(
+                    lambda plugin, msg, args: self.stats(msg, args),
+                    name=f"{self.cfg.plugin_prefix}stats",
+                    cmd_type=botcmd,
+                    cmd_kwargs={"admin_only": True},
+                    doc="Show err-stackstorm runtime statistics.",
+                ),
+                Command(
+                    lambda plugin, msg, args: self.dead_letters(msg, args),
+                    name=f"{self.cfg.plugin_prefix}dead_letters",
+                    cmd_type=botcmd,
+                    cmd_kwargs={"admin_only": True},
+                    doc=f"Usage: {self.cfg.plugin_prefix}dead_letters [clear]\n"
+                    "List or clear the notifications that couldn't be delivered to chat.",
+                ),
                 Command(
                     enquiry_list,
                     name=f"{self.cfg.plugin_prefix}enquiry_list",
@@ -0,0 +1,17 @@
+# coding:utf-8
+import pytest
+from mock import Mock
+
+
+@pytest.fixture
+def bot_plugin():
+    """
+    Returns a mock St2 plugin with the configuration read by the chat adapters.
+    """
+    bot_plugin = Mock()
+    bot_plugin.cfg.rate_limit = {}
+    bot_plugin.cfg.identifier_cache_size = 1000
+    bot_plugin.cfg.identifier_cache_ttl = 3600
+    bot_plugin.cfg.slack_directory = False
+    bot_plugin.cfg.slack_directory_refresh = 3600
+    return bot_plugin
@@ -0,0 +1,101 @@
+# coding:utf-8
+from mock import Mock
+
+from errst2lib.action_alias import ActionAliasFormat, ActionAliasIndex
+
+pytest_plugins = ["errbot.backends.test"]
+extra_plugin_dir = "."
+
+
+def test_action_alias_format():
+    """
+    Action-alias format matching.
+    """
+    fmt = ActionAliasFormat("pack install {{packs}}", "pack install {{packs}}")
+    assert fmt.match("pack install st2") is True
+    assert fmt.match("pack install st2 aws") is True
+    assert fmt.match("pack install") is False
+    assert fmt.match("pack remove st2") is False
+
+    fmt = ActionAliasFormat(
+        "run {{cmd}} on {{hosts=localhost}}", "run {{cmd}} on {{hosts=localhost}}"
+    )
+    assert fmt.match("run date on") is True
+    assert fmt.match("run date on web01") is True
+    assert fmt.match("run 'ls -l' on web01") is True
+
+    # Whitespace before a placeholder is required.
+    fmt = ActionAliasFormat("status {{ host=localhost }}", "status {{ host=localhost }}")
+    assert fmt.match("status") is True
+    assert fmt.match("status web1") is True
+    assert fmt.match("statusweb1") is False
+
+    fmt = ActionAliasFormat("st2 {{a}}", "st2 {{a}}")
+    assert fmt.match("st2 b") is True
+    assert fmt.match("st2 ") is False
+    assert fmt.match("st2b") is False
+
+    fmt = ActionAliasFormat("st2 ping", "st2 ping")
+    assert fmt.match("st2 ping") is True
+    assert fmt.match("st2 ping timeout=5 debug=true") is True
+    assert fmt.match("st2 pingpong") is False
+
+    # Formats are regular expressions.
+    fmt = ActionAliasFormat("(list|show) {{type}}", "(list|show) {{type}}")
+    assert fmt.match("list hosts") is True
+    assert fmt.match("show hosts") is True
+    assert fmt.match("remove hosts") is False
+
+    # Anchors are only added when the format doesn't have them.
+    fmt = ActionAliasFormat("^run {{cmd}}$", "^run {{cmd}}$")
+    assert fmt.regex.pattern.startswith("^run ")
+    assert fmt.match("run ls") is True
+    assert fmt.match("please run ls") is False
+
+    # Optional parameters can be left out with the whitespace before them.
+    fmt = ActionAliasFormat("deploy {{pack}} to {{env=prod}}", "deploy {{pack}} to {{env=prod}}")
+    assert fmt.match("deploy foo to") is True
+    assert fmt.match("deploy foo to dev") is True
+    assert fmt.match("deploy foo") is False
+
+
+def test_action_alias_index():
+    """
+    Action-alias index.
+    """
+    st2api = Mock()
+    st2api.actionalias_list.return_value = [
+        {"ref": "packs.install", "formats": ["pack install {{packs}}"]},
+        {
+            "ref": "core.ping",
+            "enabled": False,
+            "formats": [{"display": "ping", "representation": ["ping", "ping {{host}}"]}],
+        },
+    ]
+    index = ActionAliasIndex(st2api, ttl=300)
+
+    matches = index.match("pack install st2")
+    assert len(matches) == 1
+    assert matches[0]["actionalias"]["ref"] == "packs.install"
+
+    matches = index.match("ping web01")
+    assert len(matches) == 1
+    assert matches[0]["display"] == "ping"
+    assert matches[0]["representation"] == "ping {{host}}"
+
+    assert index.match("pack list") == []
+    assert st2api.actionalias_list.call_count == 1
+
+    # Invalidated index is fetched again.
+    index.invalidate("st2.action_alias__update", "{}")
+    index.match("pack list")
+    assert st2api.actionalias_list.call_count == 2
+
+    # Index isn't available when it can't be fetched.
+    st2api.actionalias_list.return_value = None
+    assert ActionAliasIndex(st2api).match("pack list") is None
+
+
+if __name__ == "__main__":
+    print("Run with pytest")
+    exit(1)
@@ -1,12 +1,23 @@
 # coding:utf-8
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 
-from errst2lib.authentication_handler import ClientSideAuthHandler, StandaloneAuthHandler
+from mock import Mock
+
+from errst2lib.authentication_handler import (
+    AuthHandlerFactory,
+    ClientSideAuthHandler,
+    ServerSideAuthHandler,
+    StandaloneAuthHandler,
+)
 from errst2lib.credentials_adapters import (
     CredentialsFactory,
     St2UserCredentials,
     St2UserToken,
     St2ApiKey,
 )
+from errst2lib.errors import SessionExistsError
 
 pytest_plugins = ["errbot.backends.test"]
 extra_plugin_dir = "."
@@ -37,6 +48,48 @@ def test_credentials_manager():
     assert apikey_creds.requests() == {"St2-Api-Key": apikey}
 
 
+def test_serverside_token_cache():
+    """
+    Server side user tokens are cached until shortly before they expire.
+    """
+    cfg = Mock()
+    cfg.auth_url = "https://localhost/auth/v1"
+    cfg.user_token_ttl = 86400
+    cfg.token_expiry_margin = 300
+    expiry = datetime.now(timezone.utc) + timedelta(hours=1)
+
+    def request(*args, **kwargs):
+        # Let concurrent commands arrive while the token is fetched.
+        time.sleep(0.2)
+        return Mock(status_code=200, json=lambda: {"token": "abc", "expiry": expiry.isoformat()})
+
+    cfg.http.request = Mock(side_effect=request)
+    handler = AuthHandlerFactory.instantiate("serverside")(cfg)
+    assert isinstance(handler, ServerSideAuthHandler)
+
+    accessctl = Mock()
+    accessctl.get_token_by_userid.return_value = St2UserToken("bot_token")
+    accessctl.create_session.side_effect = SessionExistsError
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        tokens = list(
+            executor.map(
+                lambda _: handler.pre_execution_authentication(accessctl, "user"), range(8)
+            )
+        )
+    assert all(t.token == "abc" for t in tokens)
+    assert cfg.http.request.call_count == 1
+    accessctl.set_token_by_session.assert_called_once()
+
+    # Later commands are served from the cache, which expires before the token.
+    assert handler.pre_execution_authentication(accessctl, "user").token == "abc"
+    assert cfg.http.request.call_count == 1
+    cached_until = handler.tokens.items["user"][0] - time.monotonic()
+    assert 3200 < cached_until < 3300
+    assert handler.stats()["fetches"] == 1
+    assert handler.stats()["hits"] == 1
+
+
 if __name__ == "__main__":
     print("Run with python -m pytest")
     exit(1)
@@ -0,0 +1,78 @@
+# coding:utf-8
+import time
+
+from errst2lib.cache import RecentSet, TTLCache
+
+pytest_plugins = ["errbot.backends.test"]
+extra_plugin_dir = "."
+
+
+def test_ttl_cache():
+    """
+    Time to live cache.
+    """
+    cache = TTLCache(ttl=300)
+
+    cache.set("key", "value")
+    assert cache.get("key") == "value"
+    assert cache.get("missing") is None
+    assert cache.get("missing", False) is False
+
+    # Expired entries are removed.
+    cache.set("short", "value", ttl=1)
+    time.sleep(1.1)
+    assert cache.get("short") is None
+    assert len(cache) == 1
+
+    cache.delete("key")
+    assert cache.get("key") is None
+
+    cache.set("key", "value")
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_lru_cache():
+    """
+    Time to live cache with a maximum size.
+    """
+    cache = TTLCache(ttl=300, maxsize=2)
+
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+
+    # The least recently used entry is evicted.
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+    stats = cache.stats()
+    assert stats["size"] == 2
+    assert stats["hits"] == 3
+    assert stats["misses"] == 1
+    assert stats["hit_rate"] == 0.75
+    assert stats["evictions"] == 1
+
+
+def test_recent_set():
+    """
+    Bounded set of recent keys.
+    """
+    recent = RecentSet(maxsize=2)
+
+    assert recent.add("a") is True
+    assert recent.add("a") is False
+    assert recent.add("b") is True
+    assert "a" in recent
+
+    # The oldest key is forgotten.
+    assert recent.add("c") is True
+    assert "a" not in recent
+    assert len(recent) == 2
+
+
+if __name__ == "__main__":
+    print("Run with pytest")
+    exit(1)
@@ -1,4 +1,5 @@
 # coding:utf-8
+import pytest
 from mock import Mock
 
 from errst2lib.chat_adapters import (
@@ -8,27 +9,55 @@ from errst2lib.chat_adapters import (
     SlackChatAdapter,
     XMPPChatAdapter,
 )
+from errst2lib.errors import DeliveryPermanentError
 
 pytest_plugins = ["errbot.backends.test"]
 extra_plugin_dir = "."
 
 
-def test_chat_adapters():
+def test_chat_adapters(bot_plugin):
     """
     Chat Adapters
     """
-    slack = ChatAdapterFactory.instance("slack")(Mock())
+    slack = ChatAdapterFactory.instance("slack")(bot_plugin)
     assert isinstance(slack, SlackChatAdapter)
 
-    mattermost = ChatAdapterFactory.instance("mattermost")(Mock())
+    mattermost = ChatAdapterFactory.instance("mattermost")(bot_plugin)
     assert isinstance(mattermost, MattermostChatAdapter)
 
-    xmpp = ChatAdapterFactory.instance("xmpp")(Mock())
+    xmpp = ChatAdapterFactory.instance("xmpp")(bot_plugin)
     assert isinstance(xmpp, XMPPChatAdapter)
 
-    generic = ChatAdapterFactory.instance("generic")(Mock())
+    generic = ChatAdapterFactory.instance("generic")(bot_plugin)
     assert isinstance(generic, GenericChatAdapter)
 
+    # Backend rate limits are merged with the configured limits.
+    bot_plugin.cfg.rate_limit = {"channel_rate": 2}
+    slack = ChatAdapterFactory.instance("slack")(bot_plugin)
+    assert slack.rate_limiter.channel_rate == 2
+    assert slack.rate_limiter.channel_burst == 5
+
+
+def test_identifier_cache(bot_plugin):
+    """
+    Chat adapters cache resolved identifiers.
+    """
+    bot_plugin.build_identifier.side_effect = lambda text: "id:{}".format(text)
+
+    generic = GenericChatAdapter(bot_plugin)
+    generic.post_message(False, "one", "@bob", "#deploy", {})
+    generic.post_message(False, "two", "@bob", "#deploy", {})
+    assert bot_plugin.build_identifier.call_count == 2
+    bot_plugin.send.assert_called_with("id:#deploy", "two")
+
+    # Identifiers are forgotten when the chat service rejects them.
+    err = Exception("Not found")
+    err.response = Mock(status_code=404)
+    bot_plugin.send.side_effect = err
+    with pytest.raises(DeliveryPermanentError):
+        generic.post_message(False, "three", "@bob", "#deploy", {})
+    assert len(generic.identifiers) == 0
+
 
 if __name__ == "__main__":
     print("Run with pytest")
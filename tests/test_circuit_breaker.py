@@ -0,0 +1,72 @@
+# coding:utf-8
+import time
+
+import pytest
+
+from errst2lib.circuit_breaker import CircuitBreaker, CircuitBreakers
+from errst2lib.errors import CircuitOpenError
+
+pytest_plugins = ["errbot.backends.test"]
+extra_plugin_dir = "."
+
+
+def test_circuit_breaker():
+    """
+    Circuit breaker states.
+    """
+    breaker = CircuitBreaker("match", failure_threshold=2, reset_timeout=1)
+
+    # Closed circuit allows requests.
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+    # Open circuit fails fast.
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    # Half-open circuit allows a single trial request.
+    time.sleep(1.1)
+    breaker.before_call()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    # Failed trial re-opens the circuit.
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+
+    # Successful trial closes the circuit.
+    time.sleep(1.1)
+    breaker.before_call()
+    breaker.record_success(0.1)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.stats()["rejected"] == 2
+
+
+def test_adaptive_timeout():
+    """
+    Timeouts adapt to the observed latency.
+    """
+    breaker = CircuitBreaker("help", min_timeout=1, max_timeout=10, timeout_factor=3, samples=20)
+    assert breaker.timeout() == 10
+
+    for _ in range(20):
+        breaker.record_success(0.5)
+    assert breaker.timeout() == 1.5
+
+    for _ in range(20):
+        breaker.record_success(0.1)
+    assert breaker.timeout() == 1
+
+    breakers = CircuitBreakers({"max_timeout": 5})
+    assert breakers.get("execute") is breakers.get("execute")
+    assert breakers.get("execute").timeout() == 5
+
+
+if __name__ == "__main__":
+    print("Run with pytest")
+    exit(1)
@@ -0,0 +1,78 @@
+# coding:utf-8
+import threading
+import time
+
+from errst2lib.coalescer import Coalescer
+from errst2lib.delivery import Announcement
+
+pytest_plugins = ["errbot.backends.test"]
+extra_plugin_dir = "."
+
+
+def test_coalescer():
+    """
+    Bursts of plain text announcements are merged.
+    """
+    emitted = []
+    coalescer = Coalescer(emitted.append, window=0.2, max_length=10)
+
+    coalescer.put(Announcement(False, "one", None, "#deploy", {}))
+    coalescer.put(Announcement(False, "two", None, "#deploy", {}))
+    coalescer.put(Announcement(True, "secret", "@bob", "#deploy", {}))
+    assert emitted == []
+
+    # Announcements with extra data flush the channel's pending announcements first.
+    card = Announcement(False, "card", None, "#deploy", {"slack": {"color": "red"}})
+    coalescer.put(card)
+    assert [a.message for a in emitted] == ["one\ntwo", "secret", "card"]
+
+    # Merged messages are limited in size.
+    emitted.clear()
+    coalescer.put(Announcement(False, "three", None, "#deploy", {}))
+    coalescer.put(Announcement(False, "four", None, "#deploy", {}))
+    coalescer.put(Announcement(False, "five", None, "#deploy", {}))
+    assert [a.message for a in emitted] == ["three\nfour"]
+
+    # Pending announcements are emitted when the window closes.
+    time.sleep(0.4)
+    assert [a.message for a in emitted] == ["three\nfour", "five"]
+
+    stats = coalescer.stats()
+    assert stats["received"] == 7
+    assert stats["emitted"] == 5
+
+    coalescer.put(Announcement(False, "six", None, "#deploy", {}))
+    coalescer.shutdown()
+    assert emitted[-1].message == "six"
+
+
+def test_coalescer_slow_emit():
+    """
+    A slow delivery doesn't block announcements being added.
+    """
+    release = threading.Event()
+    emitted = []
+
+    def emit(announcement):
+        release.wait(5)
+        emitted.append(announcement)
+
+    coalescer = Coalescer(emit, window=10)
+    card = Announcement(False, "card", None, "#deploy", {"slack": {"color": "red"}})
+    threading.Thread(target=coalescer.put, args=[card], daemon=True).start()
+    while coalescer.stats()["emitted"] == 0:
+        time.sleep(0.01)
+
+    start = time.monotonic()
+    coalescer.put(Announcement(False, "one", None, "#alerts", {}))
+    assert time.monotonic() - start < 1
+    assert emitted == []
+
+    release.set()
+    coalescer.shutdown()
+    assert [a.message for a in emitted] == ["card", "one"]
+
+
+if __name__ == "__main__":
+    print("Run with pytest")
+    exit(1)
@@ -0,0 +1,93 @@
+# coding:utf-8
+import threading
+import time
+
+import pytest
+
+from errst2lib.delivery import Announcement, DeliveryQueue
+
+pytest_plugins = ["errbot.backends.test"]
+extra_plugin_dir = "."
+
+
+def test_delivery_order():
+    """
+    Announcements are delivered in order within a channel.
+    """
+    delivered = []
+    delivery = DeliveryQueue("test", delivered.append, workers=4, queue_size=100)
+    announcements = [
+        Announcement(False, str(i), None, "channel{}".format(i % 3), {}) for i in range(30)
+    ]
+    for announcement in announcements:
+        assert delivery.put(announcement) is True
+    delivery.shutdown()
+
+    for channel in ["channel0", "channel1", "channel2"]:
+        expected = [a for a in announcements if a.channel == channel]
+        assert [a for a in delivered if a.channel == channel] == expected
+    assert delivery.stats()["delivered"] == 30
+
+
+@pytest.mark.parametrize(
+    "overflow,expected", [("drop_newest", ["1", "2"]), ("drop_oldest", ["1", "3"])]
+)
+def test_delivery_overflow(overflow, expected):
+    """
+    Overflow policies drop announcements when the queue is full.
+    """
+    started = threading.Event()
+    release = threading.Event()
+    delivered = []
+
+    def deliver(announcement):
+        started.set()
+        release.wait()
+        delivered.append(announcement.message)
+
+    delivery = DeliveryQueue("test", deliver, workers=1, queue_size=1, overflow=overflow)
+
+    # The first announcement is being delivered, the second is queued and the third overflows.
+    delivery.put(Announcement(False, "1", None, "channel", {}))
+    started.wait()
+    delivery.put(Announcement(False, "2", None, "channel", {}))
+    delivery.put(Announcement(False, "3", None, "channel", {}))
+
+    release.set()
+    delivery.shutdown()
+
+    assert delivered == expected
+    assert delivery.stats()["dropped"] == 1
+
+
+def test_delivery_shutdown_timeout():
+    """
+    Shutdown doesn't wait forever for a full queue to be delivered.
+    """
+    started = threading.Event()
+    release = threading.Event()
+    delivered = []
+
+    def deliver(announcement):
+        started.set()
+        release.wait()
+        delivered.append(announcement.message)
+
+    delivery = DeliveryQueue("test", deliver, workers=1, queue_size=1)
+    delivery.put(Announcement(False, "1", None, "channel", {}))
+    started.wait()
+    delivery.put(Announcement(False, "2", None, "channel", {}))
+
+    start = time.monotonic()
+    delivery.shutdown(timeout=0.1)
+    assert time.monotonic() - start < 1
+
+    # The announcement being delivered completes, the queued one is abandoned.
+    release.set()
+    delivery.threads[0].join(1)
+    assert delivered == ["1"]
+
+
+if __name__ == "__main__":
+    print("Run with pytest")
+    exit(1)
@@ -0,0 +1,38 @@
+# coding:utf-8
+import threading
+
+from errst2lib.executor import BoundedExecutor
+
+pytest_plugins = ["errbot.backends.test"]
+extra_plugin_dir = "."
+
+
+def test_bounded_executor():
+    """
+    Bounded executor.
+    """
+    executor = BoundedExecutor("test", workers=1, queue_size=1)
+    release = threading.Event()
+    results = []
+
+    # One job running, one job queued and the third rejected.
+    assert executor.submit(release.wait) is True
+    assert executor.submit(results.append, "queued") is True
+    assert executor.submit(results.append, "rejected") is False
+
+    stats = executor.stats()
+    assert stats["queue_depth"] + stats["running"] == 2
+    assert stats["rejected"] == 1
+
+    release.set()
+    executor.shutdown()
+
+    assert results == ["queued"]
+    stats = executor.stats()
+    assert stats["queue_depth"] == 0
+    assert stats["completed"] == 2
+
+
+if __name__ == "__main__":
+    print("Run with pytest")
+    exit(1)
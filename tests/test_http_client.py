@@ -0,0 +1,128 @@
+# coding:utf-8
+import itertools
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+from mock import Mock
+
+from errst2lib.http_client import HttpClient, HttpClientFactory
+
+pytest_plugins = ["errbot.backends.test"]
+extra_plugin_dir = "."
+
+
+def test_http_client():
+    """
+    Connection pooled HTTP client.
+    """
+    cfg = Mock()
+    cfg.api_url = "https://st2.example.com/api/v1"
+    cfg.auth_url = "https://st2.example.com/auth/v1"
+    cfg.stream_url = "https://stream.example.com:9102/v1"
+    cfg.verify_cert = True
+    cfg.ca_cert = "/etc/ssl/st2_ca.pem"
+    cfg.client_cert = "/etc/ssl/bot.crt"
+    cfg.client_key = "/etc/ssl/bot.key"
+    cfg.pool_size = {"api_url": 20, "auth_url": 4}
+    cfg.circuit_breaker = {}
+
+    client = HttpClient(cfg)
+
+    # Certificates are applied to the session.
+    assert client.session.verify == cfg.ca_cert
+    assert client.session.cert == (cfg.client_cert, cfg.client_key)
+
+    # End points on the same host share the largest pool.
+    adapter = client.session.get_adapter(cfg.api_url)
+    assert adapter is client.session.get_adapter(cfg.auth_url)
+    assert adapter._pool_maxsize == 20
+
+    # Unconfigured end points use the default pool size.
+    adapter = client.session.get_adapter(cfg.stream_url)
+    assert adapter._pool_maxsize == HttpClient.default_pool_size
+
+    # Disabling verification ignores the CA certificate.
+    cfg.verify_cert = False
+    client = HttpClient(cfg)
+    assert client.session.verify is False
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    paths = []
+    last_ids = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        StubHandler.paths.append(self.path)
+        StubHandler.last_ids.append(self.headers.get("Last-Event-ID"))
+        if self.path.startswith("/v1/stream"):
+            body = b'event: st2.announcement__errbot\ndata: {"a": 1}\n\nid: 2\ndata: x\ndata: y\n\n'
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+        else:
+            body = json.dumps({"path": self.path, "token": self.headers.get("X-Auth-Token")})
+            body = body.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.mark.parametrize("engine", ["requests", "asyncio"])
+def test_http_client_engines(engine):
+    """
+    HTTP client engines return the same responses and stream events.
+    """
+    if engine == "asyncio":
+        pytest.importorskip("aiohttp")
+
+    server = HTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}/v1".format(server.server_port)
+
+    cfg = Mock()
+    cfg.api_url = cfg.auth_url = cfg.stream_url = url
+    cfg.verify_cert = True
+    cfg.ca_cert = cfg.client_cert = cfg.client_key = None
+    cfg.pool_size = {}
+    cfg.circuit_breaker = {}
+
+    client = HttpClientFactory.instantiate(engine)(cfg)
+    try:
+        response = client.get(
+            url + "/actionalias", headers={"X-Auth-Token": "abc"}, params={"limit": 1}, timeout=5
+        )
+        assert response.status_code == 200
+        assert response.json() == {"path": "/v1/actionalias?limit=1", "token": "abc"}
+
+        params = {"events": "st2.announcement__errbot,st2.action_alias__create"}
+        stream = client.events(url + "/stream", headers={}, params=params, last_id="1")
+        events = [(e.event, e.id, e.data) for e in itertools.islice(stream, 2)]
+        assert events[0] == ("st2.announcement__errbot", None, '{"a": 1}')
+        assert events[1] == ("message", "2", "x\ny")
+
+        # The event filter is sent to the stream end point.
+        assert (
+            "/v1/stream?events=st2.announcement__errbot%2Cst2.action_alias__create"
+            in StubHandler.paths
+        )
+        # The stream is resumed from the last event id.
+        assert StubHandler.last_ids[-1] == "1"
+    finally:
+        client.close()
+        server.shutdown()
+
+    # Closing the client stops the asyncio event loop thread.
+    assert client.closed is True
+    if engine == "asyncio":
+        assert client.thread.is_alive() is False
+
+
+if __name__ == "__main__":
+    print("Run with pytest")
+    exit(1)
@@ -0,0 +1,47 @@
+# coding:utf-8
+import time
+
+from errst2lib.rate_limiter import RateLimiter, TokenBucket
+
+pytest_plugins = ["errbot.backends.test"]
+extra_plugin_dir = "."
+
+
+def test_token_bucket():
+    """
+    Token bucket.
+    """
+    bucket = TokenBucket(rate=10, burst=2)
+
+    # The burst is sent immediately, further messages reserve the next tokens in order.
+    assert bucket.reserve() == 0.0
+    assert bucket.reserve() == 0.0
+    assert 0.09 < bucket.reserve() <= 0.1
+    assert 0.19 < bucket.reserve() <= 0.2
+
+
+def test_rate_limiter():
+    """
+    Rate limiter with backend and channel buckets.
+    """
+    limiter = RateLimiter(channel_rate=10, channel_burst=1)
+
+    start = time.monotonic()
+    assert limiter.wait("#general") == 0.0
+    assert limiter.wait("#random") == 0.0
+    assert limiter.wait("#general") > 0.0
+    assert time.monotonic() - start >= 0.09
+
+    stats = limiter.stats()
+    assert stats["messages"] == 3
+    assert stats["delayed"] == 1
+
+    # No limits configured.
+    limiter = RateLimiter()
+    assert limiter.wait("#general") == 0.0
+    assert limiter.wait("#general") == 0.0
+
+
+if __name__ == "__main__":
+    print("Run with pytest")
+    exit(1)
@@ -0,0 +1,86 @@
+# coding:utf-8
+import pytest
+from mock import Mock
+
+from errst2lib.chat_adapters import GenericChatAdapter, SlackChatAdapter
+from errst2lib.delivery import Announcement
+from errst2lib.errors import DeliveryPermanentError, DeliveryTransientError
+from errst2lib.retry import DeliveryRetry
+
+pytest_plugins = ["errbot.backends.test"]
+extra_plugin_dir = "."
+
+
+def test_delivery_retry(caplog):
+    """
+    Failed deliveries are retried and dead-lettered.
+    """
+    attempts = []
+
+    def deliver(announcement):
+        attempts.append(announcement)
+        if len(attempts) < 3:
+            raise DeliveryTransientError("Slack API error: ratelimited")
+
+    retry = DeliveryRetry(deliver, max_attempts=3, backoff=0.01)
+    announcement = Announcement(False, "deployed", None, "#deploy", {})
+    assert retry(announcement) == DeliveryRetry.DELIVERED
+    assert len(attempts) == 3
+    assert retry.list_dead_letters() == []
+
+    # Permanent errors aren't retried.
+    deliver = Mock(side_effect=DeliveryPermanentError("Slack API error: channel_not_found"))
+    retry = DeliveryRetry(deliver, max_attempts=3, backoff=0.01)
+    assert retry(announcement) == DeliveryRetry.DEAD_LETTERED
+    assert deliver.call_count == 1
+
+    # Transient errors are dead-lettered after the last attempt.
+    deliver = Mock(side_effect=DeliveryTransientError())
+    retry = DeliveryRetry(deliver, max_attempts=2, backoff=0.01)
+    assert retry(announcement) == DeliveryRetry.DEAD_LETTERED
+    assert deliver.call_count == 2
+    dead_letters = retry.list_dead_letters()
+    assert len(dead_letters) == 1
+    assert dead_letters[0]["announcement"] is announcement
+    assert dead_letters[0]["attempts"] == 2
+    assert retry.stats() == {"retried": 1, "dead_lettered": 1, "dead_letters": 1}
+    # Retries log the attempt count without the message content.
+    warnings = [r.getMessage() for r in caplog.records if r.levelname == "WARNING"]
+    assert warnings[-1].startswith("Delivery attempt 1 of 2 failed")
+    assert "deployed" not in warnings[-1]
+
+    # Stopped retries are abandoned.
+    retry = DeliveryRetry(Mock(side_effect=OSError()), max_attempts=2, backoff=10)
+    retry.stop()
+    assert retry(announcement) is None
+
+
+def test_delivery_errors(bot_plugin):
+    """
+    Chat adapters classify delivery errors.
+    """
+    generic = GenericChatAdapter(bot_plugin)
+    assert isinstance(generic.delivery_error(ConnectionError()), DeliveryTransientError)
+    assert isinstance(
+        generic.delivery_error(Mock(response=Mock(status_code=503))), DeliveryTransientError
+    )
+    assert isinstance(
+        generic.delivery_error(Mock(response=Mock(status_code=404))), DeliveryPermanentError
+    )
+
+    # A message without a destination can't be delivered.
+    bot_plugin.build_identifier.side_effect = ValueError("Unknown identifier")
+    with pytest.raises(DeliveryPermanentError):
+        generic.post_message(False, "deployed", "@nobody", "#nowhere", {})
+
+    slack = SlackChatAdapter(bot_plugin)
+    err = Exception()
+    err.response = {"ok": False, "error": "channel_not_found"}
+    assert isinstance(slack.delivery_error(err), DeliveryPermanentError)
+    err.response = {"ok": False, "error": "ratelimited"}
+    assert isinstance(slack.delivery_error(err), DeliveryTransientError)
+
+
+if __name__ == "__main__":
+    print("Run with pytest")
+    exit(1)
@@ -1,5 +1,12 @@
 # coding:utf-8
-from errst2lib.store_adapters import ClearTextStoreAdapter, StoreAdapterFactory
+import os
+
+from errst2lib.credentials_adapters import St2ApiKey, St2UserToken
+from errst2lib.store_adapters import (
+    ClearTextStoreAdapter,
+    SQLiteStoreAdapter,
+    StoreAdapterFactory,
+)
 
 pytest_plugins = ["errbot.backends.test"]
 extra_plugin_dir = "."
@@ -25,6 +32,51 @@ def test_secret_store():
     assert None is cleartext.get("token")
 
 
+def test_sqlite_secret_store(tmp_path):
+    """
+    SQLite Store backend.
+    """
+    path = str(tmp_path / "secrets.db")
+    store = StoreAdapterFactory.instantiate("sqlite")()
+    assert isinstance(store, SQLiteStoreAdapter)
+    store.setup(path)
+
+    store.set("token", St2UserToken("123456-abcdef-123456", 1716899968.650231))
+    store.set("apikey", St2ApiKey("abcdef"))
+    store.set("session", {"user_id": "user"}, namespace="sessions")
+    store.set("deleted", "secret")
+    store.delete("deleted")
+
+    # Reads are served from memory before the writes are saved.
+    assert store.get("token").token == "123456-abcdef-123456"
+    assert store.get("deleted") is None
+    store.teardown()
+    assert store.stats()["pending"] == 0
+    # Deletions are forgotten once they're written.
+    assert store.stats()["cached"] == 3
+    assert store.get("deleted") is None
+    assert store.stats()["cached"] == 3
+    # The database is only readable by the bot's user.
+    assert os.stat(path).st_mode & 0o777 == 0o600
+
+    restarted = StoreAdapterFactory.instantiate("sqlite")()
+    restarted.setup(path)
+    assert restarted.get("token").token == "123456-abcdef-123456"
+    # The token's expiry is kept for the token cache and revalidation.
+    assert restarted.get("token").expiry == 1716899968.650231
+    assert restarted.get("apikey").apikey == "abcdef"
+    assert restarted.get("session") is None
+    assert restarted.get("session", namespace="sessions") == {"user_id": "user"}
+    assert restarted.get("deleted") is None
+    assert restarted.items("sessions") == [("session", {"user_id": "user"})]
+
+    # Names are read from the database once.
+    restarted.get("token")
+    stats = restarted.stats()
+    assert stats["misses"] == 5
+    assert stats["hits"] == 2
+
+
 if __name__ == "__main__":
     print("Run with python -m pytest")
     exit(1)
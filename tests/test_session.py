@@ -41,6 +41,29 @@ def test_session():
         session.is_expired()
 
 
+def test_session_persistence():
+    """
+    Sessions restored from a dict keep their state and the time left before they expire.
+    """
+    session = Session("test_id", "test_secret", 300)
+    session.unseal()
+    assert not hasattr(session, "__dict__")
+
+    restored = Session.from_dict(session.to_dict())
+    assert restored.id() == session.id()
+    assert restored.is_sealed() is False
+    assert restored.match_secret("test_secret") is True
+    assert restored.match_secret("wrong_secret") is False
+    assert abs(restored.expiry() - session.expiry()) < 2
+    assert restored.attributes() == session.attributes()
+
+    # A session saved before it expired and restored after.
+    attributes = session.to_dict()
+    attributes["modified_date"] -= 600
+    with pytest.raises(SessionExpiredError):
+        Session.from_dict(attributes).is_expired()
+
+
 if __name__ == "__main__":
     print("Run with pytest")
     exit(1)
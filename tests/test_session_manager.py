@@ -1,10 +1,15 @@
 # coding:utf-8
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import pytest
 from mock import Mock
 
-from errst2lib.errors import SessionExistsError, SessionInvalidError
+from errst2lib.authentication_controller import AuthenticationController, BotPluginIdentity
+from errst2lib.credentials_adapters import St2UserToken
+from errst2lib.errors import SessionConsumedError, SessionExistsError, SessionInvalidError
 from errst2lib.session_manager import SessionManager
-from errst2lib.store_adapters import ClearTextStoreAdapter
+from errst2lib.store_adapters import ClearTextStoreAdapter, SQLiteStoreAdapter
 
 pytest_plugins = ["errbot.backends.test"]
 extra_plugin_dir = "."
@@ -16,6 +21,7 @@ def test_session_manager():
     """
     cfg = Mock()
     cfg.secrets_store = "cleartext"
+    cfg.secrets_store_options = {}
 
     user_id = "test%user"
     user_secret = "secret_for_test"
@@ -67,6 +73,153 @@ def test_session_manager():
     assert session_manager.get_secret(s.id()) == user_token
 
 
+def test_session_manager_expire():
+    """
+    Expired sessions and their secrets are evicted.
+    """
+    cfg = Mock()
+    cfg.secrets_store = "cleartext"
+    cfg.secrets_store_options = {}
+    session_manager = SessionManager(cfg)
+
+    sessions = [
+        session_manager.create("user{}".format(i), "secret", 100 if i < 5 else 5000)
+        for i in range(10)
+    ]
+    for s in sessions:
+        session_manager.put_secret(s.id(), "token")
+
+    # Nothing has expired yet.
+    assert session_manager.expire() == 0
+    assert session_manager.stats()["live"] == 10
+
+    # Extend the ttl of a session before it's swept.
+    sessions[0].ttl(5000)
+    # A deleted session leaves a stale entry in the expiry index.
+    session_manager.delete("user1")
+
+    assert session_manager.expire(now=time.monotonic() + 1000) == 3
+
+    for s in sessions[1:5]:
+        assert session_manager.exists(s.user_id) is False
+        assert session_manager.get_secret(s.id()) is None
+    assert session_manager.get_secret(sessions[0].id()) == "token"
+
+    stats = session_manager.stats()
+    assert stats["live"] == 6
+    assert stats["expired"] == 0
+    assert stats["evicted"] == 3
+    assert stats["index"] == 6
+
+
+def test_session_manager_expire_bot():
+    """
+    The bot's session and token aren't evicted when they expire.
+    """
+    bot = Mock()
+    bot.cfg.secrets_store = "cleartext"
+    bot.cfg.secrets_store_options = {}
+    bot.internal_identity = BotPluginIdentity()
+    accessctl = AuthenticationController(bot)
+
+    bot_session = accessctl.sessions.create(bot.internal_identity.name, "secret", 0.01)
+    accessctl.sessions.put_secret(bot_session.id(), "bot token")
+    user_session = accessctl.sessions.create("user", "secret", 0.01)
+    accessctl.sessions.put_secret(user_session.id(), "user token")
+    time.sleep(0.05)
+
+    assert accessctl.expire_sessions() == 1
+    assert accessctl.sessions.exists("user") is False
+    assert accessctl.sessions.exists(bot.internal_identity.name) is True
+    assert accessctl.get_token_by_session(bot_session.id()) == "bot token"
+
+    # The bot's session stays in the expiry index and is kept by later sweeps.
+    assert accessctl.expire_sessions() == 0
+    assert accessctl.sessions.exists(bot.internal_identity.name) is True
+
+
+def test_session_manager_persistent(tmp_path):
+    """
+    Sessions and secrets in a persistent store are restored by a new SessionManager.
+    """
+    cfg = Mock()
+    cfg.secrets_store = "sqlite"
+    cfg.secrets_store_options = {"path": str(tmp_path / "secrets.db")}
+
+    session_manager = SessionManager(cfg)
+    assert isinstance(session_manager.secure_store, SQLiteStoreAdapter)
+    s = session_manager.create("user", "secret", 5000)
+    session_manager.put_secret(s.id(), St2UserToken("1234567890"))
+    s.unseal()
+    session_manager.update(s)
+    expired = session_manager.create("expired_user", "secret", 100)
+    session_manager.put_secret(expired.id(), St2UserToken("expired"))
+    # A session record that can't be read, with its secret.
+    session_manager.secure_store.set("broken_user", {"session_id": "broken"}, "sessions")
+    session_manager.put_secret("broken", St2UserToken("broken"))
+    session_manager.create("deleted_user", "secret", 5000)
+    session_manager.delete("deleted_user")
+    session_manager.teardown()
+    # Expire a session while the bot isn't running.
+    expired.modified_date -= 1000
+    session_manager.update(expired)
+    session_manager.teardown()
+
+    restarted = SessionManager(cfg)
+    assert restarted.exists("expired_user") is False
+    assert restarted.exists("deleted_user") is False
+    assert restarted.exists("broken_user") is False
+    s1 = restarted.get_by_uuid(s.id())
+    assert s1.user_id == "user"
+    assert s1.is_sealed() is False
+    assert s1.match_secret("secret") is True
+    assert restarted.get_secret(s.id()).token == "1234567890"
+    assert restarted.secure_store.stats()["misses"] == 1
+    restarted.teardown()
+
+    # The secrets of the expired and unreadable sessions were deleted along with them.
+    restarted = SessionManager(cfg)
+    assert restarted.get_secret(expired.id()) is None
+    assert restarted.get_secret("broken") is None
+    assert restarted.get_secret(s.id()).token == "1234567890"
+
+
+def test_session_manager_concurrency():
+    """
+    Parallel create, consume and delete cycles on a shared set of users.
+    """
+    cfg = Mock()
+    cfg.secrets_store = "cleartext"
+    cfg.secrets_store_options = {}
+    session_manager = SessionManager(cfg)
+
+    def cycle(i):
+        user_id = "user{}".format(i % 64)
+        try:
+            s = session_manager.create(user_id, "secret", 5000)
+        except SessionExistsError:
+            return False
+        session_manager.put_secret(s.id(), "token{}".format(i))
+        assert session_manager.get_by_uuid(s.id()) is s
+        session_manager.consume(s.id())
+        with pytest.raises(SessionConsumedError):
+            session_manager.consume(s.id())
+        assert session_manager.get_secret(s.id()) == "token{}".format(i)
+        session_manager.delete(user_id, s.id())
+        with pytest.raises(SessionInvalidError):
+            session_manager.get_by_uuid(s.id())
+        return True
+
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        completed = list(executor.map(cycle, range(5000)))
+
+    assert any(completed)
+    assert session_manager.list_sessions() == []
+    assert session_manager.store.id_to_user_map == {}
+    assert session_manager.secure_store.associations == {}
+    assert session_manager.stats()["live"] == 0
+
+
 if __name__ == "__main__":
     print("Run with pytest")
     exit(1)
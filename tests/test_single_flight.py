@@ -0,0 +1,52 @@
+# coding:utf-8
+import threading
+import time
+
+import pytest
+
+from errst2lib.single_flight import SingleFlight
+
+pytest_plugins = ["errbot.backends.test"]
+extra_plugin_dir = "."
+
+
+def test_single_flight():
+    """
+    Concurrent calls share a single in-flight call.
+    """
+    flight = SingleFlight()
+    calls = []
+
+    def authenticate():
+        calls.append(1)
+        time.sleep(0.5)
+        return "token"
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(flight.do("bot", authenticate)))
+        for _ in range(10)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
+    assert results == ["token"] * 10
+
+    # Calls after completion run again.
+    assert flight.do("bot", authenticate) == "token"
+    assert len(calls) == 2
+
+    # Exceptions are raised to the caller.
+    def fail():
+        raise ValueError("failed")
+
+    with pytest.raises(ValueError):
+        flight.do("bot", fail)
+
+
+if __name__ == "__main__":
+    print("Run with pytest")
+    exit(1)
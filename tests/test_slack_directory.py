@@ -0,0 +1,99 @@
+# coding:utf-8
+import time
+
+from mock import Mock
+
+from errst2lib.chat_adapters import SlackChatAdapter
+from errst2lib.slack_directory import SlackDirectory
+
+pytest_plugins = ["errbot.backends.test"]
+extra_plugin_dir = "."
+
+
+def paginated(key, pages):
+    """
+    Returns a fake Slack list method serving pages of items.
+    """
+
+    def method(cursor=None, limit=None, **kwargs):
+        page = int(cursor or 0)
+        next_cursor = str(page + 1) if page + 1 < len(pages) else ""
+        return {key: pages[page], "response_metadata": {"next_cursor": next_cursor}}
+
+    return Mock(side_effect=method)
+
+
+def test_slack_directory(bot_plugin):
+    """
+    Slack directory translates user and channel names to Slack ids.
+    """
+    client = Mock()
+    client.users_list = paginated(
+        "members",
+        [
+            [{"id": "U1", "name": "alice"}, {"id": "U2", "name": "bob"}],
+            [{"id": "U3", "name": "carol", "deleted": True}],
+        ],
+    )
+    client.conversations_list = paginated("channels", [[{"id": "C1", "name": "deploy"}]])
+
+    directory = SlackDirectory(lambda: client, page_size=2)
+    directory.load()
+    assert client.users_list.call_count == 2
+
+    assert directory.translate("@alice") == "<@U1>"
+    assert directory.translate("@U2") == "<@U2>"
+    assert directory.translate("#deploy") == "<#C1>"
+    assert directory.username("U2") == "bob"
+
+    # Unknown and deleted names are left for the backend to resolve.
+    assert directory.translate("@carol") == "@carol"
+    assert directory.translate("#deploy/alice") == "#deploy/alice"
+    assert directory.translate("<@U1>") == "<@U1>"
+
+    stats = directory.stats()
+    assert stats["users"] == 2
+    assert stats["channels"] == 1
+    assert stats["misses"] == 1
+
+    # The Slack chat adapter builds identifiers from the directory's ids.
+    bot_plugin.cfg.slack_directory = True
+    slack = SlackChatAdapter(bot_plugin)
+    slack.directory = directory
+    slack.build_identifier("#deploy")
+    bot_plugin.build_identifier.assert_called_with("<#C1>")
+    assert slack.get_username(Mock(frm=Mock(userid="U1"))) == "@alice"
+
+
+def test_slack_directory_stopped():
+    """
+    Stopping the directory while it waits out a rate limit discards the partial load.
+    """
+    rate_limited = Exception("ratelimited")
+    rate_limited.response = Mock(status_code=429, headers={"Retry-After": "30"})
+    pages = [[{"id": "U1", "name": "alice"}], rate_limited]
+
+    def users_list(cursor=None, limit=None, **kwargs):
+        page = pages[int(cursor or 0)]
+        if isinstance(page, Exception):
+            raise page
+        return {"members": page, "response_metadata": {"next_cursor": "1"}}
+
+    client = Mock()
+    client.users_list = Mock(side_effect=users_list)
+
+    directory = SlackDirectory(lambda: client)
+    directory.start()
+    while client.users_list.call_count < 2:
+        time.sleep(0.01)
+    directory.stop()
+
+    assert directory.thread is None
+    assert client.conversations_list.called is False
+    assert directory.stats()["loads"] == 0
+    assert directory.username("U1") is None
+
+
+if __name__ == "__main__":
+    print("Run with pytest")
+    exit(1)
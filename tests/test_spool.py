@@ -0,0 +1,41 @@
+# coding:utf-8
+from errst2lib.delivery import Announcement
+from errst2lib.spool import Spool
+
+pytest_plugins = ["errbot.backends.test"]
+extra_plugin_dir = "."
+
+
+def test_spool(tmp_path):
+    """
+    Announcement spool.
+    """
+    path = str(tmp_path / "spool.db")
+    spool = Spool(path)
+
+    first = Announcement(False, "first", "@bob", "#deploy", {"slack": {"color": "red"}})
+    second = Announcement(True, "second", "@bob", "#deploy", {})
+    spool.append(first)
+    spool.append(second)
+    assert len(spool) == 2
+
+    spool.done(first)
+    assert len(spool) == 1
+    spool.close()
+
+    # Undelivered announcements are replayed after a restart.
+    spool = Spool(path)
+    pending = spool.pending()
+    assert len(pending) == 1
+    assert pending[0].to_dict() == second.to_dict()
+    assert pending[0].spool_ids == second.spool_ids
+
+    spool.done(pending[0])
+    assert spool.pending() == []
+    assert spool.conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    spool.close()
+
+
+if __name__ == "__main__":
+    print("Run with pytest")
+    exit(1)
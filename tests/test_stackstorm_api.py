@@ -0,0 +1,190 @@
+# coding:utf-8
+import threading
+import time
+
+from mock import Mock
+
+from errst2lib.credentials_adapters import St2ApiKey, St2UserToken
+from errst2lib.stackstorm_api import StackStormAPI
+
+pytest_plugins = ["errbot.backends.test"]
+extra_plugin_dir = "."
+
+
+def test_stream_events():
+    """
+    Stream listener subscribes to announcements and events with a registered handler.
+    """
+    cfg = Mock()
+    cfg.route_key = "errbot"
+    cfg.alias_index = False
+
+    st2api = StackStormAPI(cfg, Mock())
+    assert st2api.stream_events() == ["st2.announcement__errbot"]
+
+    handler = Mock()
+    st2api.add_stream_handler(["st2.action_alias__update", "st2.action_alias__create"], handler)
+    assert st2api.stream_events() == [
+        "st2.announcement__errbot",
+        "st2.action_alias__create",
+        "st2.action_alias__update",
+    ]
+
+
+def test_stream_resume():
+    """
+    Stream event ids are tracked to resume the stream and drop duplicates.
+    """
+    cfg = Mock()
+    cfg.alias_index = False
+
+    st2api = StackStormAPI(cfg, Mock())
+    assert st2api._stream_seen(Mock(id=None)) is False
+    assert st2api._stream_seen(Mock(id="1")) is False
+    assert st2api._stream_seen(Mock(id="2")) is False
+    assert st2api.stream_last_id == "2"
+
+    # Events replayed after a reconnect are dropped.
+    assert st2api._stream_seen(Mock(id="1")) is True
+    assert st2api.stream_last_id == "2"
+    assert st2api.stream_stats()["duplicates"] == 1
+
+
+def test_match_fallback():
+    """
+    Commands the action-alias index doesn't match are matched by StackStorm's API.
+    """
+    cfg = Mock()
+    cfg.alias_index = False
+    cfg.api_url = "http://localhost:9101/v1"
+    response = Mock(status_code=200)
+    response.json.return_value = {"actionalias": {"ref": "packs.deploy"}}
+    cfg.http.post.return_value = response
+
+    st2api = StackStormAPI(cfg, Mock())
+    st2api.action_aliases = Mock()
+    st2api.action_aliases.match.return_value = [{"actionalias": {"ref": "packs.install"}}]
+    st2token = Mock()
+    st2token.requests.return_value = {}
+    result = st2api.match("pack install st2", st2token)
+    assert result.return_code == 0
+    assert result.message == {"actionalias": {"ref": "packs.install"}}
+    cfg.http.post.assert_not_called()
+
+    st2api.action_aliases.match.return_value = []
+    result = st2api.match("deploy foo", st2token)
+    assert result.return_code == 0
+    assert result.message == {"actionalias": {"ref": "packs.deploy"}}
+    assert cfg.http.post.call_args.args[0] == "http://localhost:9101/v1/actionalias/match"
+
+
+def test_stream_closed():
+    """
+    A stream closed by StackStorm is reconnected and resumed from the last event id.
+    """
+    cfg = Mock()
+    cfg.alias_index = False
+    cfg.stream_url = "http://localhost:9102/v1"
+    accessctl = Mock()
+    accessctl.bot.run_listener = True
+
+    st2api = StackStormAPI(cfg, accessctl)
+    st2api.refresh_bot_credentials = Mock()
+    st2api._stream_seen(Mock(id="4"))
+
+    def stop(event, data):
+        accessctl.bot.run_listener = False
+
+    st2api.add_stream_handler(["st2.action_alias__update"], stop)
+    cfg.http.events.side_effect = [
+        iter([]),
+        iter([Mock(event="st2.action_alias__update", id="5", data="{}")]),
+    ]
+    st2api.st2stream_listener(Mock(), Mock())
+
+    assert cfg.http.events.call_args_list[1][1]["last_id"] == "4"
+    assert st2api.stream_failures == 0
+    assert st2api.stream_last_gap is not None
+    assert st2api.stream_stats()["reconnects"] == 1
+
+
+def test_bot_renewal(monkeypatch):
+    """
+    The bot token is renewed after a fraction of its lifetime and failed renewals are retried.
+    """
+    monkeypatch.setattr(StackStormAPI, "refresh_min_interval", 0)
+    monkeypatch.setattr(StackStormAPI, "authenticate_backoff", 0.05)
+    cfg = Mock()
+    cfg.alias_index = False
+    cfg.bot_token_renewal = 0.5
+
+    st2api = StackStormAPI(cfg, Mock())
+    renewed = threading.Event()
+    attempts = []
+
+    def refresh_bot_credentials():
+        attempts.append(time.monotonic())
+        if len(attempts) == 2:
+            raise Exception("StackStorm unavailable")
+        st2api.schedule_bot_renewal(St2UserToken("new", time.time() + 3600))
+        renewed.set()
+
+    st2api.refresh_bot_credentials = refresh_bot_credentials
+    start = time.monotonic()
+    st2api.schedule_bot_renewal(St2UserToken("old", time.time() + 0.4))
+    assert renewed.wait(2)
+    assert attempts[0] - start >= 0.15
+    stats = st2api.refresh_stats()
+    assert stats["renewals"] == 1
+    assert 3590 < stats["token_expires_in"] <= 3600
+    assert 1790 < st2api.bot_renewal_at - time.time() <= 1800
+
+    # A failed renewal is retried while the token is still valid.
+    renewed.clear()
+    st2api.schedule_bot_renewal(St2UserToken("old", time.time() + 0.4))
+    assert renewed.wait(2)
+    stats = st2api.refresh_stats()
+    assert stats["renewals"] == 3
+    assert stats["renewal_failures"] == 1
+    st2api.cancel_bot_renewal()
+    assert st2api.renewal_timer is None
+
+    # Tokens issued while renewal is cancelled are renewed once it's resumed.
+    st2api.schedule_bot_renewal(St2UserToken("new", time.time() + 3600))
+    assert st2api.renewal_timer is None
+    st2api.resume_bot_renewal()
+    assert st2api.renewal_timer is not None
+    st2api.cancel_bot_renewal()
+
+    # Tokens without an expiry aren't renewed by the timer.
+    st2api.schedule_bot_renewal(St2ApiKey("key"))
+    assert st2api.renewal_timer is None
+    st2api.resume_bot_renewal()
+    assert st2api.renewal_timer is None
+
+
+def test_refresh_failed():
+    """
+    A failed refresh doesn't hold back the next attempt.
+    """
+    cfg = Mock()
+    cfg.alias_index = False
+    accessctl = Mock()
+    accessctl.bot.reauthenticate_bot_credentials.return_value = False
+
+    st2api = StackStormAPI(cfg, accessctl)
+    st2api.refresh_bot_credentials()
+    st2api.refresh_bot_credentials()
+    assert accessctl.bot.reauthenticate_bot_credentials.call_count == 2
+    assert st2api.refreshed_at is None
+
+    # Refreshes following a successful one reuse its token.
+    accessctl.bot.reauthenticate_bot_credentials.return_value = True
+    st2api.refresh_bot_credentials()
+    st2api.refresh_bot_credentials()
+    assert accessctl.bot.reauthenticate_bot_credentials.call_count == 3
+
+
+if __name__ == "__main__":
+    print("Run with pytest")
+    exit(1)
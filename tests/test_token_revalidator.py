@@ -0,0 +1,90 @@
+# coding:utf-8
+import time
+
+from mock import Mock
+
+from errst2lib.credentials_adapters import St2UserToken
+from errst2lib.errors import SessionExpiredError
+from errst2lib.token_revalidator import TokenRevalidator
+
+pytest_plugins = ["errbot.backends.test"]
+extra_plugin_dir = "."
+
+
+def session(session_id, user_id, sealed=False, expired=False):
+    s = Mock()
+    s.id.return_value = session_id
+    s.user_id = user_id
+    if expired:
+        s.is_sealed.side_effect = SessionExpiredError
+    else:
+        s.is_sealed.return_value = sealed
+    return s
+
+
+def test_token_revalidator():
+    """
+    Rejected tokens are evicted, expiring tokens are warned about once.
+    """
+    now = time.time()
+    tokens = {
+        "s-bot": St2UserToken("bot", now + 86400),
+        "s-valid": St2UserToken("valid", now + 86400),
+        "s-expiring": St2UserToken("expiring", now + 600),
+        "s-rejected": St2UserToken("rejected", now + 86400),
+        "s-unknown": St2UserToken("unknown", now + 600),
+    }
+    accessctl = Mock()
+    accessctl.to_userid.return_value = "bot"
+    accessctl.list_sessions.return_value = [
+        session("s-bot", "bot"),
+        session("s-valid", "alice"),
+        session("s-expiring", "bob"),
+        session("s-rejected", "carol"),
+        session("s-unknown", "dave"),
+        session("s-sealed", "erin", sealed=True),
+        session("s-expired", "frank", expired=True),
+    ]
+    accessctl.get_token_by_session.side_effect = lambda session_id: tokens[session_id]
+    accessctl.get_token_by_userid.return_value = tokens["s-bot"]
+
+    def validate(token, bot_token):
+        assert bot_token is tokens["s-bot"]
+        return {"rejected": False, "unknown": None}.get(token.token, True)
+
+    validate = Mock(side_effect=validate)
+    notify = Mock()
+    revalidator = TokenRevalidator(
+        accessctl, validate, notify, batch_size=2, workers=2, rate=1000, warning=3600
+    )
+
+    revalidator.run()
+
+    # The bot's, sealed and expired sessions aren't checked.
+    assert validate.call_count == 4
+    accessctl.delete_session.assert_called_once_with("s-rejected")
+    assert sorted(c.args[0] for c in notify.call_args_list) == ["bob", "carol"]
+    for c in notify.call_args_list:
+        if c.args[0] == "bob":
+            assert 0 < c.args[1] <= 600
+        else:
+            assert c.args[1] is None
+
+    stats = revalidator.stats()
+    assert stats["runs"] == 1
+    assert stats["checked"] == 4
+    assert stats["evicted"] == 1
+    assert stats["warnings"] == 1
+    assert stats["errors"] == 1
+
+    # The expiring token is only warned about once.
+    notify.reset_mock()
+    accessctl.list_sessions.return_value = [session("s-expiring", "bob")]
+    revalidator.run()
+    notify.assert_not_called()
+    assert revalidator.stats()["runs"] == 2
+
+
+if __name__ == "__main__":
+    print("Run with pytest")
+    exit(1)
@@ -0,0 +1,148 @@
+# coding:utf-8
+from mock import Mock
+
+from errst2lib.cache import TTLCache
+from errst2lib.retry import DeliveryRetry
+from st2 import St2
+
+pytest_plugins = ["errbot.backends.test"]
+extra_plugin_dir = "."
+
+
+def plugin(webhook_async, webhook_status=False):
+    """
+    Returns an St2 plugin with just the state used by the chatops webhooks.
+    """
+    st2 = St2.__new__(St2)
+    st2.cfg = Mock(
+        webhook_async=webhook_async,
+        webhook_status=webhook_status,
+        webhook_batch_max=10,
+        delivery_workers=4,
+    )
+    st2.chatbackend = Mock()
+    st2.spool = None
+    st2.delivery = None
+    st2.coalescer = None
+    st2.retry = DeliveryRetry(st2.post_to_chat)
+    st2.receipts = TTLCache(3600)
+    return st2
+
+
+def test_chatops_message():
+    """
+    The chatops message webhook validates and delivers messages.
+    """
+    st2 = plugin(webhook_async=False)
+    result = st2.chatops_message({"channel": "#deploy", "message": "done"})
+    assert result == "Delivered to chat backend."
+    st2.chatbackend.post_message.assert_called_with(None, "done", None, "#deploy", {})
+
+    # Failed messages aren't retried or dead-lettered while the caller waits.
+    st2.chatbackend.post_message.reset_mock()
+    st2.chatbackend.post_message.side_effect = Exception("chat service unavailable")
+    assert st2.chatops_message({"channel": "#deploy", "message": "done"})[1] == 500
+    assert st2.chatbackend.post_message.call_count == 1
+    assert st2.retry.list_dead_letters() == []
+    st2.chatbackend.post_message.side_effect = None
+
+    body, status = st2.chatops_message({"message": "done"})
+    assert status == 400
+    assert body["error"] == "The message has no channel or user."
+
+    body, status = st2.chatops_message({"channel": "#deploy", "extra": "x"})
+    assert status == 400
+
+    # The delivery status is reported when enabled.
+    st2 = plugin(webhook_async=False, webhook_status=True)
+    assert st2.chatops_message({"channel": "#deploy", "message": "done"}) == {"status": "delivered"}
+    st2.chatbackend.post_message.side_effect = Exception("chat service unavailable")
+    body, status = st2.chatops_message({"channel": "#deploy", "message": "done"})
+    assert status == 502
+    assert body["status"] == "failed"
+    assert st2.retry.list_dead_letters() == []
+
+
+def test_chatops_message_async():
+    """
+    Asynchronous messages are acknowledged with a receipt.
+    """
+    st2 = plugin(webhook_async=True)
+    st2.delivery = Mock()
+
+    body, status = st2.chatops_message({"user": "@bob", "whisper": True, "message": "done"})
+    assert status == 202
+    assert body["status"] == "accepted"
+    assert st2.chatops_receipt({}, body["receipt"]) == {
+        "receipt": body["receipt"],
+        "status": "queued",
+    }
+
+    # The receipt is updated once the message is delivered.
+    announcement = st2.delivery.put.call_args[0][0]
+    st2.deliver_announcement(announcement)
+    assert st2.chatops_receipt({}, body["receipt"])["status"] == "delivered"
+
+    assert st2.chatops_receipt({}, "unknown")[1] == 404
+
+
+def test_chatops_messages():
+    """
+    The chatops messages webhook delivers batches of messages.
+    """
+    st2 = plugin(webhook_async=False)
+    messages = [
+        {"channel": "#deploy", "message": "1"},
+        {"channel": "#alerts", "message": "2"},
+        {"message": "no destination"},
+        {"channel": "#deploy", "message": "3"},
+    ]
+    body = st2.chatops_messages(messages)
+    assert [r["status"] for r in body["results"]] == [
+        "delivered",
+        "delivered",
+        "rejected",
+        "delivered",
+    ]
+
+    # Messages are delivered in order within a channel.
+    deploy = [c[0][1] for c in st2.chatbackend.post_message.call_args_list if c[0][3] == "#deploy"]
+    assert deploy == ["1", "3"]
+
+    # Failed messages are posted once and reported without being dead-lettered.
+    def post_message(whisper, message, user, channel, extra):
+        if channel == "#alerts":
+            raise Exception("chat service unavailable")
+
+    st2.chatbackend.post_message.reset_mock()
+    st2.chatbackend.post_message.side_effect = post_message
+    body = st2.chatops_messages(messages)
+    assert [r["status"] for r in body["results"]] == [
+        "delivered",
+        "failed",
+        "rejected",
+        "delivered",
+    ]
+    assert st2.chatbackend.post_message.call_count == 3
+    assert st2.retry.list_dead_letters() == []
+    st2.chatbackend.post_message.side_effect = None
+
+    assert st2.chatops_messages({"messages": "x"})[1] == 400
+    assert st2.chatops_messages([{}] * 11)[1] == 400
+
+    st2 = plugin(webhook_async=True)
+    st2.delivery = Mock()
+    body, status = st2.chatops_messages({"messages": messages})
+    assert status == 202
+    assert [r["status"] for r in body["results"]] == [
+        "accepted",
+        "accepted",
+        "rejected",
+        "accepted",
+    ]
+    assert st2.delivery.put.call_count == 3
+
+
+if __name__ == "__main__":
+    print("Run with pytest")
+    exit(1)